@@ -0,0 +1,205 @@
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+
+def write_synthetic_bam(bam_filename, snp_filename, chromosome, chromosome_length, num_fragments,
+                        read_length=100, fragment_mean=300, fragment_stddev=30, duplicate_rate=0.2,
+                        snp_spacing=1000, seed=2014):
+    """ Write a coordinate sorted synthetic paired end bam and matching snp file.
+
+    Args:
+        bam_filename (str): bam to write, indexed with samtools
+        snp_filename (str): TSV chromosome, position, ref, alt of snps to write
+        chromosome (str): name of the single chromosome
+        chromosome_length (int): length of the chromosome
+        num_fragments (int): number of read pairs
+
+    KwArgs:
+        read_length (int): length of each read
+        fragment_mean (float): mean fragment length
+        fragment_stddev (float): standard deviation of fragment length
+        duplicate_rate (float): proportion of fragments duplicating another fragment
+        snp_spacing (int): distance between snps
+        seed (int): random seed
+
+    Reads are all reference, and the snp file lists a snp every snp_spacing bases.
+
+    """
+
+    rng = np.random.RandomState(seed)
+
+    # Duplicates share the start and length of a random unique fragment
+    num_duplicates = int(duplicate_rate * num_fragments)
+    num_unique = num_fragments - num_duplicates
+
+    lengths = rng.normal(fragment_mean, fragment_stddev, size=num_unique).astype(int)
+    lengths = np.clip(lengths, read_length, 3 * fragment_mean)
+    starts = rng.randint(0, chromosome_length - lengths.max(), size=num_unique)
+
+    originals = rng.randint(0, num_unique, size=num_duplicates)
+    starts = np.concatenate([starts, starts[originals]])
+    lengths = np.concatenate([lengths, lengths[originals]])
+    is_duplicate = np.concatenate([np.zeros(num_unique, dtype=bool), np.ones(num_duplicates, dtype=bool)])
+
+    # Read 1 is leftmost, read 2 is rightmost and reverse
+    reads = pd.DataFrame({
+        'fragment_id': np.concatenate([np.arange(num_fragments)] * 2),
+        'is_read1': np.concatenate([np.ones(num_fragments, dtype=bool), np.zeros(num_fragments, dtype=bool)]),
+        'position': np.concatenate([starts, starts + lengths - read_length]),
+        'mate_position': np.concatenate([starts + lengths - read_length, starts]),
+        'tlen': np.concatenate([lengths, -lengths]),
+        'is_duplicate': np.concatenate([is_duplicate] * 2),
+    })
+    reads['flag'] = np.where(reads['is_read1'], 1 | 2 | 32 | 64, 1 | 2 | 16 | 128)
+    reads['flag'] |= np.where(reads['is_duplicate'], 1024, 0)
+    reads.sort_values(['position', 'fragment_id'], inplace=True)
+
+    seq = 'A' * read_length
+    qual = 'I' * read_length
+    cigar = '{}M'.format(read_length)
+
+    samtools = subprocess.Popen(['samtools', 'view', '-b', '-o', bam_filename, '-'], stdin=subprocess.PIPE)
+
+    samtools.stdin.write('@HD\tVN:1.4\tSO:coordinate\n')
+    samtools.stdin.write('@SQ\tSN:{}\tLN:{}\n'.format(chromosome, chromosome_length))
+
+    for fragment_id, flag, position, mate_position, tlen in zip(
+            reads['fragment_id'].values, reads['flag'].values, reads['position'].values,
+            reads['mate_position'].values, reads['tlen'].values):
+        samtools.stdin.write('SIM:1:FC706VJ:1:{}:{}\t{}\t{}\t{}\t60\t{}\t=\t{}\t{}\t{}\t{}\n'.format(
+            fragment_id % 1000, fragment_id, flag, chromosome, position + 1, cigar,
+            mate_position + 1, tlen, seq, qual))
+
+    samtools.stdin.close()
+    if samtools.wait() != 0:
+        raise Exception('samtools view failed')
+
+    subprocess.check_call(['samtools', 'index', bam_filename])
+
+    with open(snp_filename, 'w') as f:
+        for position in xrange(snp_spacing, chromosome_length, snp_spacing):
+            f.write('{}\t{}\tA\tC\n'.format(chromosome, position))
+
+
+def run_worker(bam_filename, snp_filename, chromosome, mate_index, chunk_size):
+    """ Extract all fragments and alleles with the given mate index in this process.
+    """
+
+    import remixt.bamreader
+
+    start_time = time.time()
+
+    reader = remixt.bamreader.AlleleReader(
+        bam_filename,
+        snp_filename,
+        chromosome,
+        1000,
+        8,
+        True,
+        hash_mate_index=(mate_index == 'hash'),
+    )
+
+    read_seconds = 0.
+    num_fragments = 0
+    num_alleles = 0
+
+    while True:
+        read_start_time = time.time()
+        more = reader.ReadAlignments(chunk_size)
+        read_seconds += time.time() - read_start_time
+
+        if not more:
+            break
+
+        num_fragments += len(reader.GetFragmentTable().index)
+        num_alleles += len(reader.GetAlleleTable().index)
+
+    return {
+        'mate_index': mate_index,
+        'total_seconds': time.time() - start_time,
+        'read_seconds': read_seconds,
+        'num_fragments': num_fragments,
+        'num_alleles': num_alleles,
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.,
+    }
+
+
+if __name__ == '__main__':
+
+    argparser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    argparser.add_argument('tmp_dir',
+        help='Directory for the synthetic bam')
+
+    argparser.add_argument('--table', required=False,
+        help='Output Table Filename')
+
+    argparser.add_argument('--chromosome_length', type=int, default=2000000,
+        help='Length of the synthetic chromosome')
+
+    argparser.add_argument('--num_fragments', type=int, default=4000000,
+        help='Number of synthetic read pairs')
+
+    argparser.add_argument('--duplicate_rate', type=float, default=0.2,
+        help='Proportion of duplicate read pairs')
+
+    argparser.add_argument('--chunk_size', type=int, default=10000000,
+        help='Alignments per call to ReadAlignments')
+
+    argparser.add_argument('--repeats', type=int, default=3,
+        help='Number of runs of each mate index')
+
+    argparser.add_argument('--worker', choices=['hash', 'map'], required=False,
+        help=argparse.SUPPRESS)
+
+    args = argparser.parse_args()
+
+    chromosome = '1'
+    bam_filename = os.path.join(args.tmp_dir, 'synthetic.bam')
+    snp_filename = os.path.join(args.tmp_dir, 'synthetic_snps.tsv')
+
+    if args.worker is not None:
+        result = run_worker(bam_filename, snp_filename, chromosome, args.worker, args.chunk_size)
+        print json.dumps(result)
+        sys.exit(0)
+
+    if not os.path.exists(args.tmp_dir):
+        os.makedirs(args.tmp_dir)
+
+    write_synthetic_bam(
+        bam_filename, snp_filename, chromosome, args.chromosome_length, args.num_fragments,
+        duplicate_rate=args.duplicate_rate)
+
+    # Run each mate index in a separate process for an independent peak rss
+    results = []
+    for repeat in xrange(args.repeats):
+        for mate_index in ('map', 'hash'):
+            output = subprocess.check_output([
+                sys.executable, os.path.abspath(__file__), args.tmp_dir,
+                '--chunk_size', str(args.chunk_size),
+                '--worker', mate_index,
+            ])
+            result = json.loads(output.strip().split('\n')[-1])
+            result['repeat'] = repeat
+            results.append(result)
+
+    results = pd.DataFrame(results)
+    results['fragments_per_second'] = results['num_fragments'] / results['read_seconds']
+
+    summary = results.groupby('mate_index')[['read_seconds', 'total_seconds', 'fragments_per_second', 'max_rss_mb']].median()
+    print summary
+
+    if len(results['num_fragments'].unique()) != 1 or len(results['num_alleles'].unique()) != 1:
+        raise Exception('mate index implementations extracted different data')
+
+    if args.table is not None:
+        results.to_csv(args.table, sep='\t', index=False)
+
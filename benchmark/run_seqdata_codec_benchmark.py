@@ -0,0 +1,179 @@
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+import remixt.seqdataio
+import remixt.simulations.experiment
+import remixt.simulations.seqread
+
+
+default_codecs = [
+    'zlib:9',
+    'zlib:1',
+    'lzo:5',
+    'blosc:lz4:5',
+    'blosc:lz4hc:5',
+    'blosc:zstd:5',
+    'blosc:zstd:1',
+    'none:0',
+]
+
+
+def parse_codec(codec):
+    """ Parse a codec string of the form complib:complevel, 'none' for no compression.
+    """
+
+    complib, complevel = codec.rsplit(':', 1)
+
+    if complib == 'none':
+        complib = None
+
+    return complib, int(complevel)
+
+
+def simulate_seqdata(seqdata_filename, num_chromosomes, chromosome_length, read_depth, snp_spacing, seed):
+    """ Simulate a normal seqdata file with remixt.simulations.seqread.
+    """
+
+    np.random.seed(seed)
+
+    chromosome_lengths = dict([(str(a), chromosome_length) for a in xrange(1, num_chromosomes + 1)])
+
+    genome_params = dict(remixt.simulations.experiment.RearrangedGenome.default_params)
+    genome_params['chromosome_lengths'] = chromosome_lengths
+
+    genome = remixt.simulations.experiment.RearrangedGenome(num_chromosomes * 10)
+    genome.create(genome_params)
+
+    # Heterozygous snps at regular spacing
+    snps = dict()
+    for chromosome in chromosome_lengths.keys():
+        positions = np.arange(snp_spacing, chromosome_length, snp_spacing)
+        is_alt_0 = np.random.randint(0, 2, size=len(positions))
+        snps['/chromosome_{}'.format(chromosome)] = pd.DataFrame({
+            'position': positions,
+            'is_alt_0': is_alt_0,
+            'is_alt_1': 1 - is_alt_0,
+        })
+
+    params = {
+        'read_length': 100,
+        'fragment_mean': 300,
+        'fragment_stddev': 30,
+        'base_call_error': 0.005,
+    }
+
+    remixt.simulations.seqread.simulate_mixture_read_data(
+        seqdata_filename, [genome], [read_depth], snps, params)
+
+    return chromosome_lengths.keys()
+
+
+def run_codec(seqdata_filename, chromosome_data, codec):
+    """ Write and read back the simulated seqdata with the given codec.
+    """
+
+    complib, complevel = parse_codec(codec)
+
+    raw_bytes = sum([a.values.nbytes + b.values.nbytes for a, b in chromosome_data.itervalues()])
+
+    start_time = time.time()
+    writer = remixt.seqdataio.Writer(seqdata_filename, complib=complib, complevel=complevel)
+    for chromosome, (fragments, alleles) in chromosome_data.iteritems():
+        writer.write(chromosome, fragments.copy(), alleles.copy())
+    writer.close()
+    write_seconds = time.time() - start_time
+
+    start_time = time.time()
+    for chromosome in chromosome_data.keys():
+        remixt.seqdataio.read_fragment_data(seqdata_filename, chromosome)
+        remixt.seqdataio.read_allele_data(seqdata_filename, chromosome)
+    read_seconds = time.time() - start_time
+
+    file_bytes = os.path.getsize(seqdata_filename)
+
+    os.remove(seqdata_filename)
+
+    return {
+        'codec': codec,
+        'raw_mb': raw_bytes / 1e6,
+        'file_mb': file_bytes / 1e6,
+        'ratio': float(raw_bytes) / file_bytes,
+        'write_seconds': write_seconds,
+        'read_seconds': read_seconds,
+        'write_mb_per_second': raw_bytes / 1e6 / write_seconds,
+        'read_mb_per_second': raw_bytes / 1e6 / read_seconds,
+    }
+
+
+if __name__ == '__main__':
+
+    argparser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    argparser.add_argument('tmp_dir',
+        help='Directory for simulated seqdata')
+
+    argparser.add_argument('--table', required=False,
+        help='Output Table Filename')
+
+    argparser.add_argument('--codecs', nargs='+', default=default_codecs,
+        help='Codecs to benchmark as complib:complevel')
+
+    argparser.add_argument('--num_chromosomes', type=int, default=2,
+        help='Number of simulated chromosomes')
+
+    argparser.add_argument('--chromosome_length', type=int, default=20000000,
+        help='Length of each simulated chromosome')
+
+    argparser.add_argument('--read_depth', type=float, default=0.1,
+        help='Simulated haploid read depth in fragments per base')
+
+    argparser.add_argument('--snp_spacing', type=int, default=1000,
+        help='Distance between simulated snps')
+
+    argparser.add_argument('--repeats', type=int, default=3,
+        help='Number of runs of each codec')
+
+    argparser.add_argument('--seed', type=int, default=2014,
+        help='Random seed')
+
+    args = argparser.parse_args()
+
+    if not os.path.exists(args.tmp_dir):
+        os.makedirs(args.tmp_dir)
+
+    source_filename = os.path.join(args.tmp_dir, 'simulated.seqdata')
+    codec_filename = os.path.join(args.tmp_dir, 'codec.seqdata')
+
+    chromosomes = simulate_seqdata(
+        source_filename, args.num_chromosomes, args.chromosome_length,
+        args.read_depth, args.snp_spacing, args.seed)
+
+    # Benchmark on in memory data to exclude simulation and source reads
+    chromosome_data = dict()
+    for chromosome in chromosomes:
+        chromosome_data[chromosome] = (
+            remixt.seqdataio.read_fragment_data(source_filename, chromosome, filter_duplicates=None, map_qual_threshold=None),
+            remixt.seqdataio.read_allele_data(source_filename, chromosome),
+        )
+
+    os.remove(source_filename)
+
+    results = []
+    for repeat in xrange(args.repeats):
+        for codec in args.codecs:
+            result = run_codec(codec_filename, chromosome_data, codec)
+            result['repeat'] = repeat
+            results.append(result)
+
+    results = pd.DataFrame(results)
+
+    summary = results.groupby('codec', sort=False)[['file_mb', 'ratio', 'write_mb_per_second', 'read_mb_per_second']].median()
+    print summary
+
+    if args.table is not None:
+        results.to_csv(args.table, sep='\t', index=False)
+
@@ -0,0 +1,459 @@
+import numpy as np
+import pandas as pd
+
+import remixt.bamreader
+import remixt.config
+import remixt.segalg
+import remixt.seqdataio
+import remixt.analysis.gcbias
+import remixt.analysis.haplotype
+import remixt.analysis.stats
+
+
+def read_bam_chunks(bam_filename, chromosome, config, ref_data_dir, max_alignments=10000000):
+    """ Stream fragment and allele data for a chromosome directly from a bam
+
+    Args:
+        bam_filename (str): bam from which to extract read information
+        chromosome (str): chromosome to extract
+        config (dict): configuration
+        ref_data_dir (str): reference dataset directory
+
+    KwArgs:
+        max_alignments (int): number of alignments to read per chunk
+
+    Yields:
+        tuple of pandas.DataFrame: fragment data and allele data
+
+    Fragment and allele data are as would be read from a seqdata file.
+
+    """
+
+    reader = remixt.bamreader.AlleleReader(
+        bam_filename,
+        remixt.config.get_filename(config, ref_data_dir, 'snp_positions'),
+        chromosome,
+        remixt.config.get_param(config, 'bam_max_fragment_length'),
+        remixt.config.get_param(config, 'bam_max_soft_clipped'),
+        remixt.config.get_param(config, 'bam_check_proper_pair'),
+    )
+
+    while reader.ReadAlignments(max_alignments):
+        yield reader.GetFragmentTable(), reader.GetAlleleTable()
+
+
+class ChromosomeCounter(object):
+    """ Accumulate read counts for a chromosome from streamed fragment and allele data
+
+    KwArgs:
+        segments (pandas.DataFrame): segments for which to count reads
+        haps (pandas.DataFrame): haplotype blocks for which to count allele reads
+        gc_positions (numpy.array): positions at which to count read starts
+        filter_duplicates (bool): filter reads marked as duplicate
+        map_qual_threshold (int): filter reads with less than this mapping quality
+        max_fragment_length (int): maximum length of fragments generating paired reads
+        record_alleles (bool): retain alleles of filtered fragments for later haplotype counting
+
+    Counts are equivalent to those calculated from a seqdata file by
+    `remixt.analysis.segment.count_segment_reads`,
+    `remixt.analysis.haplotype.count_allele_reads`,
+    `remixt.analysis.haplotype.read_snp_counts`, and `remixt.analysis.gcbias.sample_gc`.
+
+    Allele data for a fragment may be produced in a later chunk than the
+    fragment itself, so fragments are retained until the reader has
+    produced allele data beyond the end of the fragment.
+
+    Recorded alleles, with the start and end of their fragment, allow allele
+    counts to be calculated by `count_haplotype_allele_reads` once haplotypes
+    are inferred, without a second pass over the bam.
+
+    """
+
+    def __init__(self, segments=None, haps=None, gc_positions=None, filter_duplicates=False, map_qual_threshold=1, max_fragment_length=1000, record_alleles=False):
+        self.filter_duplicates = filter_duplicates
+        self.map_qual_threshold = map_qual_threshold
+        self.max_fragment_length = max_fragment_length
+        self.record_alleles = record_alleles
+
+        self.segments = None
+        self.segment_readcount = None
+        if segments is not None:
+            self.segments = segments.sort_values('start')
+            self.segment_readcount = np.zeros(len(segments.index), dtype=int)
+
+        self.haps = None
+        if haps is not None:
+            self.haps = haps[['position', 'allele', 'hap_label', 'allele_id']]
+
+        self.gc_positions = None
+        self.gc_read_count = None
+        if gc_positions is not None:
+            self.gc_positions = np.asarray(gc_positions)
+            self.gc_read_count = np.zeros(self.gc_positions.shape, dtype=int)
+
+        self.length_sum = 0.
+        self.length_sum_sq = 0.
+        self.num_fragments = 0
+
+        self.snp_counts = list()
+        self.allele_counts = list()
+        self.allele_reads = list()
+
+        # Fragments for which allele data may yet be produced
+        self.pending = pd.DataFrame({
+            'fragment_id': np.zeros(0, dtype=np.int32),
+            'start': np.zeros(0, dtype=np.int32),
+            'end': np.zeros(0, dtype=np.int32),
+            'is_counted': np.zeros(0, dtype=bool),
+        }, columns=['fragment_id', 'start', 'end', 'is_counted'])
+        self.complete_position = -1
+
+    def add(self, fragments, alleles):
+        """ Add a chunk of fragment and allele data.
+
+        Args:
+            fragments (pandas.DataFrame): fragment data
+            alleles (pandas.DataFrame): allele data
+
+        """
+
+        fragments = remixt.seqdataio.filter_fragment_data(
+            fragments,
+            filter_duplicates=self.filter_duplicates,
+            map_qual_threshold=self.map_qual_threshold,
+        )
+
+        length = fragments['end'].values - fragments['start'].values
+        self.length_sum += length.sum()
+        self.length_sum_sq += (length * length).sum()
+        self.num_fragments += length.shape[0]
+
+        if self.segments is not None:
+            self.segment_readcount += remixt.segalg.contained_counts(
+                self.segments[['start', 'end']].values,
+                fragments[['start', 'end']].values,
+            )
+
+        if self.gc_positions is not None:
+            self.gc_read_count += remixt.analysis.gcbias.count_position_reads(
+                self.gc_positions, fragments['start'].values)
+
+        self.snp_counts.append(remixt.analysis.haplotype.count_snp_alleles(alleles))
+
+        if self.haps is not None or self.record_alleles:
+            self._add_fragment_alleles(fragments, alleles)
+
+    def _add_fragment_alleles(self, fragments, alleles):
+        fragments = fragments[['fragment_id', 'start', 'end']].copy()
+        fragments['is_counted'] = False
+        pending = pd.concat([self.pending, fragments], ignore_index=True)
+
+        # Read start and end of filtered fragments for each allele
+        if self.record_alleles:
+            self.allele_reads.append(
+                alleles[['fragment_id', 'position', 'is_alt']]
+                .merge(pending[['fragment_id', 'start', 'end']], on='fragment_id'))
+
+        if self.haps is not None:
+
+            # Merge haplotype information into read alleles table, and read start
+            # and end for filtered fragments with no previously counted alleles
+            hap_alleles = alleles.merge(self.haps, left_on=['position', 'is_alt'], right_on=['position', 'allele'], how='inner')
+            hap_alleles = hap_alleles.merge(pending.loc[~pending['is_counted'], ['fragment_id', 'start', 'end']], on='fragment_id')
+
+            # Arbitrarily assign a haplotype/allele label to each read
+            hap_alleles.drop_duplicates('fragment_id', inplace=True)
+            pending.loc[pending['fragment_id'].isin(hap_alleles['fragment_id']), 'is_counted'] = True
+
+            self.allele_counts.append(remixt.analysis.haplotype.count_segment_allele_reads(
+                hap_alleles[['start', 'end', 'hap_label', 'allele_id']], self.segments))
+
+        # Alleles are produced in order of position, allele positions are 1-based
+        # and fragment ends are 0-based exclusive.  Fragments are paired, and
+        # their alleles produced, within a bounded distance of the latest fragment
+        if len(alleles.index) > 0:
+            self.complete_position = max(self.complete_position, alleles['position'].max())
+        if len(fragments.index) > 0:
+            self.complete_position = max(self.complete_position, fragments['start'].max() - 3 * self.max_fragment_length)
+
+        self.pending = pending[pending['end'] > self.complete_position]
+
+    def get_segment_counts(self):
+        """ Segments with an additional 'readcount' column, in their original order.
+        """
+        segments = self.segments.copy()
+        segments['readcount'] = self.segment_readcount
+        return segments.sort_index()
+
+    def get_allele_counts(self, chromosome):
+        """ Read counts for haplotype block alleles within each segment.
+        """
+        return _merge_allele_counts(self.allele_counts, chromosome)
+
+    def get_allele_reads(self):
+        """ Recorded alleles with the start and end of their fragment, in the order read.
+        """
+        return pd.concat([pd.DataFrame(columns=_allele_reads_columns, dtype=np.int32)] + self.allele_reads, ignore_index=True)
+
+    def get_snp_counts(self):
+        """ Reference and alternate read counts for each SNP.
+        """
+        return remixt.analysis.haplotype.merge_snp_counts(self.snp_counts)
+
+    def get_fragment_length_sums(self):
+        """ Sum of lengths, sum of squared lengths, and number of fragments.
+        """
+        return pd.DataFrame({
+            'length_sum': [self.length_sum],
+            'length_sum_sq': [self.length_sum_sq],
+            'num_fragments': [self.num_fragments],
+        }, columns=['length_sum', 'length_sum_sq', 'num_fragments'])
+
+
+_allele_reads_columns = ['fragment_id', 'position', 'is_alt', 'start', 'end']
+
+
+def _merge_allele_counts(allele_counts, chromosome):
+    allele_counts = pd.concat([pd.DataFrame()] + list(allele_counts), ignore_index=True)
+
+    if len(allele_counts.index) == 0:
+        return pd.DataFrame(columns=['chromosome', 'start', 'end', 'hap_label', 'allele_id', 'readcount'])
+
+    allele_counts = (
+        allele_counts
+        .groupby(['start', 'end', 'hap_label', 'allele_id'])['readcount']
+        .sum()
+        .reset_index()
+    )
+
+    allele_counts['chromosome'] = chromosome
+
+    return allele_counts
+
+
+def count_haplotype_allele_reads(allele_reads, haps, segments, chromosome):
+    """ Count reads for haplotype block alleles within segments from recorded alleles
+
+    Args:
+        allele_reads (pandas.DataFrame): alleles recorded by `ChromosomeCounter`
+        haps (pandas.DataFrame): haplotype blocks of the chromosome
+        segments (pandas.DataFrame): segments of the chromosome
+        chromosome (str): chromosome of the alleles
+
+    Returns:
+        pandas.DataFrame: read counts per segment haplotype block allele
+
+    Counts are as for `ChromosomeCounter.get_allele_counts` given the haplotype blocks.
+
+    """
+
+    hap_alleles = allele_reads.merge(
+        haps[['position', 'allele', 'hap_label', 'allele_id']],
+        left_on=['position', 'is_alt'], right_on=['position', 'allele'], how='inner')
+
+    # Arbitrarily assign a haplotype/allele label to each read
+    hap_alleles.drop_duplicates('fragment_id', inplace=True)
+
+    allele_counts = remixt.analysis.haplotype.count_segment_allele_reads(
+        hap_alleles[['start', 'end', 'hap_label', 'allele_id']], segments)
+
+    return _merge_allele_counts([allele_counts], chromosome)
+
+
+def count_bam_snps(snp_counts_filename, bam_filename, chromosome, config, ref_data_dir):
+    """ Count reference and alternate reads for each SNP of a chromosome directly from a bam
+
+    Args:
+        snp_counts_filename (str): output TSV of 'chromosome', 'position', 'ref_count', 'alt_count'
+        bam_filename (str): bam from which to count reads
+        chromosome (str): chromosome for which to count reads
+        config (dict): configuration
+        ref_data_dir (str): reference dataset directory
+
+    """
+
+    counter = ChromosomeCounter()
+
+    for fragments, alleles in read_bam_chunks(bam_filename, chromosome, config, ref_data_dir):
+        counter.add(fragments, alleles)
+
+    snp_counts = counter.get_snp_counts()
+    snp_counts.insert(0, 'chromosome', chromosome)
+    snp_counts.to_csv(snp_counts_filename, sep='\t', index=False)
+
+
+def count_bam_segments(
+    segment_counts_filename,
+    allele_counts_filename,
+    gc_read_counts_filename,
+    fragment_length_sums_filename,
+    bam_filename,
+    segment_filename,
+    haps_filename,
+    gc_positions_filename,
+    chromosome,
+    config,
+    ref_data_dir,
+):
+    """ Count segment, haplotype allele and gc position reads of a chromosome directly from a bam
+
+    Args:
+        segment_counts_filename (str): output segment read counts
+        allele_counts_filename (str): output segment haplotype block allele read counts
+        gc_read_counts_filename (str): output read counts at gc sample positions
+        fragment_length_sums_filename (str): output sufficient statistics of fragment length
+        bam_filename (str): bam from which to count reads
+        segment_filename (str): input segments
+        haps_filename (str): input haplotype blocks
+        gc_positions_filename (str): input gc sample positions
+        chromosome (str): chromosome for which to count reads
+        config (dict): configuration
+        ref_data_dir (str): reference dataset directory
+
+    Segment and allele read counts are as for `remixt.analysis.readcount.segment_readcount`
+    and `remixt.analysis.readcount.haplotype_allele_readcount` restricted to the chromosome.
+
+    """
+
+    segments = pd.read_csv(segment_filename, sep='\t', converters={'chromosome': str})
+    segments = segments[segments['chromosome'] == chromosome]
+
+    haps = pd.read_csv(haps_filename, sep='\t', converters={'chromosome': str})
+    haps = haps[haps['chromosome'] == chromosome]
+
+    gc_positions = pd.read_csv(gc_positions_filename, sep='\t', converters={'chromosome': str})
+    gc_positions = gc_positions[gc_positions['chromosome'] == chromosome]
+
+    counter = ChromosomeCounter(
+        segments=segments,
+        haps=haps,
+        gc_positions=gc_positions['position'].values,
+        filter_duplicates=remixt.config.get_param(config, 'filter_duplicates'),
+        map_qual_threshold=remixt.config.get_param(config, 'map_qual_threshold'),
+        max_fragment_length=remixt.config.get_param(config, 'bam_max_fragment_length'),
+    )
+
+    for fragments, alleles in read_bam_chunks(bam_filename, chromosome, config, ref_data_dir):
+        counter.add(fragments, alleles)
+
+    counter.get_segment_counts().to_csv(segment_counts_filename, sep='\t', index=False)
+    counter.get_allele_counts(chromosome).to_csv(allele_counts_filename, sep='\t', index=False)
+    counter.get_fragment_length_sums().to_csv(fragment_length_sums_filename, sep='\t', index=False)
+
+    gc_positions['read_count'] = counter.gc_read_count
+    gc_positions.to_csv(gc_read_counts_filename, sep='\t', index=False)
+
+
+def count_bam_chromosome(
+    snp_counts_filename,
+    segment_counts_filename,
+    allele_reads_filename,
+    gc_read_counts_filename,
+    fragment_length_sums_filename,
+    bam_filename,
+    segment_filename,
+    gc_positions_filename,
+    chromosome,
+    config,
+    ref_data_dir,
+):
+    """ Count snp, segment and gc position reads, and record alleles, of a chromosome in a single pass of a bam
+
+    Args:
+        snp_counts_filename (str): output TSV of 'chromosome', 'position', 'ref_count', 'alt_count'
+        segment_counts_filename (str): output segment read counts
+        allele_reads_filename (str): output hdf table of alleles with the start and end of their fragment
+        gc_read_counts_filename (str): output read counts at gc sample positions
+        fragment_length_sums_filename (str): output sufficient statistics of fragment length
+        bam_filename (str): bam from which to count reads
+        segment_filename (str): input segments
+        gc_positions_filename (str): input gc sample positions
+        chromosome (str): chromosome for which to count reads
+        config (dict): configuration
+        ref_data_dir (str): reference dataset directory
+
+    For samples from which haplotypes are inferred, allele counts are
+    calculated from the recorded alleles by `count_allele_reads_from_table`
+    once haplotypes are inferred from the snp counts.
+
+    """
+
+    segments = pd.read_csv(segment_filename, sep='\t', converters={'chromosome': str})
+    segments = segments[segments['chromosome'] == chromosome]
+
+    gc_positions = pd.read_csv(gc_positions_filename, sep='\t', converters={'chromosome': str})
+    gc_positions = gc_positions[gc_positions['chromosome'] == chromosome]
+
+    counter = ChromosomeCounter(
+        segments=segments,
+        gc_positions=gc_positions['position'].values,
+        filter_duplicates=remixt.config.get_param(config, 'filter_duplicates'),
+        map_qual_threshold=remixt.config.get_param(config, 'map_qual_threshold'),
+        max_fragment_length=remixt.config.get_param(config, 'bam_max_fragment_length'),
+        record_alleles=True,
+    )
+
+    for fragments, alleles in read_bam_chunks(bam_filename, chromosome, config, ref_data_dir):
+        counter.add(fragments, alleles)
+
+    snp_counts = counter.get_snp_counts()
+    snp_counts.insert(0, 'chromosome', chromosome)
+    snp_counts.to_csv(snp_counts_filename, sep='\t', index=False)
+
+    counter.get_segment_counts().to_csv(segment_counts_filename, sep='\t', index=False)
+    counter.get_fragment_length_sums().to_csv(fragment_length_sums_filename, sep='\t', index=False)
+
+    gc_positions['read_count'] = counter.gc_read_count
+    gc_positions.to_csv(gc_read_counts_filename, sep='\t', index=False)
+
+    counter.get_allele_reads().to_hdf(allele_reads_filename, 'allele_reads', mode='w', complib='zlib', complevel=1)
+
+
+def count_allele_reads_from_table(allele_counts_filename, allele_reads_filename, haps_filename, segment_filename, chromosome):
+    """ Count segment haplotype allele reads of a chromosome from alleles recorded by `count_bam_chromosome`
+
+    Args:
+        allele_counts_filename (str): output segment haplotype block allele read counts
+        allele_reads_filename (str): input alleles with the start and end of their fragment
+        haps_filename (str): input haplotype blocks
+        segment_filename (str): input segments
+        chromosome (str): chromosome for which to count reads
+
+    """
+
+    segments = pd.read_csv(segment_filename, sep='\t', converters={'chromosome': str})
+    segments = segments[segments['chromosome'] == chromosome]
+
+    haps = pd.read_csv(haps_filename, sep='\t', converters={'chromosome': str})
+    haps = haps[haps['chromosome'] == chromosome]
+
+    allele_reads = pd.read_hdf(allele_reads_filename, 'allele_reads')
+
+    allele_counts = count_haplotype_allele_reads(allele_reads, haps, segments, chromosome)
+    allele_counts.to_csv(allele_counts_filename, sep='\t', index=False)
+
+
+def merge_segment_counts(segment_counts_filename, segment_filename, chromosome_segment_counts_filenames):
+    """ Merge per chromosome segment read counts, in the order of the segments file.
+    """
+
+    segments = pd.read_csv(segment_filename, sep='\t', converters={'chromosome': str})
+
+    counts = [pd.read_csv(a, sep='\t', converters={'chromosome': str}) for a in chromosome_segment_counts_filenames.itervalues()]
+    counts = pd.concat(counts, ignore_index=True)
+
+    segments = segments.merge(counts[['chromosome', 'start', 'end', 'readcount']], how='left')
+    segments['readcount'] = segments['readcount'].fillna(0).astype(int)
+
+    segments.to_csv(segment_counts_filename, sep='\t', index=False)
+
+
+def calculate_fragment_stats(fragment_length_sums_filename):
+    """ Calculate fragment length mean and standard deviation from per chromosome sums.
+    """
+
+    sums = pd.read_csv(fragment_length_sums_filename, sep='\t').sum()
+
+    return remixt.analysis.stats.fragment_stats_from_sums(
+        sums['length_sum'], sums['length_sum_sq'], sums['num_fragments'])
+
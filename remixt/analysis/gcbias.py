@@ -12,16 +12,89 @@ import remixt.utils
 def sample_gc(gc_samples_filename, seqdata_filename, fragment_length, config, ref_data_dir):
 
     chromosomes = remixt.config.get_chromosomes(config, ref_data_dir)
-    chromosome_lengths = remixt.config.get_chromosome_lengths(config, ref_data_dir)
-    num_samples = remixt.config.get_param(config, 'sample_gc_num_positions')
-    position_offset = remixt.config.get_param(config, 'gc_position_offset')
-    genome_fasta = remixt.config.get_filename(config, ref_data_dir, 'genome_fasta')
-    mappability_filename = remixt.config.get_filename(config, ref_data_dir, 'mappability')
     filter_duplicates = remixt.config.get_param(config, 'filter_duplicates')
     map_qual_threshold = remixt.config.get_param(config, 'map_qual_threshold')
 
-    fragment_length = int(fragment_length)
-    gc_window = fragment_length - 2 * position_offset
+    samples = sample_positions(config, ref_data_dir)
+
+    # Count number of reads at each position
+    samples['read_count'] = 0
+    for chrom_id in remixt.seqdataio.read_chromosomes(seqdata_filename):
+
+        # Ignore extraneous chromosomes
+        if chrom_id not in chromosomes:
+            continue
+
+        chrom_sample_idx = (samples['chromosome'] == chrom_id).values
+        chrom_sample_pos = samples.loc[chrom_sample_idx, 'position'].values
+
+        reads_iter = remixt.seqdataio.read_fragment_columns(
+            seqdata_filename, chrom_id, ['start'],
+            filter_duplicates=filter_duplicates,
+            map_qual_threshold=map_qual_threshold,
+            chunksize=1000000)
+
+        chrom_read_count = np.zeros(chrom_sample_pos.shape, dtype=int)
+        for chrom_reads in reads_iter:
+            chrom_read_count += count_position_reads(chrom_sample_pos, chrom_reads['start'])
+
+        samples.loc[chrom_sample_idx, 'read_count'] = chrom_read_count
+
+    gc_sample_data = calculate_sample_gc(samples, fragment_length, config, ref_data_dir)
+
+    gc_sample_data.to_csv(gc_samples_filename, sep='\t', header=False, index=False)
+
+
+def sample_gc_positions(positions_filename, config, ref_data_dir):
+    """ Sample random genomic positions at which to count reads for gc bias.
+
+    Args:
+        positions_filename (str): output TSV of sampled 'chromosome', 'position'
+        config (dict): configuration
+        ref_data_dir (str): reference dataset directory
+
+    """
+
+    samples = sample_positions(config, ref_data_dir)
+
+    samples.to_csv(positions_filename, sep='\t', index=False)
+
+
+def sample_gc_from_counts(gc_samples_filename, read_counts_filename, fragment_length, config, ref_data_dir):
+    """ Calculate gc samples from read counts at sampled positions.
+
+    Args:
+        gc_samples_filename (str): output gc samples
+        read_counts_filename (str): TSV of 'chromosome', 'position', 'read_count' of sampled positions
+        fragment_length (int): fragment length used for calculating gc
+        config (dict): configuration
+        ref_data_dir (str): reference dataset directory
+
+    Output is as for `sample_gc`.
+
+    """
+
+    samples = pd.read_csv(read_counts_filename, sep='\t', converters={'chromosome': str})
+
+    gc_sample_data = calculate_sample_gc(samples, fragment_length, config, ref_data_dir)
+
+    gc_sample_data.to_csv(gc_samples_filename, sep='\t', header=False, index=False)
+
+
+def sample_positions(config, ref_data_dir):
+    """ Sample random genomic positions uniformly from the genome.
+
+    Args:
+        config (dict): configuration
+        ref_data_dir (str): reference dataset directory
+
+    Returns:
+        pandas.DataFrame: sampled positions with columns 'chromosome', 'position'
+
+    """
+
+    chromosome_lengths = remixt.config.get_chromosome_lengths(config, ref_data_dir)
+    num_samples = remixt.config.get_param(config, 'sample_gc_num_positions')
 
     chrom_info = pd.DataFrame({'chrom_length':chromosome_lengths})
     chrom_info['chrom_end'] = chrom_info['chrom_length'].cumsum()
@@ -31,9 +104,71 @@ def sample_gc(gc_samples_filename, seqdata_filename, fragment_length, config, re
     genome_length = chrom_info['chrom_length'].sum()
     sample_pos = np.sort(np.random.randint(0, genome_length, num_samples))
 
+    # Calculate position in non-concatenated genome
+    sample_chrom_idx = np.searchsorted(chrom_info['chrom_end'].values, sample_pos, side='right')
+    sample_chrom = chrom_info.index.values[sample_chrom_idx]
+    sample_chrom_pos = sample_pos - chrom_info['chrom_start'].values[sample_chrom_idx]
+
+    return pd.DataFrame({
+        'chromosome':sample_chrom,
+        'position':sample_chrom_pos,
+    }, columns=['chromosome', 'position'])
+
+
+def count_position_reads(positions, read_starts):
+    """ Count reads starting at each of a set of positions.
+
+    Args:
+        positions (numpy.array): positions, possibly repeated
+        read_starts (numpy.array): start of each read
+
+    Returns:
+        numpy.array: number of reads starting at each position
+
+    """
+
+    unique_pos, unique_idx = np.unique(positions, return_inverse=True)
+
+    if len(unique_pos) == 0:
+        return np.zeros(positions.shape, dtype=int)
+
+    idx = np.searchsorted(unique_pos, read_starts)
+    idx[idx == len(unique_pos)] = 0
+    idx = idx[unique_pos[idx] == read_starts]
+
+    return np.bincount(idx, minlength=len(unique_pos))[unique_idx]
+
+
+def calculate_sample_gc(samples, fragment_length, config, ref_data_dir):
+    """ Calculate gc content of fragments starting at sampled positions.
+
+    Args:
+        samples (pandas.DataFrame): sampled positions
+        fragment_length (int): fragment length used for calculating gc
+        config (dict): configuration
+        ref_data_dir (str): reference dataset directory
+
+    Returns:
+        pandas.DataFrame: gc samples
+
+    Input samples should have columns 'chromosome', 'position', 'read_count'.  Output
+    has additional column 'gc_percent', with unmappable positions and positions
+    too close to the end of the chromosome removed.
+
+    """
+
+    chromosomes = remixt.config.get_chromosomes(config, ref_data_dir)
+    position_offset = remixt.config.get_param(config, 'gc_position_offset')
+    genome_fasta = remixt.config.get_filename(config, ref_data_dir, 'genome_fasta')
+    mappability_filename = remixt.config.get_filename(config, ref_data_dir, 'mappability')
+    map_qual_threshold = remixt.config.get_param(config, 'map_qual_threshold')
+
+    fragment_length = int(fragment_length)
+    gc_window = fragment_length - 2 * position_offset
+
     # Calculate GC/mappability for each position
-    sample_gc_count = np.zeros(sample_pos.shape)
-    sample_mappability = np.ones(sample_pos.shape)
+    sample_gc_count = np.zeros(samples.shape[0])
+    sample_mappability = np.ones(samples.shape[0])
     for chrom_id, sequence in remixt.utils.read_sequences(genome_fasta):
 
         # Ignore extraneous chromosomes
@@ -43,9 +178,6 @@ def sample_gc(gc_samples_filename, seqdata_filename, fragment_length, config, re
         # Read indicator of mappability based on threshold
         mappability = read_mappability_indicator(mappability_filename, chrom_id, len(sequence), map_qual_threshold)
 
-        # Start and end of current chromosome in concatenated genome
-        chrom_start, chrom_end = chrom_info.loc[chrom_id, ['chrom_start', 'chrom_end']].values
-
         # Calculate gc count within sliding window
         sequence = np.array(list(sequence.upper()))
         gc = ((sequence == 'G') | (sequence == 'C'))
@@ -56,10 +188,10 @@ def sample_gc(gc_samples_filename, seqdata_filename, fragment_length, config, re
         gc_count = np.concatenate([gc_count, np.ones(fragment_length) * np.nan])
 
         # Calculate filter of positions in this chromosome
-        chrom_sample_idx = (sample_pos >= chrom_start) & (sample_pos < chrom_end)
+        chrom_sample_idx = (samples['chromosome'] == chrom_id).values
 
         # Calculate positions within this chromosome
-        sample_chrom_pos = sample_pos[chrom_sample_idx] - chrom_start
+        sample_chrom_pos = samples.loc[chrom_sample_idx, 'position'].values
 
         # Set the mappability indicator of the start positions of each read
         sample_mappability[chrom_sample_idx] *= mappability[sample_chrom_pos]
@@ -72,53 +204,10 @@ def sample_gc(gc_samples_filename, seqdata_filename, fragment_length, config, re
 
     # Filter unmappable positions and nan gc count values
     sample_filter = ((sample_mappability > 0) & (~np.isnan(sample_gc_count)))
-    sample_pos = sample_pos[sample_filter]
-    sample_gc_count = sample_gc_count[sample_filter]
-
-    sample_gc_percent = sample_gc_count / float(gc_window)
-
-    # Count number of reads at each position
-    sample_read_count = np.zeros(sample_pos.shape, dtype=int)
-    for chrom_id in remixt.seqdataio.read_chromosomes(seqdata_filename):
-
-        # Ignore extraneous chromosomes
-        if chrom_id not in chromosomes:
-            continue
-
-        reads_iter = remixt.seqdataio.read_fragment_data(
-            seqdata_filename, chrom_id,
-            filter_duplicates=filter_duplicates,
-            map_qual_threshold=map_qual_threshold,
-            chunksize=1000000)
-
-        for chrom_reads in reads_iter:
-
-            # Calculate read start in concatenated genome
-            chrom_reads['start'] += chrom_info.loc[chrom_id, 'chrom_start']
-
-            # Add reads at each start
-            sample_read_count += (
-                chrom_reads
-                .groupby('start')['end']
-                .count()
-                .reindex(sample_pos)
-                .fillna(0)
-                .astype(int)
-                .values
-            )
-
-    # Calculate position in non-concatenated genome
-    sample_chrom_idx = np.searchsorted(chrom_info['chrom_end'].values, sample_pos, side='right')
-    sample_chrom = chrom_info.index.values[sample_chrom_idx]
-    sample_chrom_pos = sample_pos - chrom_info['chrom_start'].values[sample_chrom_idx]
 
     # Output chromosome, position, gc percent, read count
-    gc_sample_data = pd.DataFrame({
-        'chromosome':sample_chrom,
-        'position':sample_chrom_pos,
-        'gc_percent':sample_gc_percent,
-        'read_count':sample_read_count,
-    })
+    gc_sample_data = samples[sample_filter].copy()
+    gc_sample_data['gc_percent'] = sample_gc_count[sample_filter] / float(gc_window)
     gc_sample_data = gc_sample_data[[
         'chromosome',
         'position',
@@ -126,7 +215,7 @@ def sample_gc(gc_samples_filename, seqdata_filename, fragment_length, config, re
         'read_count'
     ]]
 
-    gc_sample_data.to_csv(gc_samples_filename, sep='\t', header=False, index=False)
+    return gc_sample_data
 
 
 def gc_lowess(gc_samples_filename, gc_dist_filename, gc_table_filename, gc_resolution=100):
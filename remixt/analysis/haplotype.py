@@ -1,4 +1,5 @@
 import os
+import collections
 import pandas as pd
 import numpy as np
 import scipy
@@ -42,6 +43,61 @@ def infer_snp_genotype(data, base_call_error=0.005, call_threshold=0.9):
     data['BB'] = (data['posterior_BB'] >= call_threshold) * 1
 
 
+def count_snp_alleles(alleles):
+    """ Count reference and alternate reads for each SNP in a table of read alleles
+
+    Args:
+        alleles (pandas.DataFrame): read alleles with columns 'position', 'is_alt'
+
+    Returns:
+        pandas.DataFrame: read counts per SNP
+
+    Returned dataframe has columns 'position', 'ref_count', 'alt_count'
+
+    """
+
+    if len(alleles.index) == 0:
+        return pd.DataFrame(columns=['position', 'ref_count', 'alt_count'], dtype=int)
+
+    snp_counts = (
+        alleles
+        .groupby(['position', 'is_alt'])
+        .size()
+        .unstack(fill_value=0)
+        .reindex(columns=[0, 1])
+        .fillna(0)
+        .astype(int)
+        .rename(columns=lambda a: {0:'ref_count', 1:'alt_count'}[a])
+        .reset_index()
+    )
+
+    return snp_counts
+
+
+def merge_snp_counts(snp_counts):
+    """ Sum SNP read counts calculated for separate chunks of read alleles
+
+    Args:
+        snp_counts (list of pandas.DataFrame): read counts per SNP
+
+    Returns:
+        pandas.DataFrame: read counts per SNP sorted by position
+
+    """
+
+    snp_counts = pd.concat([pd.DataFrame(columns=['position', 'ref_count', 'alt_count'], dtype=int)] + list(snp_counts), ignore_index=True)
+
+    if len(snp_counts.index) == 0:
+        return pd.DataFrame(columns=['position', 'ref_count', 'alt_count']).astype(int)
+
+    # Consolodate positions split by chunking
+    snp_counts = snp_counts.groupby('position').sum().reset_index()
+
+    snp_counts.sort_values('position', inplace=True)
+
+    return snp_counts
+
+
 def read_snp_counts(seqdata_filename, chromosome, num_rows=1000000):
     """ Count reads for each SNP from sequence data
 
@@ -61,36 +117,34 @@ def read_snp_counts(seqdata_filename, chromosome, num_rows=1000000):
 
     snp_counts = list()
     for alleles_chunk in remixt.seqdataio.read_allele_data(seqdata_filename, chromosome, chunksize=num_rows):
+        snp_counts.append(count_snp_alleles(alleles_chunk))
 
-        if len(alleles_chunk.index) == 0:
-            snp_counts.append(pd.DataFrame(columns=['position', 'ref_count', 'alt_count'], dtype=int))
-            continue
+    return merge_snp_counts(snp_counts)
 
-        snp_counts_chunk = (
-            alleles_chunk
-            .groupby(['position', 'is_alt'])
-            .size()
-            .unstack(fill_value=0)
-            .reindex(columns=[0, 1])
-            .fillna(0)
-            .astype(int)
-            .rename(columns=lambda a: {0:'ref_count', 1:'alt_count'}[a])
-            .reset_index()
-        )
 
-        snp_counts.append(snp_counts_chunk)
+def read_chromosome_snp_counts(snp_counts_filename, chromosome, num_rows=1000000):
+    """ Read SNP read counts of a chromosome from a table of SNP read counts
 
-    snp_counts = pd.concat(snp_counts, ignore_index=True)
+    Args:
+        snp_counts_filename (str): snp read counts file
+        chromosome (str): chromosome for which to read counts
 
-    if len(snp_counts.index) == 0:
-        return pd.DataFrame(columns=['position', 'ref_count', 'alt_count']).astype(int)
+    KwArgs:
+        num_rows (int): number of rows per chunk for streaming
 
-    # Consolodate positions split by chunking
-    snp_counts = snp_counts.groupby('position').sum().reset_index()
+    Returns:
+        pandas.DataFrame: read counts per SNP
 
-    snp_counts.sort_values('position', inplace=True)
+    Returned dataframe has columns 'position', 'ref_count', 'alt_count'
 
-    return snp_counts
+    """
+
+    snp_counts = list()
+    for snp_counts_chunk in pd.read_csv(snp_counts_filename, sep='\t', converters={'chromosome': str}, chunksize=num_rows):
+        snp_counts_chunk = snp_counts_chunk[snp_counts_chunk['chromosome'] == chromosome]
+        snp_counts.append(snp_counts_chunk[['position', 'ref_count', 'alt_count']])
+
+    return merge_snp_counts(snp_counts)
 
 
 def infer_snp_genotype_from_normal(snp_genotype_filename, seqdata_filename, chromosome, config):
@@ -111,11 +165,33 @@ def infer_snp_genotype_from_normal(snp_genotype_filename, seqdata_filename, chro
 
     """
 
+    snp_counts_df = read_snp_counts(seqdata_filename, chromosome)
+    _write_snp_genotype_from_normal(snp_genotype_filename, snp_counts_df, config)
+
+
+def infer_snp_genotype_from_normal_counts(snp_genotype_filename, snp_counts_filename, chromosome, config):
+    """ Infer SNP genotype from SNP read counts of a normal sample.
+
+    Args:
+        snp_genotype_filename (str): output snp genotype file
+        snp_counts_filename (str): input snp read counts file
+        chromosome (str): id of chromosome for which haplotype blocks will be inferred
+        config (dict): relavent shapeit parameters including thousand genomes paths
+
+    The input snp counts file has columns 'chromosome', 'position', 'ref_count', 'alt_count',
+    and the output snp genotype file is as for `infer_snp_genotype_from_normal`.
+
+    """
+
+    snp_counts_df = read_chromosome_snp_counts(snp_counts_filename, chromosome)
+    _write_snp_genotype_from_normal(snp_genotype_filename, snp_counts_df, config)
+
+
+def _write_snp_genotype_from_normal(snp_genotype_filename, snp_counts_df, config):
     sequencing_base_call_error = remixt.config.get_param(config, 'sequencing_base_call_error')
     het_snp_call_threshold = remixt.config.get_param(config, 'het_snp_call_threshold')
     
     # Call snps based on reference and alternate read counts from normal
-    snp_counts_df = read_snp_counts(seqdata_filename, chromosome)
     infer_snp_genotype(snp_counts_df, sequencing_base_call_error, het_snp_call_threshold)
     
     snp_counts_df.to_csv(snp_genotype_filename, sep='\t', columns=['position', 'AA', 'AB', 'BB'], index=False)
@@ -139,15 +215,38 @@ def infer_snp_genotype_from_tumour(snp_genotype_filename, seqdata_filenames, chr
 
     """
 
-    sequencing_base_call_error = remixt.config.get_param(config, 'sequencing_base_call_error')
-    homozygous_p_value_threshold = remixt.config.get_param(config, 'homozygous_p_value_threshold')
-    
     # Calculate total reference alternate read counts in all tumours
     snp_counts_df = pd.DataFrame(columns=['position', 'ref_count', 'alt_count']).astype(int)
     for tumour_id, seqdata_filename in seqdata_filenames.iteritems():
         snp_counts_df = pd.concat([snp_counts_df, read_snp_counts(seqdata_filename, chromosome)], ignore_index=True)
         snp_counts_df = snp_counts_df.groupby('position').sum().reset_index()
 
+    _write_snp_genotype_from_tumour(snp_genotype_filename, snp_counts_df, config)
+
+
+def infer_snp_genotype_from_tumour_counts(snp_genotype_filename, snp_counts_filenames, chromosome, config):
+    """ Infer SNP genotype from SNP read counts of tumour samples.
+
+    Args:
+        snp_genotype_filename (str): output snp genotype file
+        snp_counts_filenames (dict): input snp read counts files keyed by tumour id
+        chromosome (str): id of chromosome for which haplotype blocks will be inferred
+        config (dict): relavent shapeit parameters including thousand genomes paths
+
+    The input snp counts files have columns 'chromosome', 'position', 'ref_count', 'alt_count',
+    and the output snp genotype file is as for `infer_snp_genotype_from_tumour`.
+
+    """
+
+    snp_counts = [read_chromosome_snp_counts(a, chromosome) for a in snp_counts_filenames.itervalues()]
+    snp_counts_df = merge_snp_counts(snp_counts)
+    _write_snp_genotype_from_tumour(snp_genotype_filename, snp_counts_df, config)
+
+
+def _write_snp_genotype_from_tumour(snp_genotype_filename, snp_counts_df, config):
+    sequencing_base_call_error = remixt.config.get_param(config, 'sequencing_base_call_error')
+    homozygous_p_value_threshold = remixt.config.get_param(config, 'homozygous_p_value_threshold')
+
     snp_counts_df['total_count'] = snp_counts_df['alt_count'] + snp_counts_df['ref_count']
 
     snp_counts_df = snp_counts_df[snp_counts_df['total_count'] > 50]
@@ -330,7 +429,7 @@ def infer_haps(haps_filename, snp_genotype_filename, chromosome, temp_directory,
     haps.to_csv(haps_filename, sep='\t', index=False)
 
 
-def count_allele_reads(seqdata_filename, haps, chromosome, segments, filter_duplicates=False, map_qual_threshold=1):
+def count_allele_reads(seqdata_filename, haps, chromosome, segments, filter_duplicates=False, map_qual_threshold=1, query_segments=False):
     """ Count reads for each allele of haplotype blocks for a given chromosome
 
     Args:
@@ -342,6 +441,7 @@ def count_allele_reads(seqdata_filename, haps, chromosome, segments, filter_dupl
     KwArgs:
         filter_duplicates (bool): filter reads marked as duplicate
         map_qual_threshold (int): filter reads with less than this mapping quality
+        query_segments (bool): read only fragments and alleles within segments
 
     Input haps should have the following columns:
 
@@ -367,19 +467,34 @@ def count_allele_reads(seqdata_filename, haps, chromosome, segments, filter_dupl
     # Select haps for given chromosome
     haps = haps[haps['chromosome'] == chromosome]
 
-    # Merge haplotype information into read alleles table
+    # Only fragments contained in segments are counted, and allele positions
+    # are 1-based, within 1 of the 0-based exclusive fragment end
+    fragment_regions = None
+    allele_regions = None
+    if query_segments:
+        fragment_regions = segments[['start', 'end']].values
+        allele_regions = fragment_regions + np.array([0, 1])
+
+    # Merge haplotype information into read alleles table, building tables
+    # only for alleles at haplotyped positions
+    hap_positions = np.unique(haps['position'].values)
     alleles = list()
-    for alleles_chunk in remixt.seqdataio.read_allele_data(seqdata_filename, chromosome, chunksize=1000000):
+    for alleles_chunk in remixt.seqdataio.read_seq_data_columns(
+            seqdata_filename, 'alleles', chromosome, ['position', 'fragment_id', 'is_alt'],
+            chunksize=1000000, regions=allele_regions):
+        is_hap = np.in1d(alleles_chunk['position'], hap_positions)
+        alleles_chunk = pd.DataFrame(collections.OrderedDict([(a, b[is_hap]) for a, b in alleles_chunk.iteritems()]))
         alleles_chunk = alleles_chunk.merge(haps, left_on=['position', 'is_alt'], right_on=['position', 'allele'], how='inner')
         alleles.append(alleles_chunk)
     alleles = pd.concat(alleles, ignore_index=True)
 
     # Read fragment data with filtering
-    reads = remixt.seqdataio.read_fragment_data(
-        seqdata_filename, chromosome,
+    reads = pd.concat([pd.DataFrame(a) for a in remixt.seqdataio.read_fragment_columns(
+        seqdata_filename, chromosome, ['fragment_id', 'start', 'end'],
         filter_duplicates=filter_duplicates,
         map_qual_threshold=map_qual_threshold,
-    )
+        regions=fragment_regions,
+    )], ignore_index=True)
 
     # Merge read start and end into read alleles table
     # Note this merge will also remove filtered reads from the allele table
@@ -388,10 +503,36 @@ def count_allele_reads(seqdata_filename, haps, chromosome, segments, filter_dupl
     # Arbitrarily assign a haplotype/allele label to each read
     alleles.drop_duplicates('fragment_id', inplace=True)
 
+    allele_counts = count_segment_allele_reads(alleles, segments)
+
+    # Add chromosome to output
+    allele_counts['chromosome'] = chromosome
+
+    return allele_counts
+
+
+def count_segment_allele_reads(alleles, segments):
+    """ Count reads for each allele of haplotype blocks within segments
+
+    Args:
+        alleles (pandas.DataFrame): haplotype allele of each read
+        segments (pandas.DataFrame): genomic segments of a single chromosome
+
+    Returns:
+        pandas.DataFrame: read counts per segment haplotype block allele
+
+    Input alleles should have one row per read, with columns 'start', 'end', 'hap_label',
+    'allele_id', and input segments should have columns 'start', 'end'.
+
+    The output table has columns 'start', 'end', 'hap_label', 'allele_id', 'readcount'.
+
+    """
+
     # Sort in preparation for search, reindex to allow for subsequent merge
     segments = segments.sort_values('start').reset_index(drop=True)
 
     # Annotate segment for start and end of each read
+    alleles = alleles.copy()
     alleles['segment_idx'] = remixt.segalg.find_contained_segments(
         segments[['start', 'end']].values,
         alleles[['start', 'end']].values,
@@ -401,14 +542,14 @@ def count_allele_reads(seqdata_filename, haps, chromosome, segments, filter_dupl
     alleles = alleles[alleles['segment_idx'] >= 0]
 
     # Drop unecessary columns
-    alleles.drop(['start', 'end'], axis=1, inplace=True)
+    alleles = alleles.drop(['start', 'end'], axis=1)
 
     # Merge segment start end, key for each segment (for given chromosome)
     alleles = alleles.merge(segments[['start', 'end']], left_on='segment_idx', right_index=True)
 
     # Workaround for groupy/size for pandas
     if len(alleles.index) == 0:
-        return pd.DataFrame(columns=['chromosome', 'start', 'end', 'hap_label', 'allele_id', 'readcount'])
+        return pd.DataFrame(columns=['start', 'end', 'hap_label', 'allele_id', 'readcount'])
 
     # Count reads for each allele
     allele_counts = (
@@ -420,13 +561,10 @@ def count_allele_reads(seqdata_filename, haps, chromosome, segments, filter_dupl
         .rename(columns={0:'readcount'})
     )
 
-    # Add chromosome to output
-    allele_counts['chromosome'] = chromosome
-
     return allele_counts
 
 
-def create_allele_counts(segments, seqdata_filename, haps_filename, filter_duplicates=False, map_qual_threshold=1):
+def create_allele_counts(segments, seqdata_filename, haps_filename, filter_duplicates=False, map_qual_threshold=1, cached_segments=None, cached_counts=None):
     """ Create a table of read counts for alleles
 
     Args:
@@ -437,6 +575,8 @@ def create_allele_counts(segments, seqdata_filename, haps_filename, filter_dupli
     KwArgs:
         filter_duplicates (bool): filter reads marked as duplicate
         map_qual_threshold (int): filter reads with less than this mapping quality
+        cached_segments (pandas.DataFrame): segments for which cached_counts were created
+        cached_counts (pandas.DataFrame): previous allele counts from the same seqdata and haps
 
     Input segments should have columns 'chromosome', 'start', 'end'.
 
@@ -449,21 +589,37 @@ def create_allele_counts(segments, seqdata_filename, haps_filename, filter_dupli
         'allele_id': binary indicator of the haplotype allele
         'readcount': number of reads specific to haplotype block allele
 
+    Segments with no allele reads are absent from allele counts, so reusing
+    previous counts requires the segments for which they were created.  Counts
+    for segments in cached_segments are taken from cached_counts, and only the
+    remaining segments are counted from the regions of the seqdata they overlap.
+
     """
 
     # Read haplotype block data
     haps = pd.read_csv(haps_filename, sep='\t', converters={'chromosome':str})
 
+    counts = list()
+
+    if cached_segments is not None:
+        cached_segments = cached_segments[['chromosome', 'start', 'end']].drop_duplicates()
+        is_cached = segments[['chromosome', 'start', 'end']].merge(
+            cached_segments, how='left', indicator=True)['_merge'].values == 'both'
+
+        counts.append(cached_counts.merge(segments.loc[is_cached, ['chromosome', 'start', 'end']]))
+
+        segments = segments[~is_cached]
+
     # Count separately for each chromosome
     gp = segments.groupby('chromosome')
 
     # Table of allele counts, calculated for each group
-    counts = list()
     for chrom, segs in gp:
         counts.append(count_allele_reads(
             seqdata_filename, haps, chrom, segs.copy(),
             filter_duplicates=filter_duplicates,
-            map_qual_threshold=map_qual_threshold))
+            map_qual_threshold=map_qual_threshold,
+            query_segments=cached_segments is not None))
     counts = pd.concat(counts, ignore_index=True)
 
     return counts
@@ -1,5 +1,7 @@
+import os
 import pickle
 import itertools
+import multiprocessing
 import numpy as np
 import pandas as pd
 
@@ -117,14 +119,214 @@ def fit_task(
 ):
     with open(experiment_filename, 'r') as f:
         experiment = pickle.load(f)
-        
-    fit_results = fit(experiment, init_params, config)
+
+    # Resume from the checkpoint of an interrupted fit
+    checkpoint_filename = _get_checkpoint_filename(results_filename, config)
+
+    fit_results = fit(experiment, init_params, config, checkpoint_filename=checkpoint_filename)
     
     with open(results_filename, 'w') as f:
         pickle.dump(fit_results, f)
 
+    if checkpoint_filename is not None and os.path.exists(checkpoint_filename):
+        os.remove(checkpoint_filename)
+
+
+def _get_checkpoint_filename(results_filename, config):
+    if remixt.config.get_param(config, 'fit_checkpoint_interval') is None:
+        return None
+    return results_filename + '.checkpoint'
+
+
+# Experiment of the current local fit, inherited by forked pool processes
+_local_experiment = None
+
+
+def _fit_local_init(args):
+    init_params, config, num_em_iter, state_filename, checkpoint_filename = args
+
+    model, h_init = create_breakpoint_model(_local_experiment, init_params, config)
+
+    # Continue from the state of the previous round, or from the checkpoint
+    # of an interrupted local fit, for which states are removed
+    if os.path.exists(state_filename):
+        model.read_fit_state(h_init, state_filename)
+    elif checkpoint_filename is not None and os.path.exists(checkpoint_filename):
+        model.read_checkpoint(h_init, checkpoint_filename)
+    else:
+        model.create_model(h_init)
+
+    model.checkpoint_filename = checkpoint_filename
+    model.num_em_iter = num_em_iter
+    model.resume_fit()
+
+    model.write_fit_state(state_filename)
+
+    if checkpoint_filename is not None:
+        model.write_checkpoint(checkpoint_filename)
+
+    return create_fit_results(model, _local_experiment, init_params, config)
+
+
+def select_pruned_fits(stats, keep_fraction, config):
+    """ Select initializations to continue fitting based on partial fit statistics.
+
+    Non-divergent solutions are preferred as for store_optimal_solution, then
+    solutions with higher elbo.  Returns the init_ids of the top keep_fraction
+    of solutions, at least one.
+    """
+    max_prop_diverge = remixt.config.get_param(config, 'max_prop_diverge')
+
+    stats = stats.copy()
+    stats['is_divergent'] = stats['proportion_divergent'] >= max_prop_diverge
+    stats.sort_values(['is_divergent', 'elbo'], ascending=[True, False], inplace=True)
+
+    num_keep = max(1, int(np.ceil(keep_fraction * len(stats.index))))
+
+    return list(stats['init_id'].values[:num_keep])
+
+
+def _read_local_fit_rounds(round_filenames):
+    """ Read the last round recorded for each initialization of a local fit.
+    """
+    fit_rounds = dict()
+    for init_id, round_filename in round_filenames.iteritems():
+        if round_filename is not None and os.path.exists(round_filename):
+            with open(round_filename, 'r') as f:
+                fit_rounds[init_id] = pickle.load(f)
+    return fit_rounds
+
+
+def _write_local_fit_round(round_filename, round_idx, truncated):
+    """ Record a completed round of a local fit for an initialization.
+    """
+    if round_filename is None:
+        return
+    with open(round_filename, 'w') as f:
+        pickle.dump({'round_idx': round_idx, 'truncated': truncated}, f)
+
+
+def fit_local(
+    results_filenames,
+    experiment_filename,
+    init_params,
+    config,
+):
+    """ Fit all initializations on a pool of local processes.
+
+    The experiment is unpickled once and shared with the forked pool processes,
+    numpy arrays of the experiment are shared copy on write.  Results of each
+    initialization are written to results_filenames(init_id), as for fit_task.
+
+    Initializations may be pruned by successive halving.  After each number of
+    EM iterations in fit_prune_em_iters, only the top fit_prune_keep_fraction
+    of initializations are fit further, and results of the others are written
+    as truncated.
+
+    With fit_checkpoint_interval set, initializations are checkpointed as for
+    fit_task, also at the end of each round, and the completed rounds of each
+    initialization are recorded.  Checkpoints are kept if the local fit fails.
+    A rerun skips completed rounds, resuming the remaining initializations
+    from their checkpoints, and recreates the results of pruned
+    initializations from their checkpoints at the end of their last round.
+    """
+    global _local_experiment
+
+    num_processes = remixt.config.get_param(config, 'fit_local_num_processes')
+    num_em_iter = remixt.config.get_param(config, 'num_em_iter')
+    prune_em_iters = remixt.config.get_param(config, 'fit_prune_em_iters')
+    prune_keep_fraction = remixt.config.get_param(config, 'fit_prune_keep_fraction')
+
+    with open(experiment_filename, 'r') as f:
+        experiment = pickle.load(f)
+
+    round_em_iters = sorted(set([a for a in prune_em_iters if 0 < a < num_em_iter])) + [num_em_iter]
+
+    state_filenames = dict([(init_id, results_filenames(init_id) + '.state') for init_id in init_params])
+    checkpoint_filenames = dict([(init_id, _get_checkpoint_filename(results_filenames(init_id), config)) for init_id in init_params])
+    round_filenames = dict([(init_id, None if a is None else a + '.round') for init_id, a in checkpoint_filenames.iteritems()])
+
+    fit_init_ids = sorted(init_params.keys())
+    start_round_idx = 0
+
+    # Skip rounds completed by a previous run, pruned initializations remain
+    # at their last round, others continue from the last completed round
+    fit_rounds = _read_local_fit_rounds(round_filenames)
+    if len(fit_rounds) > 0:
+        start_round_idx = max([a['round_idx'] for a in fit_rounds.itervalues()]) + 1
+        fit_init_ids = sorted([init_id for init_id, a in fit_rounds.iteritems()
+            if a['round_idx'] == start_round_idx - 1 and not a['truncated']])
+
+    _local_experiment = experiment
+
+    pool = multiprocessing.Pool(processes=num_processes)
+    try:
+        # Results of initializations pruned by a previous run
+        pruned_init_ids = sorted(set(fit_rounds.keys()).difference(fit_init_ids))
+        pruned_args = [(init_params[init_id], config, round_em_iters[fit_rounds[init_id]['round_idx']], state_filenames[init_id], checkpoint_filenames[init_id]) for init_id in pruned_init_ids]
+        for init_id, fit_results in zip(pruned_init_ids, pool.map(_fit_local_init, pruned_args, chunksize=1)):
+            fit_results['stats']['truncated'] = True
+
+            with open(results_filenames(init_id), 'w') as f:
+                pickle.dump(fit_results, f)
+
+        for round_idx, round_em_iter in enumerate(round_em_iters):
+            if round_idx < start_round_idx:
+                continue
+
+            fit_args = [(init_params[init_id], config, round_em_iter, state_filenames[init_id], checkpoint_filenames[init_id]) for init_id in fit_init_ids]
+            fit_results = dict(zip(fit_init_ids, pool.map(_fit_local_init, fit_args, chunksize=1)))
+
+            keep_init_ids = fit_init_ids
+            if round_idx < len(round_em_iters) - 1:
+                stats = pd.DataFrame([dict(fit_results[init_id]['stats'], init_id=init_id) for init_id in fit_init_ids])
+                keep_init_ids = select_pruned_fits(stats, prune_keep_fraction, config)
+
+            for init_id in fit_init_ids:
+                if init_id in keep_init_ids:
+                    continue
+
+                fit_results[init_id]['stats']['truncated'] = True
+
+                with open(results_filenames(init_id), 'w') as f:
+                    pickle.dump(fit_results[init_id], f)
+
+            if round_idx == len(round_em_iters) - 1:
+                for init_id in fit_init_ids:
+                    with open(results_filenames(init_id), 'w') as f:
+                        pickle.dump(fit_results[init_id], f)
+
+            # The last round is replayed from checkpoints at num_em_iter
+            if round_idx < len(round_em_iters) - 1:
+                for init_id in fit_init_ids:
+                    _write_local_fit_round(round_filenames[init_id], round_idx, init_id not in keep_init_ids)
+
+            fit_init_ids = sorted(keep_init_ids)
 
-def fit(experiment, init_params, config):
+        for filename in checkpoint_filenames.values() + round_filenames.values():
+            if filename is not None and os.path.exists(filename):
+                os.remove(filename)
+
+    finally:
+        pool.terminate()
+        pool.join()
+        _local_experiment = None
+
+        for state_filename in state_filenames.itervalues():
+            if os.path.exists(state_filename):
+                os.remove(state_filename)
+
+
+def fit(experiment, init_params, config, checkpoint_filename=None):
+    model, h_init = create_breakpoint_model(experiment, init_params, config)
+
+    model.checkpoint_filename = checkpoint_filename
+    model.fit(h_init)
+
+    return create_fit_results(model, experiment, init_params, config)
+
+
+def create_breakpoint_model(experiment, init_params, config):
     h_init = np.array([
         init_params['h_normal'],
         init_params['h_tumour'] * init_params['mix_frac'],
@@ -139,9 +341,17 @@ def fit(experiment, init_params, config):
     min_proportion_genotyped = remixt.config.get_param(config, 'likelihood_min_proportion_genotyped')
     num_em_iter = remixt.config.get_param(config, 'num_em_iter')
     num_update_iter = remixt.config.get_param(config, 'num_update_iter')
+    elbo_abs_tol = remixt.config.get_param(config, 'elbo_abs_tol')
+    elbo_rel_tol = remixt.config.get_param(config, 'elbo_rel_tol')
     disable_breakpoints = remixt.config.get_param(config, 'disable_breakpoints')
     is_female = remixt.config.get_param(config, 'is_female')
     do_h_update = remixt.config.get_param(config, 'do_h_update')
+    num_threads = remixt.config.get_param(config, 'fit_num_threads')
+    cn_state_prune_threshold = remixt.config.get_param(config, 'cn_state_prune_threshold')
+    fused_variational_update = remixt.config.get_param(config, 'fused_variational_update')
+    hmm_precision = remixt.config.get_param(config, 'hmm_precision')
+    param_optimize_method = remixt.config.get_param(config, 'param_optimize_method')
+    checkpoint_interval = remixt.config.get_param(config, 'fit_checkpoint_interval')
 
     # For convergence testing purposes, provide optimal initialization
     # based on simulated breakpoint copy number
@@ -183,12 +393,24 @@ def fit(experiment, init_params, config):
         disable_breakpoints=disable_breakpoints,
         breakpoint_init=breakpoint_init,
         do_h_update=do_h_update,
+        num_threads=num_threads,
+        cn_state_prune_threshold=cn_state_prune_threshold,
+        fused_variational_update=fused_variational_update,
+        hmm_precision=hmm_precision,
+        param_optimize_method=param_optimize_method,
     )
     
     model.num_em_iter = num_em_iter
     model.num_update_iter = num_update_iter
-    
-    model.fit(h_init)
+    model.elbo_abs_tol = elbo_abs_tol
+    model.elbo_rel_tol = elbo_rel_tol
+    model.checkpoint_interval = checkpoint_interval
+
+    return model, h_init
+
+
+def create_fit_results(model, experiment, init_params, config):
+    disable_breakpoints = remixt.config.get_param(config, 'disable_breakpoints')
 
     fit_results = dict()
 
@@ -205,12 +427,21 @@ def fit(experiment, init_params, config):
     fit_results['p_outlier_allele'] = model.p_outlier_allele
     fit_results['total_likelihood_mask'] = model.total_likelihood_mask
     fit_results['allele_likelihood_mask'] = model.allele_likelihood_mask
+    fit_results['iter_stats'] = pd.DataFrame(model.iter_stats, columns=[
+        'em_iter', 'num_update_iter', 'elbo', 'elbo_diff', 'update_seconds', 'em_seconds', 'seconds', 'num_param_evals', 'num_candidate_states'])
 
     # Save estimation statistics
     fit_results['stats'] = dict()
     fit_results['stats']['elbo'] = model.prev_elbo
     fit_results['stats']['elbo_diff'] = model.prev_elbo_diff
     fit_results['stats']['error_message'] = ''
+    fit_results['stats']['num_em_iter'] = model.num_em_iter_completed
+    fit_results['stats']['num_update_iter'] = fit_results['iter_stats']['num_update_iter'].sum()
+    fit_results['stats']['num_param_evals'] = model.num_param_evals
+    fit_results['stats']['converged'] = model.converged
+    fit_results['stats']['fit_seconds'] = fit_results['iter_stats']['seconds'].sum()
+    fit_results['stats']['em_iter_seconds'] = fit_results['iter_stats']['seconds'].mean()
+    fit_results['stats']['truncated'] = False
     fit_results['stats'].update(model.get_likelihood_param_values())
 
     ploidy = (cn[:,1:,:].mean(axis=1).T * experiment.l).sum() / experiment.l.sum()
@@ -249,10 +480,17 @@ def store_fit_results(store, experiment, fit_results, key_prefix):
     store[key_prefix + '/mix'] = pd.Series(h / h.sum(), index=xrange(len(h)))
     store[key_prefix + '/brk_cn'] = brk_cn_table
 
+    if 'iter_stats' in fit_results:
+        store[key_prefix + '/iter_stats'] = fit_results['iter_stats']
+
 
 def store_optimal_solution(stats, store, config):
     max_prop_diverge = remixt.config.get_param(config, 'max_prop_diverge')
 
+    # Solutions pruned before completing the fit are not selected
+    if 'truncated' in stats and not stats['truncated'].all():
+        stats = stats[~stats['truncated'].astype(bool)].copy()
+
     if (stats['proportion_divergent'] < max_prop_diverge).any():
         stats = stats[stats['proportion_divergent'] < max_prop_diverge].copy()
     stats.sort_values('elbo', ascending=False, inplace=True)
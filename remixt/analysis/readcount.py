@@ -5,36 +5,49 @@ import remixt.analysis.segment
 import remixt.analysis.haplotype
 
 
-def segment_readcount(segment_counts_filename, segment_filename, seqdata_filename, config):
+def segment_readcount(segment_counts_filename, segment_filename, seqdata_filename, config, cached_segment_counts_filename=None):
 
     segments = pd.read_csv(segment_filename, sep='\t', converters={'chromosome': str})
 
     filter_duplicates = remixt.config.get_param(config, 'filter_duplicates')
     map_qual_threshold = remixt.config.get_param(config, 'map_qual_threshold')
 
+    cached_counts = None
+    if cached_segment_counts_filename is not None:
+        cached_counts = pd.read_csv(cached_segment_counts_filename, sep='\t', converters={'chromosome': str})
+
     segment_counts = remixt.analysis.segment.create_segment_counts(
         segments,
         seqdata_filename,
         filter_duplicates=filter_duplicates,
         map_qual_threshold=map_qual_threshold,
+        cached_counts=cached_counts,
     )
 
     segment_counts.to_csv(segment_counts_filename, sep='\t', index=False)
 
 
-def haplotype_allele_readcount(allele_counts_filename, segment_filename, seqdata_filename, haps_filename, config):
+def haplotype_allele_readcount(allele_counts_filename, segment_filename, seqdata_filename, haps_filename, config, cached_segment_filename=None, cached_allele_counts_filename=None):
     
     segments = pd.read_csv(segment_filename, sep='\t', converters={'chromosome': str})
 
     filter_duplicates = remixt.config.get_param(config, 'filter_duplicates')
     map_qual_threshold = remixt.config.get_param(config, 'map_qual_threshold')
 
+    cached_segments = None
+    cached_counts = None
+    if cached_segment_filename is not None:
+        cached_segments = pd.read_csv(cached_segment_filename, sep='\t', converters={'chromosome': str})
+        cached_counts = pd.read_csv(cached_allele_counts_filename, sep='\t', converters={'chromosome': str})
+
     allele_counts = remixt.analysis.haplotype.create_allele_counts(
         segments,
         seqdata_filename,
         haps_filename,
         filter_duplicates=filter_duplicates,
         map_qual_threshold=map_qual_threshold,
+        cached_segments=cached_segments,
+        cached_counts=cached_counts,
     )
 
     allele_counts.to_csv(allele_counts_filename, sep='\t', index=False)
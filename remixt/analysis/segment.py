@@ -105,7 +105,7 @@ def create_segments(segment_filename, config, ref_data_dir, breakpoint_filename=
     segments.to_csv(segment_filename, sep='\t', index=False, columns=['chromosome', 'start', 'end'])
 
 
-def count_segment_reads(seqdata_filename, chromosome, segments, filter_duplicates=False, map_qual_threshold=1):
+def count_segment_reads(seqdata_filename, chromosome, segments, filter_duplicates=False, map_qual_threshold=1, chunksize=10000000, query_segments=False):
     """ Count reads falling entirely within segments on a specific chromosome
 
     Args:
@@ -116,6 +116,8 @@ def count_segment_reads(seqdata_filename, chromosome, segments, filter_duplicate
     KwArgs:
         filter_duplicates (bool): filter reads marked as duplicate
         map_qual_threshold (int): filter reads with less than this mapping quality
+        chunksize (int): number of fragments to count at a time
+        query_segments (bool): read only fragments starting within segments
 
     Returns:
         pandas.DataFrame: output segment data
@@ -125,24 +127,39 @@ def count_segment_reads(seqdata_filename, chromosome, segments, filter_duplicate
     The output segment counts will be in TSV format with an additional 'readcount' column
     for the number of counts per segment.
 
-    """
+    Fragments are streamed in chunks, and counts summed across chunks, such that
+    memory is bounded by the chunk size rather than the number of fragments.
+    Only the fragment start and end columns are read, without copying for
+    unfiltered columnar seqdata.
+    Querying segments reads only the blocks of sorted seqdata overlapping the
+    segments, and is preferable when counting a small number of segments.
 
-    # Read fragment data with filtering
-    reads = remixt.seqdataio.read_fragment_data(
-        seqdata_filename, chromosome,
-        filter_duplicates=filter_duplicates,
-        map_qual_threshold=map_qual_threshold,
-    )
+    """
 
     # Sort in preparation for search
-    reads.sort_values('start', inplace=True)
     segments.sort_values('start', inplace=True)
-    
-    # Count segment reads
-    segments['readcount'] = remixt.segalg.contained_counts(
-        segments[['start', 'end']].values,
-        reads[['start', 'end']].values
-    )
+
+    segments['readcount'] = 0
+
+    regions = None
+    if query_segments:
+        regions = segments[['start', 'end']].values
+
+    # Read start and end columns of fragment data with filtering
+    for reads in remixt.seqdataio.read_fragment_columns(
+            seqdata_filename, chromosome, ['start', 'end'],
+            filter_duplicates=filter_duplicates,
+            map_qual_threshold=map_qual_threshold,
+            chunksize=chunksize,
+            regions=regions,
+        ):
+
+        # Count segment reads, containment does not require sorted reads
+        segments['readcount'] += remixt.segalg.contained_interval_counts(
+            segments[['start', 'end']].values,
+            reads['start'],
+            reads['end'],
+        )
 
     # Sort on index to return dataframe in original order
     segments.sort_index(inplace=True)
@@ -150,7 +167,7 @@ def count_segment_reads(seqdata_filename, chromosome, segments, filter_duplicate
     return segments
 
 
-def create_segment_counts(segments, seqdata_filename, filter_duplicates=False, map_qual_threshold=1):
+def create_segment_counts(segments, seqdata_filename, filter_duplicates=False, map_qual_threshold=1, chunksize=10000000, cached_counts=None):
     """ Create a table of read counts for segments
 
     Args:
@@ -160,6 +177,8 @@ def create_segment_counts(segments, seqdata_filename, filter_duplicates=False, m
     KwArgs:
         filter_duplicates (bool): filter reads marked as duplicate
         map_qual_threshold (int): filter reads with less than this mapping quality
+        chunksize (int): number of fragments to count at a time
+        cached_counts (pandas.DataFrame): previous segment counts from the same seqdata
 
     Returns:
         pandas.DataFrame: output segment data
@@ -169,19 +188,36 @@ def create_segment_counts(segments, seqdata_filename, filter_duplicates=False, m
     The output segment counts will be in TSV format with an additional 'readcount' column
     for the number of counts per segment.
 
+    Counts for segments in cached_counts, as output by a previous call with the
+    same seqdata and filters, are reused, and only the remaining segments are
+    counted from the regions of the seqdata they overlap.
+
     """
 
+    # Table of read counts, reused from cached counts or calculated for each group
+    counts = list()
+
+    if cached_counts is not None:
+        segments = segments.copy()
+        segments['readcount'] = segments[['chromosome', 'start', 'end']].merge(
+            cached_counts[['chromosome', 'start', 'end', 'readcount']].drop_duplicates(['chromosome', 'start', 'end']),
+            how='left')['readcount'].values
+        is_cached = segments['readcount'].notnull()
+        counts.append(segments[is_cached])
+        segments = segments[~is_cached].drop('readcount', axis=1)
+
     # Count separately for each chromosome, ensuring order is preserved for groups
     gp = segments.groupby('chromosome')
 
-    # Table of read counts, calculated for each group
-    counts = list()
     for chrom, segs in gp:
         counts.append(count_segment_reads(
             seqdata_filename, chrom, segs.copy(),
             filter_duplicates=filter_duplicates,
-            map_qual_threshold=map_qual_threshold))
+            map_qual_threshold=map_qual_threshold,
+            chunksize=chunksize,
+            query_segments=cached_counts is not None))
     counts = pd.concat(counts)
+    counts['readcount'] = counts['readcount'].astype(int)
 
     # Sort on index to return dataframe in original order
     counts.sort_index(inplace=True)
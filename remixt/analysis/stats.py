@@ -36,6 +36,15 @@ def calculate_fragment_stats(seqdata_filename, config):
             sum_x2 += (length * length).sum()
             n += length.shape[0]
 
+    return fragment_stats_from_sums(sum_x, sum_x2, n)
+
+
+def fragment_stats_from_sums(sum_x, sum_x2, n):
+    """ Fragment length mean and standard deviation from sum, sum of squares and count.
+    """
+
+    n = float(n)
+
     mean = sum_x / n
     stdev = np.sqrt((sum_x2 / n) - (mean * mean))
 
@@ -7,6 +7,7 @@ cimport numpy as np
 from libcpp.string cimport string
 from libcpp cimport bool
 from libcpp.vector cimport vector
+from cpython cimport Py_buffer
 
 cdef extern from "BamAlleleReader.h":
     cdef cppclass FragmentData:
@@ -25,23 +26,34 @@ cdef extern from "BamAlleleReader.h":
             string chromosome,
             int maxFragmentLength,
             int maxSoftClipped,
-            bool checkProperPair) except +
-        bool ReadAlignments(int maxAlignments) except +
+            bool checkProperPair,
+            int regionStart,
+            int regionEnd,
+            bool hashMateIndex) except +
+        bool ReadAlignments(int maxAlignments) nogil except +
         vector[FragmentData] mFragmentData
         vector[AlleleData] mAlleleData
 
+fragment_columns = [
+    'fragment_id',
+    'start',
+    'end',
+    'mapping_quality',
+    'is_duplicate',
+]
+
+allele_columns = [
+    'fragment_id',
+    'position',
+    'is_alt',
+]
+
 def create_fragment_table(nrows):
     return pd.DataFrame(
         data=0,
         index=xrange(nrows),
         dtype=np.int32,
-        columns=[
-            'fragment_id',
-            'start',
-            'end',
-            'mapping_quality',
-            'is_duplicate',
-        ],
+        columns=fragment_columns,
     )
 
 def create_allele_table(nrows):
@@ -49,45 +61,88 @@ def create_allele_table(nrows):
         data=0,
         index=xrange(nrows),
         dtype=np.int32,
-        columns=[
-            'fragment_id',
-            'position',
-            'is_alt',
-        ],
+        columns=allele_columns,
     )
 
 cdef class AlleleReader:
     cdef CAlleleReader *thisptr
-    def __cinit__(self, bam_filename, snp_filename, chromosome, max_fragment_length, max_soft_clipped, check_proper_pair):
-        self.thisptr = new CAlleleReader(bam_filename, snp_filename, chromosome, max_fragment_length, max_soft_clipped, check_proper_pair)
+    def __cinit__(self, bam_filename, snp_filename, chromosome, max_fragment_length, max_soft_clipped, check_proper_pair, region_start=0, region_end=-1, hash_mate_index=True):
+        self.thisptr = new CAlleleReader(bam_filename, snp_filename, chromosome, max_fragment_length, max_soft_clipped, check_proper_pair, region_start, region_end, hash_mate_index)
     def __dealloc__(self):
         del self.thisptr
-    def ReadAlignments(self, max_alignments):
-        return self.thisptr.ReadAlignments(max_alignments)
+    def ReadAlignments(self, int max_alignments):
+        cdef bool result
+        with nogil:
+            result = self.thisptr.ReadAlignments(max_alignments)
+        return result
+    def GetFragmentArray(self):
+        """ Fragments from the last call to ReadAlignments as an (n, 5) int32 array.
+
+        The array takes ownership of the fragment buffer without copying.
+        """
+        cdef _FragmentBuffer buffer = _FragmentBuffer()
+        buffer.data.swap(self.thisptr.mFragmentData)
+        return np.asarray(buffer)
+    def GetAlleleArray(self):
+        """ Alleles from the last call to ReadAlignments as an (n, 3) int32 array.
+
+        The array takes ownership of the allele buffer without copying.
+        """
+        cdef _AlleleBuffer buffer = _AlleleBuffer()
+        buffer.data.swap(self.thisptr.mAlleleData)
+        return np.asarray(buffer)
     def GetFragmentTable(self):
-        data = create_fragment_table(self.thisptr.mFragmentData.size())
-        cdef np.ndarray fragmentID = data['fragment_id'].values
-        cdef np.ndarray fragmentStart = data['start'].values
-        cdef np.ndarray fragmentEnd = data['end'].values
-        cdef np.ndarray mappingQuality = data['mapping_quality'].values
-        cdef np.ndarray isDuplicate = data['is_duplicate'].values
-        cdef int idx
-        for idx in range(self.thisptr.mFragmentData.size()):
-            fragmentID[idx] = self.thisptr.mFragmentData[idx].fragmentID
-            fragmentStart[idx] = self.thisptr.mFragmentData[idx].fragmentStart
-            fragmentEnd[idx] = self.thisptr.mFragmentData[idx].fragmentEnd
-            mappingQuality[idx] = self.thisptr.mFragmentData[idx].mappingQuality
-            isDuplicate[idx] = self.thisptr.mFragmentData[idx].isDuplicate
-        return data
+        return pd.DataFrame(self.GetFragmentArray(), columns=fragment_columns)
     def GetAlleleTable(self):
-        data = create_allele_table(self.thisptr.mAlleleData.size())
-        cdef np.ndarray fragmentID = data['fragment_id'].values
-        cdef np.ndarray position = data['position'].values
-        cdef np.ndarray isAlt = data['is_alt'].values
-        cdef int idx
-        for idx in range(self.thisptr.mAlleleData.size()):
-            fragmentID[idx] = self.thisptr.mAlleleData[idx].fragmentID
-            position[idx] = self.thisptr.mAlleleData[idx].position
-            isAlt[idx] = self.thisptr.mAlleleData[idx].isAlt
-        return data
+        return pd.DataFrame(self.GetAlleleArray(), columns=allele_columns)
+
+cdef _fill_buffer(Py_buffer *buffer, object obj, void *data, Py_ssize_t *shape, Py_ssize_t *strides):
+    buffer.buf = data
+    buffer.format = 'i'
+    buffer.internal = NULL
+    buffer.itemsize = sizeof(int)
+    buffer.len = shape[0] * shape[1] * sizeof(int)
+    buffer.ndim = 2
+    buffer.obj = obj
+    buffer.readonly = 0
+    buffer.shape = shape
+    buffer.strides = strides
+    buffer.suboffsets = NULL
+
+# Buffers exposing records of int fields as rows of a 2d array, taking
+# ownership of the vector by swapping, such that the array shares memory
+# with the vector and holds a reference to the buffer object
+
+cdef class _FragmentBuffer:
+    cdef vector[FragmentData] data
+    cdef Py_ssize_t shape[2]
+    cdef Py_ssize_t strides[2]
+    cdef int empty[1]
+    def __getbuffer__(self, Py_buffer *buffer, int flags):
+        cdef void *data = <void*>self.empty
+        if not self.data.empty():
+            data = <void*>&self.data[0]
+        self.shape[0] = self.data.size()
+        self.shape[1] = sizeof(FragmentData) / sizeof(int)
+        self.strides[0] = sizeof(FragmentData)
+        self.strides[1] = sizeof(int)
+        _fill_buffer(buffer, self, data, self.shape, self.strides)
+    def __releasebuffer__(self, Py_buffer *buffer):
+        pass
 
+cdef class _AlleleBuffer:
+    cdef vector[AlleleData] data
+    cdef Py_ssize_t shape[2]
+    cdef Py_ssize_t strides[2]
+    cdef int empty[1]
+    def __getbuffer__(self, Py_buffer *buffer, int flags):
+        cdef void *data = <void*>self.empty
+        if not self.data.empty():
+            data = <void*>&self.data[0]
+        self.shape[0] = self.data.size()
+        self.shape[1] = sizeof(AlleleData) / sizeof(int)
+        self.strides[0] = sizeof(AlleleData)
+        self.strides[1] = sizeof(int)
+        _fill_buffer(buffer, self, data, self.shape, self.strides)
+    def __releasebuffer__(self, Py_buffer *buffer):
+        pass
@@ -3,20 +3,27 @@
 # cython: boundscheck=False
 # cython: wraparound=False
 # cython: cdivision=True
-from libc.math cimport exp, log, fabs, lgamma, isnan
+from libc.math cimport exp, log, fabs, lgamma, isnan, NAN
 import numpy as np
 import scipy
 import itertools
 cimport numpy as np
 cimport cython
+from cython.parallel cimport prange, threadid
 
 np.import_array()
 
 cdef np.float64_t _NINF = -np.inf
 cdef np.float64_t _PI = np.pi
 
+# Storage precision of transition matrices and joint posterior marginals
+ctypedef fused transmat_t:
+    np.float32_t
+    np.float64_t
 
-cdef np.float64_t _max(np.float64_t[:] values):
+
+cdef np.float64_t _max(np.float64_t[:] values) nogil:
+    cdef int i
     cdef np.float64_t vmax = _NINF
     for i in range(values.shape[0]):
         if values[i] > vmax:
@@ -24,7 +31,8 @@ cdef np.float64_t _max(np.float64_t[:] values):
     return vmax
 
 
-cdef np.float64_t _max2(np.float64_t[:, :] values):
+cdef np.float64_t _max2(np.float64_t[:, :] values) nogil:
+    cdef int i, j
     cdef np.float64_t vmax = _NINF
     for i in range(values.shape[0]):
         for j in range(values.shape[1]):
@@ -43,7 +51,8 @@ cdef np.float64_t _max3(np.float64_t[:, :, :] values):
     return vmax
 
 
-cdef int _argmax(np.float64_t[:] values):
+cdef int _argmax(np.float64_t[:] values) nogil:
+    cdef int i
     cdef np.float64_t vmax = _NINF
     cdef int imax = 0
     for i in range(values.shape[0]):
@@ -65,7 +74,8 @@ cdef void _argmax2(np.float64_t[:, :] values, np.int64_t[:] indices):
                 indices[1] = j
 
 
-cdef np.float64_t _logsum(np.float64_t[:] X):
+cdef np.float64_t _logsum(np.float64_t[:] X) nogil:
+    cdef int i
     cdef np.float64_t vmax = _max(X)
     cdef np.float64_t power_sum = 0
 
@@ -75,7 +85,8 @@ cdef np.float64_t _logsum(np.float64_t[:] X):
     return log(power_sum) + vmax
 
 
-cdef np.float64_t _logsum2(np.float64_t[:, :] X):
+cdef np.float64_t _logsum2(np.float64_t[:, :] X) nogil:
+    cdef int i, j
     cdef np.float64_t vmax = _max2(X)
     cdef np.float64_t power_sum = 0
 
@@ -108,7 +119,8 @@ cdef np.float64_t _entropy(np.float64_t[:] X):
     return entropy
 
 
-cdef np.float64_t _exp_normalize(np.float64_t[:] Y, np.float64_t[:] X):
+cdef np.float64_t _exp_normalize(np.float64_t[:] Y, np.float64_t[:] X) nogil:
+    cdef int i
     cdef np.float64_t normalize = _logsum(X)
     for i in range(X.shape[0]):
         Y[i] = exp(X[i] - normalize)
@@ -119,7 +131,8 @@ cdef np.float64_t _exp_normalize(np.float64_t[:] Y, np.float64_t[:] X):
         Y[i] /= normalize
 
 
-cdef np.float64_t _exp_normalize2(np.float64_t[:, :] Y, np.float64_t[:, :] X):
+cdef np.float64_t _exp_normalize2(np.float64_t[:, :] Y, np.float64_t[:, :] X) nogil:
+    cdef int i, j
     cdef np.float64_t normalize = _logsum2(X)
     for i in range(X.shape[0]):
         for j in range(X.shape[1]):
@@ -133,6 +146,16 @@ cdef np.float64_t _exp_normalize2(np.float64_t[:, :] Y, np.float64_t[:, :] X):
             Y[i, j] /= normalize
 
 
+cdef inline void _exp_normalize_row(np.float64_t[:, :] Y, int n, np.float64_t x_0, np.float64_t x_1) nogil:
+    cdef np.float64_t vmax = x_0 if x_0 > x_1 else x_1
+    cdef np.float64_t normalize = log(exp(x_0 - vmax) + exp(x_1 - vmax)) + vmax
+    Y[n, 0] = exp(x_0 - normalize)
+    Y[n, 1] = exp(x_1 - normalize)
+    normalize = Y[n, 0] + Y[n, 1]
+    Y[n, 0] /= normalize
+    Y[n, 1] /= normalize
+
+
 cdef np.float64_t _exp_normalize3(np.float64_t[:, :, :] Y, np.float64_t[:, :, :] X):
     cdef np.float64_t normalize = _logsum3(X)
     for i in range(X.shape[0]):
@@ -247,21 +270,28 @@ cdef np.float64_t negbin_log_likelihood(np.float64_t x, np.float64_t mu, np.floa
         log(G(x+r)) - log(G(x+1)) - log(G(r)) + x * log(p) + r * log(1 - p)
     """
 
-    cdef np.float64_t nb_p, ll
+    cdef np.float64_t ll = _negbin_log_likelihood(x, mu, r)
+
+    if isnan(ll):
+        raise ValueError('ll is nan for x: {}, mu: {}, r: {}'.format(x, mu, r))
+
+    return ll
+
+
+cdef np.float64_t _negbin_log_likelihood(np.float64_t x, np.float64_t mu, np.float64_t r) nogil:
+    """ Negative binomial read count log likelihood, nan if undefined.
+    """
+
+    cdef np.float64_t nb_p
 
     nb_p = mu / (r + mu)
 
     if nb_p < 0. or nb_p > 1.:
         nb_p = 0.5
 
-    ll = (lgamma(x + r) - lgamma(x + 1) - lgamma(r)
+    return (lgamma(x + r) - lgamma(x + 1) - lgamma(r)
         + x * log(nb_p) + r * log(1 - nb_p))
 
-    if isnan(ll):
-        raise ValueError('ll is nan for x: {}, mu: {}, r: {}'.format(x, mu, r))
-
-    return ll
-
 
 cdef np.float64_t negbin_log_likelihood_partial_mu(np.float64_t x, np.float64_t mu, np.float64_t r) except *:
     """ Calculate the partial derivative of the negative binomial read count
@@ -292,6 +322,35 @@ cdef np.float64_t negbin_log_likelihood_partial_mu(np.float64_t x, np.float64_t
     return partial_mu
 
 
+cdef np.float64_t negbin_log_likelihood_partial_r(np.float64_t x, np.float64_t mu, np.float64_t r) except *:
+    """ Calculate the partial derivative of the negative binomial read count
+    log likelihood with respect to r
+
+    Args:
+        x (float): observed read counts
+        mu (float): expected read counts
+        r (float): over-dispersion
+    
+    Returns:
+        float: log likelihood derivative per segment
+        
+    The partial derivative of the log pmf of the negative binomial with 
+    respect to r is:
+    
+        digamma(x + r) - digamma(r) + log(r / (r + mu)) + (mu - x) / (r + mu)
+
+    """
+
+    cdef np.float64_t partial_r
+
+    partial_r = digamma(x + r) - digamma(r) + log(r / (r + mu)) + (mu - x) / (r + mu)
+
+    if isnan(partial_r):
+        raise ValueError('partial_r is nan for x: {}, mu: {}, r: {}'.format(x, mu, r))
+
+    return partial_r
+
+
 cdef np.float64_t betabin_log_likelihood(np.float64_t k, np.float64_t n, np.float64_t p, np.float64_t M) except *:
     """ Calculate beta binomial allele count log likelihood.
     
@@ -326,11 +385,7 @@ cdef np.float64_t betabin_log_likelihood(np.float64_t k, np.float64_t n, np.floa
     if p <= 0. or (1 - p) <= 0.:
         raise ValueError('p <= 0 or (1 - p) <= 0. for p: {}'.format(p))
 
-    ll = (lgamma(n+1) - lgamma(k+1) - lgamma(n-k+1)
-        + lgamma(k + M * p) + lgamma(n - k + M * (1 - p))
-        - lgamma(n + M)
-        - lgamma(M * p) - lgamma(M * (1 - p))
-        + lgamma(M))
+    ll = _betabin_log_likelihood(k, n, p, M)
 
     if isnan(ll):
         raise ValueError('ll is nan for k: {}, n: {}, p: {}, M: {}'.format(k, n, p, M))
@@ -338,6 +393,20 @@ cdef np.float64_t betabin_log_likelihood(np.float64_t k, np.float64_t n, np.floa
     return ll
 
 
+cdef np.float64_t _betabin_log_likelihood(np.float64_t k, np.float64_t n, np.float64_t p, np.float64_t M) nogil:
+    """ Beta binomial allele count log likelihood, nan if undefined.
+    """
+
+    if p <= 0. or (1 - p) <= 0.:
+        return NAN
+
+    return (lgamma(n+1) - lgamma(k+1) - lgamma(n-k+1)
+        + lgamma(k + M * p) + lgamma(n - k + M * (1 - p))
+        - lgamma(n + M)
+        - lgamma(M * p) - lgamma(M * (1 - p))
+        + lgamma(M))
+
+
 cdef np.float64_t betabin_log_likelihood_partial_p(np.float64_t k, np.float64_t n, np.float64_t p, np.float64_t M) except *:
     """ Calculate the partial derivative of the beta binomial allele count
     log likelihood with respect to p
@@ -385,6 +454,49 @@ cdef np.float64_t betabin_log_likelihood_partial_p(np.float64_t k, np.float64_t
     return partial_p
 
 
+cdef np.float64_t betabin_log_likelihood_partial_M(np.float64_t k, np.float64_t n, np.float64_t p, np.float64_t M) except *:
+    """ Calculate the partial derivative of the beta binomial allele count
+    log likelihood with respect to M
+
+    Args:
+        k (float): observed minor allelic read counts
+        n (float): observed total allelic read counts
+        p (float): expected minor allele fraction
+        M (float): over-dispersion
+    
+    Returns:
+        float: log likelihood derivative per segment
+
+    The partial derivative of the log pmf of the beta binomial with 
+    respect to M is:
+
+        p * digamma(k + M * p)
+            + (1 - p) * digamma(n - k + M * (1 - p))
+            - digamma(n + M)
+            - p * digamma(M * p)
+            - (1 - p) * digamma(M * (1 - p))
+            + digamma(M)
+
+    """
+
+    cdef np.float64_t partial_M
+
+    if p <= 0. or (1 - p) <= 0.:
+        raise ValueError('p <= 0 or (1 - p) <= 0. for p: {}'.format(p))
+
+    partial_M = (p * digamma(k + M * p)
+        + (1 - p) * digamma(n - k + M * (1 - p))
+        - digamma(n + M)
+        - p * digamma(M * p)
+        - (1 - p) * digamma(M * (1 - p))
+        + digamma(M))
+
+    if isnan(partial_M):
+        raise ValueError('partial_M is nan for k: {}, n: {}, p: {}, M: {}'.format(k, n, p, M))
+
+    return partial_M
+
+
 cdef class RemixtModel:
     cdef public int num_clones
     cdef public int num_segments
@@ -393,6 +505,10 @@ cdef class RemixtModel:
     cdef public int cn_max
     cdef public bint normal_contamination
     cdef public int num_cn_states
+    # State tables are stored per state class, such as autosomes and haploid
+    # chromosomes, indexed by the state class of each segment
+    cdef public int num_state_classes
+    cdef public np.int64_t[:] state_class
     cdef public np.int64_t[:, :, :, :] cn_states
     cdef public np.int64_t[:, :, :] cn_states_total
     cdef public int num_brk_states
@@ -412,10 +528,18 @@ cdef class RemixtModel:
 
     cdef public np.float64_t hmm_log_norm_const
     cdef public np.float64_t[:, :] framelogprob
-    cdef public np.float64_t[:, :, :] log_transmat
-    cdef public np.float64_t[:, :, :] cached_log_transmat
+    cdef public int num_transmats
+    cdef public np.int64_t[:] transmat_idx
+    cdef public np.int64_t[:] transmat_adjacency
+    cdef public np.ndarray log_transmat
+    cdef public np.ndarray cached_log_transmat
     cdef public np.float64_t[:, :] posterior_marginals
-    cdef public np.float64_t[:, :, :] joint_posterior_marginals
+    cdef public np.ndarray joint_posterior_marginals
+    cdef int _hmm_precision
+    cdef public int num_shared_transmats
+    cdef public np.int64_t[:] chain_start
+    cdef public np.int64_t[:] state_offsets
+    cdef public np.int64_t[:] state_idx
 
     cdef public np.float64_t[:, :] p_allele_swap
     cdef public np.float64_t[:, :] p_outlier_total
@@ -425,36 +549,62 @@ cdef class RemixtModel:
     cdef public np.float64_t prior_outlier_allele
 
     cdef public np.float64_t[:] l
-    cdef public np.float64_t[:] x
-    cdef public np.float64_t[:, :] y
-    cdef public np.int64_t[:] total_likelihood_mask
-    cdef public np.int64_t[:] allele_likelihood_mask
-
-    cdef public np.float64_t[:] h
-
-    cdef public np.float64_t negbin_r_0
-    cdef public np.float64_t negbin_r_1
-    cdef public np.float64_t negbin_hdel_mu
-    cdef public np.float64_t negbin_hdel_r_0
-    cdef public np.float64_t negbin_hdel_r_1
-
-    cdef public np.float64_t betabin_M_0
-    cdef public np.float64_t betabin_M_1
-    cdef public np.float64_t betabin_loh_p
-    cdef public np.float64_t betabin_loh_M_0
-    cdef public np.float64_t betabin_loh_M_1
+    cdef np.float64_t[:] _x
+    cdef np.float64_t[:, :] _y
+    cdef np.int64_t[:] _total_likelihood_mask
+    cdef np.int64_t[:] _allele_likelihood_mask
+
+    cdef np.float64_t[:] _h
+
+    cdef np.float64_t _negbin_r_0
+    cdef np.float64_t _negbin_r_1
+    cdef np.float64_t _negbin_hdel_mu
+    cdef np.float64_t _negbin_hdel_r_0
+    cdef np.float64_t _negbin_hdel_r_1
+
+    cdef np.float64_t _betabin_M_0
+    cdef np.float64_t _betabin_M_1
+    cdef np.float64_t _betabin_loh_p
+    cdef np.float64_t _betabin_loh_M_0
+    cdef np.float64_t _betabin_loh_M_1
+
+    # Log likelihood of each segment and state, for each total outlier
+    # indicator, and each allele outlier and allele swap indicator
+    cdef public np.float64_t[:, :, :] log_likelihood_total
+    cdef public np.float64_t[:, :, :, :] log_likelihood_allele
+    cdef bint _likelihood_valid
+
+    cdef np.float64_t _energy_prior
+    cdef np.float64_t _energy_total
+    cdef np.float64_t _energy_allele
+    cdef np.float64_t _energy_transition
+    cdef np.float64_t _entropy_hmm
+    cdef bint _energy_prior_valid
+    cdef bint _energy_total_valid
+    cdef bint _energy_allele_valid
+    cdef bint _energy_transition_valid
+    cdef bint _entropy_hmm_valid
 
     cdef public int transition_model
+    cdef public int sum_product_engine
+    cdef public int num_threads
 
     cdef np.float64_t[:] _p_d
     cdef np.float64_t[:] _allele_cn_change
 
+    cdef public np.float64_t sample_min_posterior
+    cdef np.int64_t[:] _sample_segment
+    cdef np.int64_t[:] _sample_state
+    cdef np.float64_t[:, :] _sample_weight_total
+    cdef np.float64_t[:, :, :] _sample_weight_allele
+
     def __cinit__(self,
         int num_clones,
         int num_segments,
         int num_breakpoints,
         bint normal_contamination,
         np.ndarray[np.int64_t, ndim=4] cn_states,
+        np.ndarray[np.int64_t, ndim=1] state_class,
         np.ndarray[np.int64_t, ndim=2] brk_states,
         np.ndarray[np.float64_t, ndim=1] h_init,
         np.ndarray[np.float64_t, ndim=1] l,
@@ -471,35 +621,43 @@ cdef class RemixtModel:
         self.num_breakpoints = num_breakpoints
         self.normal_contamination = normal_contamination
         self.cn_states = cn_states
+        self.state_class = state_class
         self.brk_states = brk_states
-        self.h = h_init
+        self._h = h_init
         self.l = l
-        self.x = x
-        self.y = y
+        self._x = x
+        self._y = y
         self.num_alleles = 2
         self.cn_max = max(cn_states.max(), brk_states.max())
+        self.num_state_classes = self.cn_states.shape[0]
         self.num_cn_states = self.cn_states.shape[1]
         self.num_brk_states = self.brk_states.shape[0]
 
-        self.total_likelihood_mask = np.ones((self.num_segments,), dtype=np.int64)
-        self.allele_likelihood_mask = np.ones((self.num_segments,), dtype=np.int64)
+        self._total_likelihood_mask = np.ones((self.num_segments,), dtype=np.int64)
+        self._allele_likelihood_mask = np.ones((self.num_segments,), dtype=np.int64)
 
         # Create total states for convenience
-        self.cn_states_total = np.zeros((self.num_segments, self.num_cn_states, self.num_clones), dtype=np.int64)
-        for n in range(self.num_segments):
+        self.cn_states_total = np.zeros((self.num_state_classes, self.num_cn_states, self.num_clones), dtype=np.int64)
+        for c in range(self.num_state_classes):
             for s in range(self.num_cn_states):
                 for m in range(self.num_clones):
                     for ell in range(self.num_alleles):
-                        self.cn_states_total[n, s, m] += self.cn_states[n, s, m, ell]
+                        self.cn_states_total[c, s, m] += self.cn_states[c, s, m, ell]
 
         # Create is subclonal and cn state indicators for convenience
         self.num_alleles_subclonal = np.sum((np.asarray(self.cn_states)[:, :, 1:, :].max(axis=-2) != np.asarray(self.cn_states)[:, :, 1:, :].min(axis=-2)), axis=-1)
         self.is_hdel = np.all(np.asarray(self.cn_states) == 0, axis=(-2, -1)) * 1
         self.is_loh = np.any(np.asarray(self.cn_states).sum(axis=-2) == 0, axis=-1) * 1
 
-        if ((cn_states.shape[0] != num_segments) or (cn_states.shape[1] != self.num_cn_states) or
+        if ((cn_states.shape[0] != self.num_state_classes) or (cn_states.shape[1] != self.num_cn_states) or
             (cn_states.shape[2] != num_clones) or (cn_states.shape[3] != self.num_alleles)):
-            raise ValueError('cn_states must have shape (num_segments, num_cn_states, num_clones, num_alleles)')
+            raise ValueError('cn_states must have shape (num_state_classes, num_cn_states, num_clones, num_alleles)')
+
+        if state_class.shape[0] != num_segments:
+            raise ValueError('state_class must have length equal to num_segments')
+
+        if state_class.shape[0] > 0 and (state_class.min() < 0 or state_class.max() >= self.num_state_classes):
+            raise ValueError('state_class must index state classes between 0 and num_state_classes - 1')
 
         if ((brk_states.shape[0] != self.num_brk_states) or (brk_states.shape[1] != num_clones)):
             raise ValueError('cn_states must have shape (num_brk_states, num_clones)')
@@ -544,18 +702,33 @@ cdef class RemixtModel:
                 self.p_breakpoint[k, s_b] = 1.
         self.p_breakpoint /= np.sum(self.p_breakpoint, axis=-1)[:, np.newaxis]
 
+        self.create_transmat_idx()
+
+        # Telomeres split the hmm into independent chains
+        self.chain_start = np.array(
+            [0] + [n + 1 for n in range(self.num_segments - 1) if self.is_telomere[n] > 0] + [self.num_segments],
+            dtype=np.int64)
+
+        self.num_threads = 1
+        self._hmm_precision = 0
+
+        # Candidate states of each segment, all states unless pruned
+        self.state_offsets = np.arange(self.num_segments + 1, dtype=np.int64) * self.num_cn_states
+        self.state_idx = np.tile(np.arange(self.num_cn_states, dtype=np.int64), self.num_segments)
+
         self.hmm_log_norm_const = 0.
         self.framelogprob = np.ones((self.num_segments, self.num_cn_states))
-        self.log_transmat = np.zeros((self.num_segments - 1, self.num_cn_states, self.num_cn_states))
-        self.cached_log_transmat = np.zeros((self.num_segments - 1, self.num_cn_states, self.num_cn_states))
+        self.log_transmat = np.zeros((self.num_transmats, self.num_cn_states, self.num_cn_states))
+        self.cached_log_transmat = np.zeros((self.num_transmats, self.num_cn_states, self.num_cn_states))
         self.posterior_marginals = np.zeros((self.num_segments, self.num_cn_states))
-        self.joint_posterior_marginals = np.zeros((self.num_segments - 1, self.num_cn_states, self.num_cn_states))
 
         # Initialize to something valid
         self.posterior_marginals[:] = 1.
         self.posterior_marginals /= np.sum(self.posterior_marginals, axis=-1)[:, np.newaxis]
-        self.joint_posterior_marginals[:] = 1.
-        self.joint_posterior_marginals /= np.sum(self.joint_posterior_marginals, axis=(-2, -1))[:, np.newaxis, np.newaxis]
+        self.joint_posterior_marginals = (
+            np.ones((self.num_transmats, self.num_cn_states, self.num_cn_states)) *
+            np.bincount(self.transmat_idx, minlength=self.num_transmats)[:, np.newaxis, np.newaxis] /
+            float(self.num_cn_states * self.num_cn_states))
 
         # Indicator for allele swapping
         self.p_allele_swap = np.ones((self.num_segments, 2)) * 0.5
@@ -575,17 +748,17 @@ cdef class RemixtModel:
         self.p_outlier_allele[:, 1] = self.prior_outlier_allele
 
         # Initialize likelihood parameters
-        self.negbin_r_0 = 500.
-        self.negbin_r_1 = 10.
-        self.negbin_hdel_mu = 1e-5
-        self.negbin_hdel_r_0 = 10.
-        self.negbin_hdel_r_1 = 1.
-
-        self.betabin_M_0 = 500.
-        self.betabin_M_1 = 10.
-        self.betabin_loh_p = 1e-3
-        self.betabin_loh_M_0 = 10.
-        self.betabin_loh_M_1 = 1.
+        self._negbin_r_0 = 500.
+        self._negbin_r_1 = 10.
+        self._negbin_hdel_mu = 1e-5
+        self._negbin_hdel_r_0 = 10.
+        self._negbin_hdel_r_1 = 1.
+
+        self._betabin_M_0 = 500.
+        self._betabin_M_1 = 10.
+        self._betabin_loh_p = 1e-3
+        self._betabin_loh_M_0 = 10.
+        self._betabin_loh_M_1 = 1.
 
         # Temporary buffers
         self._p_d = np.zeros(((self.cn_max + 1) * 2,))
@@ -594,6 +767,345 @@ cdef class RemixtModel:
         # Cached transmat expecation for elbo calc, updated with p_breakpoint
         self.calculate_log_transmat(self.cached_log_transmat)
 
+        # Cached likelihoods, updated on demand after changes to parameters
+        self.log_likelihood_total = np.zeros((self.num_segments, self.num_cn_states, 2))
+        self.log_likelihood_allele = np.zeros((self.num_segments, self.num_cn_states, 2, 2))
+        self._likelihood_valid = False
+
+        # Cached elbo terms, updated as byproducts of variational updates
+        self.invalidate_elbo()
+
+        # Contracted weights of sampled segments for parameter optimization
+        self.sample_min_posterior = 1e-8
+        self.set_likelihood_sample(np.zeros((self.num_segments,), dtype=np.int64))
+
+    # Setting data or likelihood parameters invalidates the cached likelihoods,
+    # modifying arrays in place requires a call to invalidate_likelihood
+
+    property x:
+        def __get__(self):
+            return self._x
+        def __set__(self, np.float64_t[:] value):
+            self._x = value
+            self._likelihood_valid = False
+
+    property y:
+        def __get__(self):
+            return self._y
+        def __set__(self, np.float64_t[:, :] value):
+            self._y = value
+            self._likelihood_valid = False
+
+    property total_likelihood_mask:
+        def __get__(self):
+            return self._total_likelihood_mask
+        def __set__(self, np.int64_t[:] value):
+            self._total_likelihood_mask = value
+            self._likelihood_valid = False
+
+    property allele_likelihood_mask:
+        def __get__(self):
+            return self._allele_likelihood_mask
+        def __set__(self, np.int64_t[:] value):
+            self._allele_likelihood_mask = value
+            self._likelihood_valid = False
+
+    # Storage precision of transition matrices and joint posterior marginals,
+    # 0 for double precision, 1 for single precision, with messages and sums
+    # accumulated in double precision in either case
+
+    property hmm_precision:
+        def __get__(self):
+            return self._hmm_precision
+        def __set__(self, int value):
+            if value not in (0, 1):
+                raise ValueError('hmm_precision must be 0 or 1')
+            self._hmm_precision = value
+            self.log_transmat = self.log_transmat.astype(self._transmat_dtype())
+            self.cached_log_transmat = self.cached_log_transmat.astype(self._transmat_dtype())
+            self.joint_posterior_marginals = self.joint_posterior_marginals.astype(self._transmat_dtype())
+
+    def _transmat_dtype(self):
+        if self._hmm_precision == 1:
+            return np.float32
+        return np.float64
+
+    property h:
+        def __get__(self):
+            return self._h
+        def __set__(self, np.float64_t[:] value):
+            self._h = value
+            self._likelihood_valid = False
+
+    property negbin_r_0:
+        def __get__(self):
+            return self._negbin_r_0
+        def __set__(self, np.float64_t value):
+            self._negbin_r_0 = value
+            self._likelihood_valid = False
+
+    property negbin_r_1:
+        def __get__(self):
+            return self._negbin_r_1
+        def __set__(self, np.float64_t value):
+            self._negbin_r_1 = value
+            self._likelihood_valid = False
+
+    property negbin_hdel_mu:
+        def __get__(self):
+            return self._negbin_hdel_mu
+        def __set__(self, np.float64_t value):
+            self._negbin_hdel_mu = value
+            self._likelihood_valid = False
+
+    property negbin_hdel_r_0:
+        def __get__(self):
+            return self._negbin_hdel_r_0
+        def __set__(self, np.float64_t value):
+            self._negbin_hdel_r_0 = value
+            self._likelihood_valid = False
+
+    property negbin_hdel_r_1:
+        def __get__(self):
+            return self._negbin_hdel_r_1
+        def __set__(self, np.float64_t value):
+            self._negbin_hdel_r_1 = value
+            self._likelihood_valid = False
+
+    property betabin_M_0:
+        def __get__(self):
+            return self._betabin_M_0
+        def __set__(self, np.float64_t value):
+            self._betabin_M_0 = value
+            self._likelihood_valid = False
+
+    property betabin_M_1:
+        def __get__(self):
+            return self._betabin_M_1
+        def __set__(self, np.float64_t value):
+            self._betabin_M_1 = value
+            self._likelihood_valid = False
+
+    property betabin_loh_p:
+        def __get__(self):
+            return self._betabin_loh_p
+        def __set__(self, np.float64_t value):
+            self._betabin_loh_p = value
+            self._likelihood_valid = False
+
+    property betabin_loh_M_0:
+        def __get__(self):
+            return self._betabin_loh_M_0
+        def __set__(self, np.float64_t value):
+            self._betabin_loh_M_0 = value
+            self._likelihood_valid = False
+
+    property betabin_loh_M_1:
+        def __get__(self):
+            return self._betabin_loh_M_1
+        def __set__(self, np.float64_t value):
+            self._betabin_loh_M_1 = value
+            self._likelihood_valid = False
+
+    cpdef void invalidate_likelihood(self) except *:
+        """ Mark cached likelihoods for recalculation.
+        """
+        self._likelihood_valid = False
+        self.invalidate_elbo()
+
+    cpdef void invalidate_elbo(self) except *:
+        """ Mark cached elbo terms for recalculation, required after directly
+        modifying variational parameters or priors.
+        """
+        self._energy_prior_valid = False
+        self._energy_total_valid = False
+        self._energy_allele_valid = False
+        self._energy_transition_valid = False
+        self._entropy_hmm_valid = False
+
+    cpdef void update_log_likelihood(self) except *:
+        """ Update cached log likelihoods if invalidated by a change in parameters.
+        """
+        cdef int n, j, s, u, v, w
+
+        if self._likelihood_valid:
+            return
+
+        # Likelihood energy terms depend on the likelihood
+        self._energy_total_valid = False
+        self._energy_allele_valid = False
+
+        with nogil:
+            for n in prange(self.num_segments, num_threads=self.num_threads, schedule='static'):
+                for j in range(self.state_offsets[n], self.state_offsets[n + 1]):
+                    s = self.state_idx[j]
+                    for u in range(2):
+                        self.log_likelihood_total[n, s, u] = self._log_likelihood_total(n, s, u)
+
+                    for v in range(2):
+                        for w in range(2):
+                            self.log_likelihood_allele[n, s, v, w] = self._log_likelihood_allele(n, s, v, w)
+
+        # Undefined likelihoods are nan, recalculate the first to raise
+        for n, s, u in zip(*np.where(np.isnan(self.log_likelihood_total))):
+            self.calculate_log_likelihood_total(n, s, u)
+        for n, s, v, w in zip(*np.where(np.isnan(self.log_likelihood_allele))):
+            self.calculate_log_likelihood_allele(n, s, v, w)
+
+        self._likelihood_valid = True
+
+    cpdef void set_candidate_states(self, np.int64_t[:] state_offsets, np.int64_t[:] state_idx) except *:
+        """ Restrict the copy number states of each segment to a set of candidates.
+
+        Candidate states of segment n are state_idx[state_offsets[n]:state_offsets[n + 1]],
+        in compressed sparse row layout.  Likelihoods, forward backward and the
+        joint posteriors of breakpoint adjacencies are calculated for candidate
+        states only, other states have zero posterior probability.  Cached
+        likelihoods and transition matrices are recalculated for the new
+        candidates.  Posterior marginals are restricted to the candidates and
+        renormalized, the approximating HMM should be updated with update_p_cn
+        before calculating the elbo.
+        """
+
+        cdef int n, j, s
+        cdef np.float64_t normalize
+
+        if state_offsets.shape[0] != self.num_segments + 1:
+            raise ValueError('state_offsets must have length equal to num_segments + 1')
+
+        if state_offsets[0] != 0 or state_offsets[self.num_segments] != state_idx.shape[0]:
+            raise ValueError('state_offsets must start at 0 and end at the length of state_idx')
+
+        for n in range(self.num_segments):
+            if state_offsets[n + 1] <= state_offsets[n]:
+                raise ValueError('segment {} has no candidate states'.format(n))
+
+        if state_idx.shape[0] > 0 and (np.min(state_idx) < 0 or np.max(state_idx) >= self.num_cn_states):
+            raise ValueError('state_idx must index states between 0 and num_cn_states - 1')
+
+        self.state_offsets = state_offsets
+        self.state_idx = state_idx
+
+        for n in range(self.num_segments):
+            normalize = 0.
+            for j in range(self.state_offsets[n], self.state_offsets[n + 1]):
+                normalize += self.posterior_marginals[n, self.state_idx[j]]
+
+            self.framelogprob[n, :] = _NINF
+            self.posterior_marginals[n, :] = 0.
+
+            for j in range(self.state_offsets[n], self.state_offsets[n + 1]):
+                s = self.state_idx[j]
+                self.framelogprob[n, s] = 0.
+                if normalize > 0.:
+                    self.posterior_marginals[n, s] = self.posterior_marginals[n, s] / normalize
+                else:
+                    self.posterior_marginals[n, s] = 1. / (self.state_offsets[n + 1] - self.state_offsets[n])
+
+        # Likelihoods and breakpoint transition matrices are cached for the
+        # previous candidates only
+        self.calculate_log_transmat(self.cached_log_transmat)
+        self.invalidate_likelihood()
+
+    cpdef void prune_cn_states(self, np.float64_t log_threshold, bint keep_candidates=False) except *:
+        """ Set the candidate states of each segment to those plausible given the
+        expected read depth and allele ratio under the current h.
+
+        Candidate states have a log prior plus total and allele log likelihood,
+        taking the best outlier and allele swap indicators, within log_threshold
+        of the best state of the segment.  States with a score of -inf are not
+        candidates unless no state of the segment has a finite score.  If
+        keep_candidates is set, the current candidates of each segment remain
+        candidates.
+        """
+
+        cdef int n, s, u, v, w
+        cdef np.float64_t ll, ll_total, ll_allele
+        cdef np.float64_t[:, :] log_score = np.empty((self.num_segments, self.num_cn_states))
+
+        with nogil:
+            for n in prange(self.num_segments, num_threads=self.num_threads, schedule='static'):
+                for s in range(self.num_cn_states):
+                    ll_total = _NINF
+                    for u in range(2):
+                        ll = self._log_likelihood_total(n, s, u)
+                        if isnan(ll) or ll > ll_total:
+                            ll_total = ll
+
+                    ll_allele = _NINF
+                    for v in range(2):
+                        for w in range(2):
+                            ll = self._log_likelihood_allele(n, s, v, w)
+                            if isnan(ll) or ll > ll_allele:
+                                ll_allele = ll
+
+                    log_score[n, s] = self._log_prior_cn(n, s) + ll_total + ll_allele
+
+        # Undefined likelihoods are kept as candidates, and raise when updated
+        score = np.asarray(log_score)
+        is_undefined = np.isnan(score)
+        max_score = np.where(is_undefined, _NINF, score).max(axis=1)
+        with np.errstate(invalid='ignore'):
+            is_candidate = is_undefined | (
+                (score > _NINF) & (score >= max_score[:, np.newaxis] - log_threshold))
+
+        # Segments with no finite score keep all states
+        is_candidate[np.isneginf(max_score), :] = True
+
+        if keep_candidates:
+            for n in range(self.num_segments):
+                is_candidate[n, self.state_idx[self.state_offsets[n]:self.state_offsets[n + 1]]] = True
+
+        state_offsets = np.concatenate([[0], np.cumsum(is_candidate.sum(axis=1))]).astype(np.int64)
+        state_idx = np.where(is_candidate)[1].astype(np.int64)
+
+        # Unchanged candidates leave the approximating HMM as is
+        if np.array_equal(state_offsets, self.state_offsets) and np.array_equal(state_idx, self.state_idx):
+            return
+
+        self.set_candidate_states(state_offsets, state_idx)
+
+    def create_transmat_idx(self):
+        """ Create the index of each adjacency into shared transition matrices.
+
+        Transition matrices depend only on the copy number states of adjacent
+        segments, except at breakpoints, and are zero at telomeres.  Matrix 0
+        is for telomeres, a matrix is shared by other adjacencies between
+        segments with the same pair of state classes, and each breakpoint
+        adjacency has its own matrix, indexed after the num_shared_transmats
+        shared matrices.  Joint posterior marginals are summed over the
+        adjacencies sharing each matrix, such that memory scales with the
+        number of segments times the number of states.
+        """
+
+        self.transmat_idx = np.zeros((max(self.num_segments - 1, 0),), dtype=np.int64)
+        transmat_adjacency = [-1]
+        breakpoint_adjacency = []
+        template_idx = dict()
+
+        for n in range(0, self.num_segments - 1):
+            if self.breakpoint_idx[n] >= 0:
+                breakpoint_adjacency.append(n)
+
+            elif self.is_telomere[n] > 0:
+                self.transmat_idx[n] = 0
+
+            else:
+                key = (self.state_class[n], self.state_class[n + 1])
+                if key not in template_idx:
+                    template_idx[key] = len(transmat_adjacency)
+                    transmat_adjacency.append(n)
+                self.transmat_idx[n] = template_idx[key]
+
+        self.num_shared_transmats = len(transmat_adjacency)
+
+        for n in breakpoint_adjacency:
+            self.transmat_idx[n] = len(transmat_adjacency)
+            transmat_adjacency.append(n)
+
+        self.transmat_adjacency = np.array(transmat_adjacency, dtype=np.int64)
+        self.num_transmats = len(transmat_adjacency)
+
     @cython.profile(False)
     cdef inline np.float64_t calc_transition(self, np.float64_t cn_diff):
         """ Calculate transition function for a copy number difference.
@@ -606,6 +1118,15 @@ cdef class RemixtModel:
             else:
                 return 1.
 
+    cdef np.int64_t[:] _transition_states(self, int n, int side):
+        """ States of the segment on one side of adjacency n for which transitions
+        are calculated, candidate states at breakpoints, all states otherwise, as
+        matrices not at breakpoints are shared between adjacencies.
+        """
+        if self.breakpoint_idx[n] >= 0:
+            return self.state_idx[self.state_offsets[n + side]:self.state_offsets[n + side + 1]]
+        return np.arange(self.num_cn_states, dtype=np.int64)
+
     @cython.wraparound(True)
     cdef void add_log_breakpoint_p_expectation_cn(self, np.float64_t[:] log_breakpoint_p, np.float64_t[:, :] p_cn,
                                              int n, int m, int breakpoint_orient, np.float64_t mult_const) except *:
@@ -613,14 +1134,17 @@ cdef class RemixtModel:
         copy number probability.
         """
 
-        cdef int d, s_1, s_2, s_b
-        cdef np.ndarray[np.float64_t, ndim=1] p_d
+        cdef int d, a, b, s_1, s_2, s_b
+        cdef np.int64_t[:] states_1 = self._transition_states(n, 0)
+        cdef np.int64_t[:] states_2 = self._transition_states(n, 1)
 
         self._p_d[:] = 0.
 
-        for s_1 in range(self.num_cn_states):
-            for s_2 in range(self.num_cn_states):
-                d = self.cn_states_total[n, s_1, m] - self.cn_states_total[n + 1, s_2, m]
+        for a in range(states_1.shape[0]):
+            s_1 = states_1[a]
+            for b in range(states_2.shape[0]):
+                s_2 = states_2[b]
+                d = self.cn_states_total[self.state_class[n], s_1, m] - self.cn_states_total[self.state_class[n + 1], s_2, m]
                 self._p_d[d] += p_cn[s_1, s_2]
 
         for s_b in range(self.num_brk_states):
@@ -628,23 +1152,39 @@ cdef class RemixtModel:
                 log_breakpoint_p[s_b] += mult_const * self._p_d[d] * self.calc_transition(d - breakpoint_orient * self.brk_states[s_b, m])
 
     @cython.wraparound(True)
-    cpdef void calculate_log_transmat(self, np.float64_t[:, :, :] log_transmat) except *:
-        """ Calculate the log transition matrix given current breakpoint and
+    cpdef void calculate_log_transmat(self, log_transmat) except *:
+        """ Calculate the log transition matrices given current breakpoint and
         allele probabilities.
+
+        Breakpoint matrices are calculated for pairs of candidate states only.
+        Each matrix is calculated in double precision and stored in the
+        precision of log_transmat.
         """
-        cdef int n, m, d, s_b, s_1, s_2, flip, allele
+        cdef int i, n, m, d, s_b, a, b, s_1, s_2, flip, allele
+        cdef np.int64_t[:] states_1
+        cdef np.int64_t[:] states_2
+        cdef np.float64_t[:, :] log_transmat_i = np.zeros((self.num_cn_states, self.num_cn_states))
 
         log_transmat[:] = 0.
 
-        for n in range(0, self.num_segments - 1):
-            if self.is_telomere[n] > 0:
+        for i in range(self.num_transmats):
+            n = self.transmat_adjacency[i]
+
+            if n < 0 or self.is_telomere[n] > 0:
                 continue
 
-            elif self.breakpoint_idx[n] < 0:
+            states_1 = self._transition_states(n, 0)
+            states_2 = self._transition_states(n, 1)
+
+            log_transmat_i[:, :] = 0.
+
+            if self.breakpoint_idx[n] < 0:
                 for m in range(self.num_clones):
-                    for s_1 in range(self.num_cn_states):
-                        for s_2 in range(self.num_cn_states):
-                            log_transmat[n, s_1, s_2] += -self.transition_penalty * self.calc_transition(self.cn_states_total[n, s_1, m] - self.cn_states_total[n + 1, s_2, m])
+                    for a in range(states_1.shape[0]):
+                        s_1 = states_1[a]
+                        for b in range(states_2.shape[0]):
+                            s_2 = states_2[b]
+                            log_transmat_i[s_1, s_2] += -self.transition_penalty * self.calc_transition(self.cn_states_total[self.state_class[n], s_1, m] - self.cn_states_total[self.state_class[n + 1], s_2, m])
 
             else:
                 for m in range(self.num_clones):
@@ -654,14 +1194,18 @@ cdef class RemixtModel:
                         for s_b in range(self.num_brk_states):
                             self._p_d[d] += self.p_breakpoint[self.breakpoint_idx[n], s_b] * self.calc_transition(d - self.breakpoint_orient[n] * self.brk_states[s_b, m])
 
-                    for s_1 in range(self.num_cn_states):
-                        for s_2 in range(self.num_cn_states):
-                            log_transmat[n, s_1, s_2] += -self.transition_penalty * self._p_d[self.cn_states_total[n, s_1, m] - self.cn_states_total[n + 1, s_2, m]]
+                    for a in range(states_1.shape[0]):
+                        s_1 = states_1[a]
+                        for b in range(states_2.shape[0]):
+                            s_2 = states_2[b]
+                            log_transmat_i[s_1, s_2] += -self.transition_penalty * self._p_d[self.cn_states_total[self.state_class[n], s_1, m] - self.cn_states_total[self.state_class[n + 1], s_2, m]]
 
             self._allele_cn_change[:] = 0.
 
-            for s_1 in range(self.num_cn_states):
-                for s_2 in range(self.num_cn_states):
+            for a in range(states_1.shape[0]):
+                s_1 = states_1[a]
+                for b in range(states_2.shape[0]):
+                    s_2 = states_2[b]
                     for flip in range(2):
                         self._allele_cn_change[flip] = 0.
                         for m in range(self.num_clones):
@@ -670,19 +1214,24 @@ cdef class RemixtModel:
                                     other_allele = 1 - allele
                                 else:
                                     other_allele = allele
-                                self._allele_cn_change[flip] += self.calc_transition(self.cn_states[n, s_1, m, allele] - self.cn_states[n + 1, s_2, m, other_allele])
-                            self._allele_cn_change[flip] -= self.calc_transition(self.cn_states_total[n, s_1, m] - self.cn_states_total[n + 1, s_2, m])
-                    log_transmat[n, s_1, s_2] += -self.transition_penalty * min(self._allele_cn_change[0], self._allele_cn_change[1])
+                                self._allele_cn_change[flip] += self.calc_transition(self.cn_states[self.state_class[n], s_1, m, allele] - self.cn_states[self.state_class[n + 1], s_2, m, other_allele])
+                            self._allele_cn_change[flip] -= self.calc_transition(self.cn_states_total[self.state_class[n], s_1, m] - self.cn_states_total[self.state_class[n + 1], s_2, m])
+                    log_transmat_i[s_1, s_2] += -self.transition_penalty * min(self._allele_cn_change[0], self._allele_cn_change[1])
+
+            log_transmat[i] = np.asarray(log_transmat_i)
 
     cpdef np.float64_t calculate_expected_total_reads(self, int n, int s) except *:
         """ Calculate expected total read count for a segment.
         """
 
+        return self._expected_total_reads(n, s)
+
+    cdef np.float64_t _expected_total_reads(self, int n, int s) nogil:
         cdef np.float64_t mu = 0.
         cdef int m
 
         for m in range(self.num_clones):
-            mu += self.h[m] * self.cn_states_total[n, s, m]
+            mu += self._h[m] * self.cn_states_total[self.state_class[n], s, m]
 
         mu *= self.l[n]
 
@@ -695,22 +1244,30 @@ cdef class RemixtModel:
         cdef int m
 
         for m in range(self.num_clones):
-            partial_h[m] = self.l[n] * self.cn_states_total[n, s, m]
+            partial_h[m] = self.l[n] * self.cn_states_total[self.state_class[n], s, m]
 
     cpdef np.float64_t calculate_expected_allele_ratio(self, int n, int s) except *:
         """ Calculate expected allele ratio for a segment.
         """
 
+        cdef np.float64_t p = self._expected_allele_ratio(n, s)
+
+        if isnan(p):
+            raise ValueError('total_depth <= 0 for s: {}'.format(s))
+
+        return p
+
+    cdef np.float64_t _expected_allele_ratio(self, int n, int s) nogil:
         cdef np.float64_t minor_depth = 0.
         cdef np.float64_t total_depth = 0.
         cdef int m
 
         for m in range(self.num_clones):
-            minor_depth += self.h[m] * self.cn_states[n, s, m, 0]
-            total_depth += self.h[m] * self.cn_states_total[n, s, m]
+            minor_depth += self._h[m] * self.cn_states[self.state_class[n], s, m, 0]
+            total_depth += self._h[m] * self.cn_states_total[self.state_class[n], s, m]
 
         if total_depth <= 0:
-            raise ValueError('total_depth <= 0 for s: {}'.format(s))
+            return NAN
 
         return minor_depth / total_depth
 
@@ -723,48 +1280,59 @@ cdef class RemixtModel:
         cdef int m
 
         for m in range(self.num_clones):
-            minor_depth += self.h[m] * self.cn_states[n, s, m, 0]
-            total_depth += self.h[m] * self.cn_states_total[n, s, m]
+            minor_depth += self._h[m] * self.cn_states[self.state_class[n], s, m, 0]
+            total_depth += self._h[m] * self.cn_states_total[self.state_class[n], s, m]
 
         if total_depth <= 0:
             raise ValueError('total_depth <= 0 for s: {}'.format(s))
 
         for m in range(self.num_clones):
             partial_h[m] = (
-                (self.cn_states[n, s, m, 0] * total_depth - minor_depth * self.cn_states_total[n, s, m]) /
+                (self.cn_states[self.state_class[n], s, m, 0] * total_depth - minor_depth * self.cn_states_total[self.state_class[n], s, m]) /
                 (total_depth * total_depth))
 
     cpdef np.float64_t calculate_log_prior_cn(self, int n, int s) except *:
         """ Calculate the log prior of the copy number state for a segment.
         """
-        return -1.0 * self.num_alleles_subclonal[n, s] * self.l[n] * self.divergence_weight
+        return self._log_prior_cn(n, s)
+
+    cdef inline np.float64_t _log_prior_cn(self, int n, int s) nogil:
+        return -1.0 * self.num_alleles_subclonal[self.state_class[n], s] * self.l[n] * self.divergence_weight
 
     cpdef np.float64_t calculate_log_likelihood_total(self, int n, int s, int u) except *:
         """ Calculate the log likelihood of total read counts for a segment.
         """
 
+        cdef np.float64_t ll = self._log_likelihood_total(n, s, u)
+
+        if isnan(ll):
+            raise ValueError('ll is nan for x: {}, mu: {}'.format(self._x[n], self.calculate_expected_total_reads(n, s)))
+
+        return ll
+
+    cdef np.float64_t _log_likelihood_total(self, int n, int s, int u) nogil:
         cdef np.float64_t mu, r
 
-        if self.total_likelihood_mask[n] == 0:
+        if self._total_likelihood_mask[n] == 0:
             return 0.
 
-        if not self.normal_contamination and self.is_hdel[n, s] == 1:
-            mu = self.negbin_hdel_mu
+        if not self.normal_contamination and self.is_hdel[self.state_class[n], s] == 1:
+            mu = self._negbin_hdel_mu
 
             if u == 0:
-                r = self.negbin_hdel_r_0
+                r = self._negbin_hdel_r_0
             else:
-                r = self.negbin_hdel_r_1
+                r = self._negbin_hdel_r_1
 
         else:
-            mu = self.calculate_expected_total_reads(n, s)
+            mu = self._expected_total_reads(n, s)
 
             if u == 0:
-                r = self.negbin_r_0
+                r = self._negbin_r_0
             else:
-                r = self.negbin_r_1
+                r = self._negbin_r_1
 
-        return negbin_log_likelihood(self.x[n], mu, r)
+        return _negbin_log_likelihood(self._x[n], mu, r)
 
     cpdef void calculate_log_likelihood_total_partial_h(self, int n, int s, int u, np.float64_t[:] partial_h) except *:
         """ Calculate the partial derivative of the log likelihood
@@ -774,11 +1342,11 @@ cdef class RemixtModel:
 
         cdef np.float64_t mu, r, log_likelihood_partial_mu
 
-        if self.total_likelihood_mask[n] == 0:
+        if self._total_likelihood_mask[n] == 0:
             partial_h[:] = 0.
             return
 
-        if not self.normal_contamination and self.is_hdel[n, s] == 1:
+        if not self.normal_contamination and self.is_hdel[self.state_class[n], s] == 1:
             partial_h[:] = 0.
             return
             
@@ -786,11 +1354,11 @@ cdef class RemixtModel:
             mu = self.calculate_expected_total_reads(n, s)
 
             if u == 0:
-                r = self.negbin_r_0
+                r = self._negbin_r_0
             else:
-                r = self.negbin_r_1
+                r = self._negbin_r_1
 
-        log_likelihood_partial_mu = negbin_log_likelihood_partial_mu(self.x[n], mu, r)
+        log_likelihood_partial_mu = negbin_log_likelihood_partial_mu(self._x[n], mu, r)
 
         self.calculate_expected_total_reads_partial_h(n, s, partial_h)
 
@@ -801,47 +1369,59 @@ cdef class RemixtModel:
         """ Calculate the log likelihood of allele read counts for a segment.
         """
 
+        cdef np.float64_t ll = self._log_likelihood_allele(n, s, v, w)
+
+        if isnan(ll):
+            if self.is_hdel[self.state_class[n], s] == 0:
+                p = self.calculate_expected_allele_ratio(n, s)
+                if not self.normal_contamination and self.is_loh[self.state_class[n], s] == 1:
+                    raise ValueError('expected p {} for loh state {}'.format(p, s))
+            raise ValueError('ll is nan for y: {}, state {}'.format(np.asarray(self._y[n]), s))
+
+        return ll
+
+    cdef np.float64_t _log_likelihood_allele(self, int n, int s, int v, int w) nogil:
         cdef np.float64_t p, M, allelic_readcount, minor_readcount
 
-        if self.allele_likelihood_mask[n] == 0:
+        if self._allele_likelihood_mask[n] == 0:
             return 0.
 
-        if self.is_hdel[n, s] == 1:
+        if self.is_hdel[self.state_class[n], s] == 1:
             p = 0.
         else:
-            p = self.calculate_expected_allele_ratio(n, s)
+            p = self._expected_allele_ratio(n, s)
 
-        if not self.normal_contamination and self.is_loh[n, s] == 1:
+        if not self.normal_contamination and self.is_loh[self.state_class[n], s] == 1:
             if p == 0.:
-                p = self.betabin_loh_p
+                p = self._betabin_loh_p
             elif p == 1.:
-                p = 1. - self.betabin_loh_p
+                p = 1. - self._betabin_loh_p
             else:
-                raise ValueError('expected p {} for loh state {}'.format(p, s))
+                return NAN
 
             if v == 0:
-                M = self.betabin_loh_M_0
+                M = self._betabin_loh_M_0
             else:
-                M = self.betabin_loh_M_1
+                M = self._betabin_loh_M_1
 
         else:
             if v == 0:
-                M = self.betabin_M_0
+                M = self._betabin_M_0
             else:
-                M = self.betabin_M_1
+                M = self._betabin_M_1
 
-        allelic_readcount = self.y[n, 0] + self.y[n, 1]
+        allelic_readcount = self._y[n, 0] + self._y[n, 1]
 
         if allelic_readcount == 0:
             return 0.
 
         if w == 0:
-            minor_readcount = self.y[n, 0]
+            minor_readcount = self._y[n, 0]
 
         else:
-            minor_readcount = self.y[n, 1]
+            minor_readcount = self._y[n, 1]
 
-        return betabin_log_likelihood(minor_readcount, allelic_readcount, p, M)
+        return _betabin_log_likelihood(minor_readcount, allelic_readcount, p, M)
 
     cpdef void calculate_log_likelihood_allele_partial_h(self, int n, int s, int v, int w, np.float64_t[:] partial_h) except *:
         """ Calculate the partial derivative of the log likelihood
@@ -851,11 +1431,11 @@ cdef class RemixtModel:
 
         cdef np.float64_t p, M, allelic_readcount, minor_readcount, log_likelihood_partial_p
 
-        if self.allele_likelihood_mask[n] == 0:
+        if self._allele_likelihood_mask[n] == 0:
             partial_h[:] = 0.
             return
 
-        if not self.normal_contamination and self.is_loh[n, s] == 1:
+        if not self.normal_contamination and self.is_loh[self.state_class[n], s] == 1:
             partial_h[:] = 0.
             return
 
@@ -863,21 +1443,21 @@ cdef class RemixtModel:
             p = self.calculate_expected_allele_ratio(n, s)
 
             if v == 0:
-                M = self.betabin_M_0
+                M = self._betabin_M_0
             else:
-                M = self.betabin_M_1
+                M = self._betabin_M_1
 
-        allelic_readcount = self.y[n, 0] + self.y[n, 1]
+        allelic_readcount = self._y[n, 0] + self._y[n, 1]
 
         if allelic_readcount == 0:
             partial_h[:] = 0.
             return
 
         if w == 0:
-            minor_readcount = self.y[n, 0]
+            minor_readcount = self._y[n, 0]
 
         else:
-            minor_readcount = self.y[n, 1]
+            minor_readcount = self._y[n, 1]
 
         log_likelihood_partial_p = betabin_log_likelihood_partial_p(minor_readcount, allelic_readcount, p, M)
 
@@ -890,36 +1470,33 @@ cdef class RemixtModel:
         """ Update the log probability of each segment from the log likelihood and
         likelihood states
         """
-        cdef int n, s, u, v, w
+        cdef int n, j, s, u, v, w
 
-        self.framelogprob[:, :] = 0.
-        
-        for n in range(self.num_segments):
-            for s in range(self.num_cn_states):
-                for u in range(2):
-                    self.framelogprob[n, s] += (
-                        self.p_outlier_total[n, u] * self.calculate_log_likelihood_total(n, s, u))
+        self.update_log_likelihood()
 
-                for v in range(2):
-                    for w in range(2):
+        with nogil:
+            for n in prange(self.num_segments, num_threads=self.num_threads, schedule='static'):
+                for j in range(self.state_offsets[n], self.state_offsets[n + 1]):
+                    s = self.state_idx[j]
+                    self.framelogprob[n, s] = 0.
+
+                    for u in range(2):
                         self.framelogprob[n, s] += (
-                            self.p_outlier_allele[n, v] * 
-                            self.p_allele_swap[n, w] * 
-                            self.calculate_log_likelihood_allele(n, s, v, w))
+                            self.p_outlier_total[n, u] * self.log_likelihood_total[n, s, u])
+
+                    for v in range(2):
+                        for w in range(2):
+                            self.framelogprob[n, s] += (
+                                self.p_outlier_allele[n, v] * 
+                                self.p_allele_swap[n, w] * 
+                                self.log_likelihood_allele[n, s, v, w])
 
-                self.framelogprob[n, s] += self.calculate_log_prior_cn(n, s)
+                    self.framelogprob[n, s] += self._log_prior_cn(n, s)
 
     cpdef void update_p_cn(self) except *:
         """ Update the parameters of the approximating HMM.
         """
 
-        cdef np.ndarray[np.float64_t, ndim=2] alphas = np.empty((self.num_segments, self.num_cn_states))
-        cdef np.ndarray[np.float64_t, ndim=2] betas = np.empty((self.num_segments, self.num_cn_states))
-
-        cdef int n, s, s_
-        cdef np.ndarray[np.float64_t, ndim=1] log_posterior_marginals = np.zeros((self.num_cn_states,))
-        cdef np.ndarray[np.float64_t, ndim=2] log_joint_posterior_marginals = np.zeros((self.num_cn_states, self.num_cn_states))
-
         # Update frame log probabilities
         self.update_framelogprob()
         assert self.framelogprob.shape[0] == self.num_segments
@@ -929,26 +1506,54 @@ cdef class RemixtModel:
         # Build the log transition probabilities of this chain
         self.calculate_log_transmat(self.log_transmat)
 
-        sum_product(self.framelogprob[:, :], self.log_transmat[:, :, :], alphas, betas)
+        # Engine 1 is scaled probability space forward backward
+        if self.sum_product_engine == 1:
+            self._update_p_cn_scaled()
+            self._update_p_cn_elbo_terms()
+            return
 
-        assert not np.any(np.isnan(alphas))
-        assert not np.any(np.isnan(betas))
+        if self._hmm_precision == 1:
+            _update_p_cn_sum_product[np.float32_t](self, self.log_transmat, self.joint_posterior_marginals)
+        else:
+            _update_p_cn_sum_product[np.float64_t](self, self.log_transmat, self.joint_posterior_marginals)
 
-        self.hmm_log_norm_const = _logsum(alphas[-1, :])
+        self._update_p_cn_elbo_terms()
 
-        for n in range(self.num_segments):
-            log_posterior_marginals[:] = alphas[n, :] + betas[n, :]
-            _exp_normalize(self.posterior_marginals[n, :], log_posterior_marginals)
+    cdef void _update_p_cn_elbo_terms(self) except *:
+        """ Update elbo terms dependent on the approximating HMM.
+        """
+
+        self._calculate_energy_likelihood()
+        self._calculate_energy_transition()
+        self._calculate_entropy_hmm()
+
+    cdef void _update_p_cn_scaled(self) except *:
+        """ Update the parameters of the approximating HMM in probability space.
+        """
+
+        transmat = np.exp(np.asarray(self.log_transmat, dtype=np.float64))
+        frameprob = np.empty((self.num_segments, self.num_cn_states))
+        alphas = np.empty((self.num_segments, self.num_cn_states))
+        betas = np.empty((self.num_segments, self.num_cn_states))
+        scales = np.empty((self.num_segments,))
+
+        transmat_idx = np.asarray(self.transmat_idx)
+
+        self.hmm_log_norm_const = sum_product_scaled(
+            np.asarray(self.framelogprob), transmat, transmat_idx, frameprob, alphas, betas, scales)
+
+        # Scaled alphas and betas give normalized posteriors directly
+        self.posterior_marginals = alphas * betas
 
         assert not np.any(np.isnan(self.posterior_marginals))
 
+        joint_posterior_marginals = np.zeros((self.num_transmats, self.num_cn_states, self.num_cn_states))
+        forward = frameprob[1:] * betas[1:] / scales[1:, np.newaxis]
+
         for n in range(self.num_segments - 1):
-            for s in range(self.num_cn_states):
-                for s_ in range(self.num_cn_states):
-                    log_joint_posterior_marginals[s, s_] = (alphas[n, s] + self.log_transmat[n, s, s_]
-                        + self.framelogprob[n + 1, s_] + betas[n + 1, s_])
+            joint_posterior_marginals[transmat_idx[n]] += transmat[transmat_idx[n]] * np.outer(alphas[n], forward[n])
 
-            _exp_normalize2(self.joint_posterior_marginals[n, :, :], log_joint_posterior_marginals)
+        self.joint_posterior_marginals[:] = joint_posterior_marginals
 
         assert not np.any(np.isnan(self.joint_posterior_marginals))
 
@@ -966,7 +1571,7 @@ cdef class RemixtModel:
             for m in range(self.num_clones):
                 self.add_log_breakpoint_p_expectation_cn(
                     log_p_breakpoint[self.breakpoint_idx[n], :],
-                    self.joint_posterior_marginals[n, :, :],
+                    np.asarray(self.joint_posterior_marginals[self.transmat_idx[n]], dtype=np.float64),
                     n, m, self.breakpoint_orient[n],
                     -self.transition_penalty)
 
@@ -975,62 +1580,181 @@ cdef class RemixtModel:
 
         self.calculate_log_transmat(self.cached_log_transmat)
 
+        self._calculate_energy_transition()
+
     cpdef void update_p_outlier_total(self) except *:
         """ Update the total read count outlier indicator approximating distributions.
         """
 
-        cdef np.ndarray[np.float64_t, ndim=1] log_p_outlier_total = np.zeros((2,))
+        cdef int n, j, s
+        cdef np.float64_t log_p_0, log_p_1
+        cdef np.float64_t energy_total = 0.
 
-        for n in range(self.num_segments):
-            log_p_outlier_total[0] = log(1. - self.prior_outlier_total)
-            log_p_outlier_total[1] = log(self.prior_outlier_total)
+        self.update_log_likelihood()
 
-            for s in range(self.num_cn_states):
-                for u in range(2):
-                    log_p_outlier_total[u] += (
-                        self.posterior_marginals[n, s] *
-                        self.calculate_log_likelihood_total(n, s, u))
+        with nogil:
+            for n in prange(self.num_segments, num_threads=self.num_threads, schedule='static'):
+                log_p_0 = log(1. - self.prior_outlier_total)
+                log_p_1 = log(self.prior_outlier_total)
+
+                for j in range(self.state_offsets[n], self.state_offsets[n + 1]):
+                    s = self.state_idx[j]
+                    log_p_0 = log_p_0 + self.posterior_marginals[n, s] * self.log_likelihood_total[n, s, 0]
+                    log_p_1 = log_p_1 + self.posterior_marginals[n, s] * self.log_likelihood_total[n, s, 1]
+
+                _exp_normalize_row(self.p_outlier_total, n, log_p_0, log_p_1)
 
-            _exp_normalize(self.p_outlier_total[n, :], log_p_outlier_total)
+                # Total likelihood and outlier prior energy
+                energy_total += self.p_outlier_total[n, 0] * log_p_0 + self.p_outlier_total[n, 1] * log_p_1
+
+        self._energy_total = energy_total
+        self._energy_total_valid = True
 
     cpdef void update_p_outlier_allele(self) except *:
         """ Update the allele read count outlier indicator approximating distributions.
         """
-        cdef int n, s, v, w
-        cdef np.ndarray[np.float64_t, ndim=1] log_p_outlier_allele = np.zeros((2,))
+        cdef int n, j, s, w
+        cdef np.float64_t log_p_0, log_p_1
+        cdef np.float64_t energy_allele = 0.
 
-        for n in range(self.num_segments):
-            log_p_outlier_allele[0] = log(1. - self.prior_outlier_allele)
-            log_p_outlier_allele[1] = log(self.prior_outlier_allele)
+        self.update_log_likelihood()
 
-            for s in range(self.num_cn_states):
-                for v in range(2):
+        with nogil:
+            for n in prange(self.num_segments, num_threads=self.num_threads, schedule='static'):
+                log_p_0 = log(1. - self.prior_outlier_allele)
+                log_p_1 = log(self.prior_outlier_allele)
+
+                for j in range(self.state_offsets[n], self.state_offsets[n + 1]):
+                    s = self.state_idx[j]
                     for w in range(2):
-                        log_p_outlier_allele[v] += (
+                        log_p_0 = log_p_0 + (
                             self.p_allele_swap[n, w] *
                             self.posterior_marginals[n, s] *
-                            self.calculate_log_likelihood_allele(n, s, v, w))
+                            self.log_likelihood_allele[n, s, 0, w])
+                        log_p_1 = log_p_1 + (
+                            self.p_allele_swap[n, w] *
+                            self.posterior_marginals[n, s] *
+                            self.log_likelihood_allele[n, s, 1, w])
+
+                _exp_normalize_row(self.p_outlier_allele, n, log_p_0, log_p_1)
 
-            _exp_normalize(self.p_outlier_allele[n, :], log_p_outlier_allele)
+                # Allele likelihood and outlier prior energy
+                energy_allele += self.p_outlier_allele[n, 0] * log_p_0 + self.p_outlier_allele[n, 1] * log_p_1
+
+        self._energy_allele = energy_allele
+        self._energy_allele_valid = True
 
     cpdef void update_p_allele_swap(self) except *:
         """ Update the allele swap indicator approximating distributions.
         """
 
-        cdef np.ndarray[np.float64_t, ndim=1] log_p_allele_swap = np.zeros((2,))
+        cdef int n, j, s, v
+        cdef np.float64_t log_p_0, log_p_1
+        cdef np.float64_t energy_allele = 0.
+        cdef np.float64_t log_prior_0 = log(1. - self.prior_outlier_allele)
+        cdef np.float64_t log_prior_1 = log(self.prior_outlier_allele)
 
-        for n in range(self.num_segments):
-            log_p_allele_swap[:] = 0.
+        self.update_log_likelihood()
 
-            for s in range(self.num_cn_states):
-                for v in range(2):
-                    for w in range(2):
-                        log_p_allele_swap[w] += (
+        with nogil:
+            for n in prange(self.num_segments, num_threads=self.num_threads, schedule='static'):
+                log_p_0 = 0.
+                log_p_1 = 0.
+
+                for j in range(self.state_offsets[n], self.state_offsets[n + 1]):
+                    s = self.state_idx[j]
+                    for v in range(2):
+                        log_p_0 = log_p_0 + (
                             self.p_outlier_allele[n, v] *
                             self.posterior_marginals[n, s] *
-                            self.calculate_log_likelihood_allele(n, s, v, w))
+                            self.log_likelihood_allele[n, s, v, 0])
+                        log_p_1 = log_p_1 + (
+                            self.p_outlier_allele[n, v] *
+                            self.posterior_marginals[n, s] *
+                            self.log_likelihood_allele[n, s, v, 1])
+
+                _exp_normalize_row(self.p_allele_swap, n, log_p_0, log_p_1)
+
+                # Allele likelihood and outlier prior energy
+                energy_allele += (
+                    self.p_allele_swap[n, 0] * log_p_0 + self.p_allele_swap[n, 1] * log_p_1 +
+                    self.p_outlier_allele[n, 0] * log_prior_0 + self.p_outlier_allele[n, 1] * log_prior_1)
+
+        self._energy_allele = energy_allele
+        self._energy_allele_valid = True
 
-            _exp_normalize(self.p_allele_swap[n, :], log_p_allele_swap)
+    cpdef void update_p_indicators(self) except *:
+        """ Update the outlier and allele swap indicator approximating distributions
+        in a single pass over segments.
+
+        Equivalent to update_p_outlier_total, update_p_outlier_allele and
+        update_p_allele_swap in sequence, as the indicators of each segment
+        depend only on the posterior marginals and likelihoods of that
+        segment, which are contracted once per segment.
+        """
+
+        cdef int n, j, s
+        cdef np.float64_t ll_total_0, ll_total_1
+        cdef np.float64_t ll_allele_00, ll_allele_01, ll_allele_10, ll_allele_11
+        cdef np.float64_t log_p_0, log_p_1
+        cdef np.float64_t energy_total = 0.
+        cdef np.float64_t energy_allele = 0.
+        cdef np.float64_t log_prior_total_0 = log(1. - self.prior_outlier_total)
+        cdef np.float64_t log_prior_total_1 = log(self.prior_outlier_total)
+        cdef np.float64_t log_prior_allele_0 = log(1. - self.prior_outlier_allele)
+        cdef np.float64_t log_prior_allele_1 = log(self.prior_outlier_allele)
+
+        self.update_log_likelihood()
+
+        with nogil:
+            for n in prange(self.num_segments, num_threads=self.num_threads, schedule='static'):
+
+                # Expected likelihoods of each indicator state
+                ll_total_0 = 0.
+                ll_total_1 = 0.
+                ll_allele_00 = 0.
+                ll_allele_01 = 0.
+                ll_allele_10 = 0.
+                ll_allele_11 = 0.
+
+                for j in range(self.state_offsets[n], self.state_offsets[n + 1]):
+                    s = self.state_idx[j]
+                    ll_total_0 = ll_total_0 + self.posterior_marginals[n, s] * self.log_likelihood_total[n, s, 0]
+                    ll_total_1 = ll_total_1 + self.posterior_marginals[n, s] * self.log_likelihood_total[n, s, 1]
+                    ll_allele_00 = ll_allele_00 + self.posterior_marginals[n, s] * self.log_likelihood_allele[n, s, 0, 0]
+                    ll_allele_01 = ll_allele_01 + self.posterior_marginals[n, s] * self.log_likelihood_allele[n, s, 0, 1]
+                    ll_allele_10 = ll_allele_10 + self.posterior_marginals[n, s] * self.log_likelihood_allele[n, s, 1, 0]
+                    ll_allele_11 = ll_allele_11 + self.posterior_marginals[n, s] * self.log_likelihood_allele[n, s, 1, 1]
+
+                # Total read count outlier indicator
+                log_p_0 = log_prior_total_0 + ll_total_0
+                log_p_1 = log_prior_total_1 + ll_total_1
+
+                _exp_normalize_row(self.p_outlier_total, n, log_p_0, log_p_1)
+
+                energy_total += self.p_outlier_total[n, 0] * log_p_0 + self.p_outlier_total[n, 1] * log_p_1
+
+                # Allele read count outlier indicator
+                log_p_0 = log_prior_allele_0 + self.p_allele_swap[n, 0] * ll_allele_00 + self.p_allele_swap[n, 1] * ll_allele_01
+                log_p_1 = log_prior_allele_1 + self.p_allele_swap[n, 0] * ll_allele_10 + self.p_allele_swap[n, 1] * ll_allele_11
+
+                _exp_normalize_row(self.p_outlier_allele, n, log_p_0, log_p_1)
+
+                # Allele swap indicator
+                log_p_0 = self.p_outlier_allele[n, 0] * ll_allele_00 + self.p_outlier_allele[n, 1] * ll_allele_10
+                log_p_1 = self.p_outlier_allele[n, 0] * ll_allele_01 + self.p_outlier_allele[n, 1] * ll_allele_11
+
+                _exp_normalize_row(self.p_allele_swap, n, log_p_0, log_p_1)
+
+                # Allele likelihood and outlier prior energy
+                energy_allele += (
+                    self.p_allele_swap[n, 0] * log_p_0 + self.p_allele_swap[n, 1] * log_p_1 +
+                    self.p_outlier_allele[n, 0] * log_prior_allele_0 + self.p_outlier_allele[n, 1] * log_prior_allele_1)
+
+        self._energy_total = energy_total
+        self._energy_total_valid = True
+        self._energy_allele = energy_allele
+        self._energy_allele_valid = True
 
     cpdef np.float64_t calculate_variational_entropy(self) except *:
         """ Calculate the entropy of the approximating distribution.
@@ -1038,9 +1762,9 @@ cdef class RemixtModel:
 
         cdef np.float64_t entropy = 0.
 
-        entropy += -np.sum(self.hmm_log_norm_const)
-        entropy += np.sum(np.asarray(self.posterior_marginals) * np.asarray(self.framelogprob))
-        entropy += np.sum(np.asarray(self.joint_posterior_marginals) * np.asarray(self.log_transmat))
+        self._calculate_entropy_hmm()
+
+        entropy += self._entropy_hmm
         entropy += _entropy(np.asarray(self.p_breakpoint).flatten())
         entropy += _entropy(np.asarray(self.p_outlier_total).flatten())
         entropy += _entropy(np.asarray(self.p_outlier_allele).flatten())
@@ -1048,102 +1772,192 @@ cdef class RemixtModel:
 
         return entropy
 
+    cdef void _calculate_entropy_hmm(self) except *:
+        """ Calculate the negative entropy of the approximating HMM from the log
+        normalization constant, framelogprob and log_transmat of the update.
+        """
+
+        cdef int n, j, s
+        cdef np.float64_t energy_frame = 0.
+
+        # Framelogprob is -inf for states that are not candidates
+        for n in range(self.num_segments):
+            for j in range(self.state_offsets[n], self.state_offsets[n + 1]):
+                s = self.state_idx[j]
+                energy_frame += self.posterior_marginals[n, s] * self.framelogprob[n, s]
+
+        self._entropy_hmm = (
+            -self.hmm_log_norm_const +
+            energy_frame +
+            self._sum_transmat_product(self.joint_posterior_marginals, self.log_transmat))
+        self._entropy_hmm_valid = True
+
     cpdef np.float64_t calculate_variational_energy(self) except *:
         """ Calculate the expectation of the true distribution wrt the
         approximating distribution.
         """
 
-        cdef int n, s, s_, u, v, w
-        cdef np.float64_t energy = 0.
-        
-        # Prior factor
-        for n in range(self.num_segments):
-            for s in range(self.num_cn_states):
-                energy += (
-                    self.posterior_marginals[n, s] *
-                    self.calculate_log_prior_cn(n, s))
+        self._calculate_energy_likelihood()
+        self._calculate_energy_transition()
 
-        # Total likelihood factors
-        for n in range(self.num_segments):
-            for s in range(self.num_cn_states):
-                for u in range(2):
-                    energy += (
-                        self.posterior_marginals[n, s] *
-                        self.p_outlier_total[n, u] *
-                        self.calculate_log_likelihood_total(n, s, u))
+        return self._energy_prior + self._energy_total + self._energy_allele + self._energy_transition
 
-            energy += (
-                self.p_outlier_total[n, 0] *
-                log(1. - self.prior_outlier_total))
+    cdef void _calculate_energy_likelihood(self) except *:
+        """ Calculate the prior and likelihood factor energy terms.
+        """
 
-            energy += (
-                self.p_outlier_total[n, 1] *
-                log(self.prior_outlier_total))
+        cdef int n, j, s, u, v, w
+        cdef np.float64_t energy_prior = 0.
+        cdef np.float64_t energy_total = 0.
+        cdef np.float64_t energy_allele = 0.
+        cdef np.float64_t log_prior_total_0 = log(1. - self.prior_outlier_total)
+        cdef np.float64_t log_prior_total_1 = log(self.prior_outlier_total)
+        cdef np.float64_t log_prior_allele_0 = log(1. - self.prior_outlier_allele)
+        cdef np.float64_t log_prior_allele_1 = log(self.prior_outlier_allele)
 
-        # Allele likelihood factors
-        for n in range(self.num_segments):
-            for s in range(self.num_cn_states):
-                for v in range(2):
-                    for w in range(2):
-                        energy += (
-                            self.posterior_marginals[n, s] *
-                            self.p_outlier_allele[n, v] *
-                            self.p_allele_swap[n, w] *
-                            self.calculate_log_likelihood_allele(n, s, v, w))
+        self.update_log_likelihood()
 
-            energy += (
-                self.p_outlier_allele[n, 0] *
-                log(1. - self.prior_outlier_allele))
+        with nogil:
+            for n in prange(self.num_segments, num_threads=self.num_threads, schedule='static'):
 
-            energy += (
-                self.p_outlier_allele[n, 1] *
-                log(self.prior_outlier_allele))
+                # Prior factor
+                for j in range(self.state_offsets[n], self.state_offsets[n + 1]):
+                    s = self.state_idx[j]
+                    energy_prior += (
+                        self.posterior_marginals[n, s] *
+                        self._log_prior_cn(n, s))
 
-        # Transitions factor
-        for n in range(0, self.num_segments - 1):
-            for s in range(self.num_cn_states):
-                for s_ in range(self.num_cn_states):
-                    energy += self.joint_posterior_marginals[n, s, s_] * self.cached_log_transmat[n, s, s_]
+                # Total likelihood factors
+                for j in range(self.state_offsets[n], self.state_offsets[n + 1]):
+                    s = self.state_idx[j]
+                    for u in range(2):
+                        energy_total += (
+                            self.posterior_marginals[n, s] *
+                            self.p_outlier_total[n, u] *
+                            self.log_likelihood_total[n, s, u])
+
+                energy_total += (
+                    self.p_outlier_total[n, 0] * log_prior_total_0 +
+                    self.p_outlier_total[n, 1] * log_prior_total_1)
+
+                # Allele likelihood factors
+                for j in range(self.state_offsets[n], self.state_offsets[n + 1]):
+                    s = self.state_idx[j]
+                    for v in range(2):
+                        for w in range(2):
+                            energy_allele += (
+                                self.posterior_marginals[n, s] *
+                                self.p_outlier_allele[n, v] *
+                                self.p_allele_swap[n, w] *
+                                self.log_likelihood_allele[n, s, v, w])
+
+                energy_allele += (
+                    self.p_outlier_allele[n, 0] * log_prior_allele_0 +
+                    self.p_outlier_allele[n, 1] * log_prior_allele_1)
+
+        self._energy_prior = energy_prior
+        self._energy_total = energy_total
+        self._energy_allele = energy_allele
+        self._energy_prior_valid = True
+        self._energy_total_valid = True
+        self._energy_allele_valid = True
+
+    cdef np.float64_t _sum_transmat_product(self, np.ndarray a, np.ndarray b) except *:
+        """ Sum of the elementwise product of two transition shaped arrays
+        stored in the hmm precision, accumulated in double precision.
+        """
 
-        return energy
+        if self._hmm_precision == 1:
+            return _sum_product_terms[np.float32_t](a, b)
+        else:
+            return _sum_product_terms[np.float64_t](a, b)
+
+    cdef void _calculate_energy_transition(self) except *:
+        """ Calculate the transitions factor energy term.
+        """
+
+        # Joint posteriors summed over adjacencies sharing a transition matrix
+        self._energy_transition = self._sum_transmat_product(self.joint_posterior_marginals, self.cached_log_transmat)
+        self._energy_transition_valid = True
 
     cpdef np.float64_t calculate_elbo(self) except *:
         """ Calculate the evidence lower bound.
+
+        Energy and HMM entropy terms calculated by the most recent variational
+        updates are reused, and only terms invalidated by changes to the
+        likelihood are recalculated.
         """
 
-        return self.calculate_variational_energy() - self.calculate_variational_entropy()
+        cdef np.float64_t energy
+        cdef np.float64_t entropy
+
+        self.update_log_likelihood()
+
+        if not (self._energy_prior_valid and self._energy_total_valid and self._energy_allele_valid):
+            self._calculate_energy_likelihood()
+
+        if not self._energy_transition_valid:
+            self._calculate_energy_transition()
+
+        if not self._entropy_hmm_valid:
+            self._calculate_entropy_hmm()
+
+        energy = self._energy_prior + self._energy_total + self._energy_allele + self._energy_transition
+
+        entropy = self._entropy_hmm
+        entropy += _entropy(np.asarray(self.p_breakpoint).flatten())
+        entropy += _entropy(np.asarray(self.p_outlier_total).flatten())
+        entropy += _entropy(np.asarray(self.p_outlier_allele).flatten())
+        entropy += _entropy(np.asarray(self.p_allele_swap).flatten())
+
+        return energy - entropy
 
     cpdef np.float64_t calculate_expected_log_likelihood(self, np.int64_t[:] sample) except *:
         """ Calculate the expectation of the log likelihood wrt the
         approximating distribution.
         """
 
-        cdef int n, s, s_, u, v
+        cdef int n, j, s, u, v, w
         cdef np.float64_t energy = 0.
-        
+        cdef np.float64_t ll
+
+        # Cached likelihoods are used if valid, otherwise likelihoods of the
+        # sampled segments are calculated without updating the cache, as
+        # when optimizing parameters on a sample of segments
+
         # Total likelihood factors
         for n in range(self.num_segments):
             if sample[n] == 0:
                 continue
-            for s in range(self.num_cn_states):
+            for j in range(self.state_offsets[n], self.state_offsets[n + 1]):
+                s = self.state_idx[j]
                 for u in range(2):
+                    if self._likelihood_valid:
+                        ll = self.log_likelihood_total[n, s, u]
+                    else:
+                        ll = self.calculate_log_likelihood_total(n, s, u)
                     energy += (
                         self.posterior_marginals[n, s] *
                         self.p_outlier_total[n, u] *
-                        self.calculate_log_likelihood_total(n, s, u))
+                        ll)
 
         # Allele likelihood factors
         for n in range(self.num_segments):
             if sample[n] == 0:
                 continue
-            for s in range(self.num_cn_states):
+            for j in range(self.state_offsets[n], self.state_offsets[n + 1]):
+                s = self.state_idx[j]
                 for v in range(2):
                     for w in range(2):
+                        if self._likelihood_valid:
+                            ll = self.log_likelihood_allele[n, s, v, w]
+                        else:
+                            ll = self.calculate_log_likelihood_allele(n, s, v, w)
                         energy += (
                             self.posterior_marginals[n, s] *
                             self.p_outlier_allele[n, v] *
                             self.p_allele_swap[n, w] *
-                            self.calculate_log_likelihood_allele(n, s, v, w))
+                            ll)
 
         return energy
 
@@ -1152,7 +1966,7 @@ cdef class RemixtModel:
         approximating distribution.
         """
 
-        cdef int n, m, s, s_, u, v
+        cdef int n, m, j, s, u, v, w
         cdef np.ndarray[np.float64_t, ndim=1] segment_ll_partial_h = np.zeros((self.num_clones,))
         
         partial_h[:] = 0.
@@ -1161,7 +1975,8 @@ cdef class RemixtModel:
         for n in range(self.num_segments):
             if sample[n] == 0:
                 continue
-            for s in range(self.num_cn_states):
+            for j in range(self.state_offsets[n], self.state_offsets[n + 1]):
+                s = self.state_idx[j]
                 for u in range(2):
                     self.calculate_log_likelihood_total_partial_h(n, s, u, segment_ll_partial_h)
                     for m in range(self.num_clones):
@@ -1174,7 +1989,8 @@ cdef class RemixtModel:
         for n in range(self.num_segments):
             if sample[n] == 0:
                 continue
-            for s in range(self.num_cn_states):
+            for j in range(self.state_offsets[n], self.state_offsets[n + 1]):
+                s = self.state_idx[j]
                 for v in range(2):
                     for w in range(2):
                         self.calculate_log_likelihood_allele_partial_h(n, s, v, w, segment_ll_partial_h)
@@ -1185,62 +2001,466 @@ cdef class RemixtModel:
                                 self.p_allele_swap[n, w] *
                                 segment_ll_partial_h[m])
 
+    cpdef void set_likelihood_sample(self, np.int64_t[:] sample) except *:
+        """ Contract the approximating distribution for sampled segments.
+
+        Posterior marginals and indicator distributions of sampled segments are
+        contracted to the weight of each likelihood term of each segment and
+        state, for repeated calculation of the expected log likelihood as h
+        or likelihood parameters are optimized.  States with posterior below
+        sample_min_posterior are omitted.
+        """
+
+        posterior_marginals = np.asarray(self.posterior_marginals)
+        p_outlier_total = np.asarray(self.p_outlier_total)
+        p_outlier_allele = np.asarray(self.p_outlier_allele)
+        p_allele_swap = np.asarray(self.p_allele_swap)
+
+        is_sampled = (np.asarray(sample) != 0)[:, np.newaxis]
+        is_weighted = (posterior_marginals > 0.) & (posterior_marginals >= self.sample_min_posterior)
+        sample_segment, sample_state = np.where(is_sampled & is_weighted)
+
+        q = posterior_marginals[sample_segment, sample_state]
+
+        self._sample_segment = sample_segment.astype(np.int64)
+        self._sample_state = sample_state.astype(np.int64)
+        self._sample_weight_total = q[:, np.newaxis] * p_outlier_total[sample_segment, :]
+        self._sample_weight_allele = (
+            q[:, np.newaxis, np.newaxis] *
+            p_outlier_allele[sample_segment, :, np.newaxis] *
+            p_allele_swap[sample_segment, np.newaxis, :])
+
+    cpdef np.float64_t calculate_sample_expected_log_likelihood(self) except *:
+        """ Calculate the expectation of the log likelihood of segments sampled by
+        set_likelihood_sample.
+        """
+
+        cdef int k, n, s, u, v, w
+        cdef np.float64_t energy = 0.
+        cdef np.float64_t ll
+
+        for k in range(self._sample_segment.shape[0]):
+            n = self._sample_segment[k]
+            s = self._sample_state[k]
+
+            for u in range(2):
+                ll = self._log_likelihood_total(n, s, u)
+                if isnan(ll):
+                    self.calculate_log_likelihood_total(n, s, u)
+                energy += self._sample_weight_total[k, u] * ll
+
+            for v in range(2):
+                for w in range(2):
+                    ll = self._log_likelihood_allele(n, s, v, w)
+                    if isnan(ll):
+                        self.calculate_log_likelihood_allele(n, s, v, w)
+                    energy += self._sample_weight_allele[k, v, w] * ll
+
+        return energy
+
+    cpdef void calculate_sample_expected_log_likelihood_partial_h(self, np.float64_t[:] partial_h) except *:
+        """ Calculate the partial derivative wrt h of the expectation of the log
+        likelihood of segments sampled by set_likelihood_sample.
+        """
+
+        cdef int k, n, m, s, u, v, w
+        cdef np.float64_t[:] segment_ll_partial_h = np.zeros((self.num_clones,))
+
+        partial_h[:] = 0.
+
+        for k in range(self._sample_segment.shape[0]):
+            n = self._sample_segment[k]
+            s = self._sample_state[k]
+
+            for u in range(2):
+                self.calculate_log_likelihood_total_partial_h(n, s, u, segment_ll_partial_h)
+                for m in range(self.num_clones):
+                    partial_h[m] += self._sample_weight_total[k, u] * segment_ll_partial_h[m]
+
+            for v in range(2):
+                for w in range(2):
+                    self.calculate_log_likelihood_allele_partial_h(n, s, v, w, segment_ll_partial_h)
+                    for m in range(self.num_clones):
+                        partial_h[m] += self._sample_weight_allele[k, v, w] * segment_ll_partial_h[m]
+
+    cpdef np.float64_t calculate_sample_expected_log_likelihood_partial_param(self, name) except *:
+        """ Calculate the partial derivative wrt the named likelihood parameter of
+        the expectation of the log likelihood of segments sampled by
+        set_likelihood_sample.
+        """
+
+        cdef int k, n, s, u, v, w
+        cdef np.float64_t partial = 0.
+        cdef np.float64_t mu, r, p, p_sign, M, allelic_readcount, minor_readcount
+        cdef int is_total_param, is_hdel_mu, is_hdel_r, is_loh_p, is_loh_M
+        cdef int param_idx = -1
+
+        if name not in (
+                'negbin_r_0', 'negbin_r_1',
+                'betabin_M_0', 'betabin_M_1',
+                'negbin_hdel_mu',
+                'negbin_hdel_r_0', 'negbin_hdel_r_1',
+                'betabin_loh_p',
+                'betabin_loh_M_0', 'betabin_loh_M_1'):
+            raise ValueError('unknown likelihood parameter {}'.format(name))
+
+        is_total_param = name.startswith('negbin')
+        is_hdel_mu = name == 'negbin_hdel_mu'
+        is_hdel_r = name.startswith('negbin_hdel_r')
+        is_loh_p = name == 'betabin_loh_p'
+        is_loh_M = name.startswith('betabin_loh_M')
+        if name.endswith('_0'):
+            param_idx = 0
+        elif name.endswith('_1'):
+            param_idx = 1
+
+        for k in range(self._sample_segment.shape[0]):
+            n = self._sample_segment[k]
+            s = self._sample_state[k]
+
+            if is_total_param:
+                if self._total_likelihood_mask[n] == 0:
+                    continue
+
+                for u in range(2):
+                    if not self.normal_contamination and self.is_hdel[self.state_class[n], s] == 1:
+                        if not (is_hdel_mu or is_hdel_r):
+                            continue
+
+                        mu = self._negbin_hdel_mu
+
+                        if u == 0:
+                            r = self._negbin_hdel_r_0
+                        else:
+                            r = self._negbin_hdel_r_1
+
+                        if is_hdel_mu:
+                            partial += self._sample_weight_total[k, u] * negbin_log_likelihood_partial_mu(self._x[n], mu, r)
+                        elif u == param_idx:
+                            partial += self._sample_weight_total[k, u] * negbin_log_likelihood_partial_r(self._x[n], mu, r)
+
+                    else:
+                        if is_hdel_mu or is_hdel_r or u != param_idx:
+                            continue
+
+                        mu = self._expected_total_reads(n, s)
+
+                        if u == 0:
+                            r = self._negbin_r_0
+                        else:
+                            r = self._negbin_r_1
+
+                        partial += self._sample_weight_total[k, u] * negbin_log_likelihood_partial_r(self._x[n], mu, r)
+
+            else:
+                if self._allele_likelihood_mask[n] == 0:
+                    continue
+
+                allelic_readcount = self._y[n, 0] + self._y[n, 1]
+
+                if allelic_readcount == 0:
+                    continue
+
+                if self.is_hdel[self.state_class[n], s] == 1:
+                    p = 0.
+                else:
+                    p = self.calculate_expected_allele_ratio(n, s)
+
+                if not self.normal_contamination and self.is_loh[self.state_class[n], s] == 1:
+                    if not (is_loh_p or is_loh_M):
+                        continue
+
+                    if p == 0.:
+                        p = self._betabin_loh_p
+                        p_sign = 1.
+                    elif p == 1.:
+                        p = 1. - self._betabin_loh_p
+                        p_sign = -1.
+                    else:
+                        raise ValueError('expected p {} for loh state {}'.format(p, s))
+
+                else:
+                    if is_loh_p or is_loh_M:
+                        continue
+
+                for v in range(2):
+                    if not is_loh_p and v != param_idx:
+                        continue
+
+                    if is_loh_p or is_loh_M:
+                        if v == 0:
+                            M = self._betabin_loh_M_0
+                        else:
+                            M = self._betabin_loh_M_1
+                    else:
+                        if v == 0:
+                            M = self._betabin_M_0
+                        else:
+                            M = self._betabin_M_1
+
+                    for w in range(2):
+                        if w == 0:
+                            minor_readcount = self._y[n, 0]
+                        else:
+                            minor_readcount = self._y[n, 1]
+
+                        if is_loh_p:
+                            partial += self._sample_weight_allele[k, v, w] * p_sign * betabin_log_likelihood_partial_p(
+                                minor_readcount, allelic_readcount, p, M)
+                        else:
+                            partial += self._sample_weight_allele[k, v, w] * betabin_log_likelihood_partial_M(
+                                minor_readcount, allelic_readcount, p, M)
+
+        return partial
+
     cpdef void infer_cn(self, np.ndarray[np.int64_t, ndim=3] cn) except *:
         """ Infer optimal copy number state sequence.
         """
         cdef int n, m, ell
         cdef np.ndarray[np.int64_t, ndim=1] state_sequence = np.zeros((self.num_segments,), dtype=np.int64)
 
-        max_product(self.framelogprob[:, :], self.log_transmat[:, :, :], state_sequence)
+        max_product(self.framelogprob[:, :], np.asarray(self.log_transmat, dtype=np.float64), self.transmat_idx, state_sequence)
 
         for n in range(self.num_segments):
             for m in range(self.num_clones):
                 for ell in range(self.num_alleles):
                     if self.p_allele_swap[n, 1] > self.p_allele_swap[n, 0]:
                         ell = 1 - ell
-                    cn[n, m, ell] = self.cn_states[n, state_sequence[n], m, ell]
+                    cn[n, m, ell] = self.cn_states[self.state_class[n], state_sequence[n], m, ell]
+
+
+cdef void _update_p_cn_sum_product(
+        RemixtModel model,
+        transmat_t[:, :, :] log_transmat,
+        transmat_t[:, :, :] joint_posterior_marginals) except *:
+    """ Update posterior marginals and joint posterior marginals of the
+    approximating HMM by forward backward, with transition matrices and joint
+    posterior marginals stored in the precision of transmat_t.
+    """
+
+    cdef np.float64_t[:, :] alphas = np.full((model.num_segments, model.num_cn_states), -np.inf)
+    cdef np.float64_t[:, :] betas = np.full((model.num_segments, model.num_cn_states), -np.inf)
+
+    cdef int num_threads = max(model.num_threads, 1)
+    cdef int num_chains = model.chain_start.shape[0] - 1
+    cdef int c, n, i, j, j_, s, s_, t, num_states, num_states_
+    cdef np.float64_t normalize
+
+    # Scratch buffers and shared matrix joint marginal accumulators for each thread
+    cdef np.float64_t[:, :] work_buffer = np.zeros((num_threads, model.num_cn_states))
+    cdef np.float64_t[:, :, :] log_joint_posterior_marginals = np.zeros((num_threads, model.num_cn_states, model.num_cn_states))
+    cdef np.float64_t[:, :, :, :] shared_joint_posterior_marginals = np.zeros((num_threads, model.num_shared_transmats, model.num_cn_states, model.num_cn_states))
+
+    # Chains between telomeres are independent, run forward backward on each
+    with nogil:
+        for c in prange(num_chains, num_threads=num_threads, schedule='dynamic'):
+            _sum_product_range(
+                model.framelogprob, log_transmat, model.transmat_idx,
+                model.state_offsets, model.state_idx, alphas, betas,
+                work_buffer[threadid(), :], model.chain_start[c], model.chain_start[c + 1])
+
+    assert not np.any(np.isnan(alphas))
+    assert not np.any(np.isnan(betas))
+
+    model.hmm_log_norm_const = 0.
+    for c in range(num_chains):
+        model.hmm_log_norm_const += _logsum(alphas[model.chain_start[c + 1] - 1, :])
+
+    with nogil:
+        for n in prange(model.num_segments, num_threads=num_threads, schedule='static'):
+            t = threadid()
+
+            for s in range(model.num_cn_states):
+                work_buffer[t, s] = _NINF
+
+            for j in range(model.state_offsets[n], model.state_offsets[n + 1]):
+                s = model.state_idx[j]
+                work_buffer[t, s] = alphas[n, s] + betas[n, s]
+
+            _exp_normalize(model.posterior_marginals[n, :], work_buffer[t, :])
+
+    assert not np.any(np.isnan(model.posterior_marginals))
+
+    # Joint marginals of shared matrices are summed per thread, breakpoint
+    # matrices are specific to one adjacency and are written directly,
+    # both calculated for pairs of candidate states indexed from the
+    # start of the candidates of each segment
+    with nogil:
+        for n in prange(model.num_segments - 1, num_threads=num_threads, schedule='static'):
+            t = threadid()
+            i = model.transmat_idx[n]
+            num_states = model.state_offsets[n + 1] - model.state_offsets[n]
+            num_states_ = model.state_offsets[n + 2] - model.state_offsets[n + 1]
+
+            for j in range(model.state_offsets[n], model.state_offsets[n + 1]):
+                s = model.state_idx[j]
+                for j_ in range(model.state_offsets[n + 1], model.state_offsets[n + 2]):
+                    s_ = model.state_idx[j_]
+                    log_joint_posterior_marginals[t, j - model.state_offsets[n], j_ - model.state_offsets[n + 1]] = (
+                        alphas[n, s] + log_transmat[i, s, s_] + model.framelogprob[n + 1, s_] + betas[n + 1, s_])
+
+            normalize = _logsum2(log_joint_posterior_marginals[t, :num_states, :num_states_])
+
+            if i < model.num_shared_transmats:
+                for j in range(model.state_offsets[n], model.state_offsets[n + 1]):
+                    s = model.state_idx[j]
+                    for j_ in range(model.state_offsets[n + 1], model.state_offsets[n + 2]):
+                        s_ = model.state_idx[j_]
+                        shared_joint_posterior_marginals[t, i, s, s_] += exp(
+                            log_joint_posterior_marginals[t, j - model.state_offsets[n], j_ - model.state_offsets[n + 1]] - normalize)
+
+            else:
+                for s in range(model.num_cn_states):
+                    for s_ in range(model.num_cn_states):
+                        joint_posterior_marginals[i, s, s_] = 0.
+
+                for j in range(model.state_offsets[n], model.state_offsets[n + 1]):
+                    s = model.state_idx[j]
+                    for j_ in range(model.state_offsets[n + 1], model.state_offsets[n + 2]):
+                        s_ = model.state_idx[j_]
+                        joint_posterior_marginals[i, s, s_] = exp(
+                            log_joint_posterior_marginals[t, j - model.state_offsets[n], j_ - model.state_offsets[n + 1]] - normalize)
+
+    for i in range(model.num_shared_transmats):
+        for s in range(model.num_cn_states):
+            for s_ in range(model.num_cn_states):
+                normalize = 0.
+                for t in range(num_threads):
+                    normalize += shared_joint_posterior_marginals[t, i, s, s_]
+                joint_posterior_marginals[i, s, s_] = normalize
+
+    assert not np.any(np.isnan(joint_posterior_marginals))
+
+
+cdef np.float64_t _sum_product_terms(transmat_t[:, :, :] a, transmat_t[:, :, :] b) nogil:
+    """ Sum of the elementwise product of a and b in double precision.
+    """
+
+    cdef int i, s, s_
+    cdef np.float64_t result = 0.
+
+    for i in range(a.shape[0]):
+        for s in range(a.shape[1]):
+            for s_ in range(a.shape[2]):
+                result += <np.float64_t>a[i, s, s_] * <np.float64_t>b[i, s, s_]
+
+    return result
 
 
 cpdef void sum_product(
         np.float64_t[:, :] framelogprob,
         np.float64_t[:, :, :] log_transmat,
+        np.int64_t[:] transmat_idx,
         np.float64_t[:, :] alphas,
         np.float64_t[:, :] betas) except *:
     """ Sum product algorithm for chain topology distributions.
+
+    The transition from observation n to n + 1 is log_transmat[transmat_idx[n]].
     """
 
-    cdef int n, i, j
-    cdef np.ndarray[np.float64_t, ndim = 1] work_buffer
+    cdef np.float64_t[:] work_buffer = np.zeros((framelogprob.shape[1],))
+    cdef np.int64_t[:] state_offsets = np.arange(framelogprob.shape[0] + 1, dtype=np.int64) * framelogprob.shape[1]
+    cdef np.int64_t[:] state_idx = np.tile(np.arange(framelogprob.shape[1], dtype=np.int64), framelogprob.shape[0])
+
+    with nogil:
+        _sum_product_range(framelogprob, log_transmat, transmat_idx, state_offsets, state_idx,
+            alphas, betas, work_buffer, 0, framelogprob.shape[0])
+
+
+cdef void _sum_product_range(
+        np.float64_t[:, :] framelogprob,
+        transmat_t[:, :, :] log_transmat,
+        np.int64_t[:] transmat_idx,
+        np.int64_t[:] state_offsets,
+        np.int64_t[:] state_idx,
+        np.float64_t[:, :] alphas,
+        np.float64_t[:, :] betas,
+        np.float64_t[:] work_buffer,
+        int start,
+        int end) nogil:
+    """ Sum product over observations start to end - 1, treated as a separate chain.
+
+    Messages are calculated for the candidate states of each observation n,
+    state_idx[state_offsets[n]:state_offsets[n + 1]], and are not written for
+    other states.
+    """
+
+    cdef int n, i, j, a, b
+
+    for a in range(state_offsets[start], state_offsets[start + 1]):
+        i = state_idx[a]
+        alphas[start, i] = framelogprob[start, i]
+
+    for n in range(start + 1, end):
+        for b in range(state_offsets[n], state_offsets[n + 1]):
+            j = state_idx[b]
+            for a in range(state_offsets[n - 1], state_offsets[n]):
+                i = state_idx[a]
+                work_buffer[a - state_offsets[n - 1]] = alphas[n - 1, i] + log_transmat[transmat_idx[n - 1], i, j]
+            alphas[n, j] = _logsum(work_buffer[:state_offsets[n] - state_offsets[n - 1]]) + framelogprob[n, j]
+
+    for a in range(state_offsets[end - 1], state_offsets[end]):
+        i = state_idx[a]
+        betas[end - 1, i] = 0.0
+
+    for n in range(end - 2, start - 1, -1):
+        for a in range(state_offsets[n], state_offsets[n + 1]):
+            i = state_idx[a]
+            for b in range(state_offsets[n + 1], state_offsets[n + 2]):
+                j = state_idx[b]
+                work_buffer[b - state_offsets[n + 1]] = (log_transmat[transmat_idx[n], i, j] + framelogprob[n + 1, j]
+                    + betas[n + 1, j])
+            betas[n, i] = _logsum(work_buffer[:state_offsets[n + 2] - state_offsets[n + 1]])
+
+
+cpdef np.float64_t sum_product_scaled(
+        np.ndarray[np.float64_t, ndim=2] framelogprob,
+        np.ndarray[np.float64_t, ndim=3] transmat,
+        np.ndarray[np.int64_t, ndim=1] transmat_idx,
+        np.ndarray[np.float64_t, ndim=2] frameprob,
+        np.ndarray[np.float64_t, ndim=2] alphas,
+        np.ndarray[np.float64_t, ndim=2] betas,
+        np.ndarray[np.float64_t, ndim=1] scales) except *:
+    """ Scaled sum product algorithm for chain topology distributions.
+
+    The transition from observation n to n + 1 is transmat[transmat_idx[n]].
+    Messages are calculated in probability space as matrix vector products,
+    rescaled to sum to 1 at each step.  Frame probabilities are calculated
+    relative to the maximum of each frame.  The product of scaled alphas and
+    betas is the posterior marginal, and the log normalization constant is
+    returned.
+    """
+
+    cdef int n
 
     cdef int n_observations = framelogprob.shape[0]
-    cdef int n_components = framelogprob.shape[1]
 
-    work_buffer = np.zeros((n_components,))
+    cdef np.ndarray[np.float64_t, ndim=1] frame_max = framelogprob.max(axis=1)
+
+    frameprob[:] = np.exp(framelogprob - frame_max[:, np.newaxis])
 
-    for i in range(n_components):
-        alphas[0, i] = framelogprob[0, i]
+    alphas[0] = frameprob[0]
+    scales[0] = alphas[0].sum()
+    alphas[0] /= scales[0]
 
     for n in range(1, n_observations):
-        for j in range(n_components):
-            for i in range(n_components):
-                work_buffer[i] = alphas[n - 1, i] + log_transmat[n - 1, i, j]
-            alphas[n, j] = _logsum(work_buffer) + framelogprob[n, j]
+        alphas[n] = np.dot(alphas[n - 1], transmat[transmat_idx[n - 1]]) * frameprob[n]
+        scales[n] = alphas[n].sum()
+        alphas[n] /= scales[n]
 
-    for i in range(n_components):
-        betas[n_observations - 1, i] = 0.0
+    betas[n_observations - 1] = 1.
 
     for n in range(n_observations - 2, -1, -1):
-        for i in range(n_components):
-            for j in range(n_components):
-                work_buffer[j] = (log_transmat[n, i, j] + framelogprob[n + 1, j]
-                    + betas[n + 1, j])
-            betas[n, i] = _logsum(work_buffer)
+        betas[n] = np.dot(transmat[transmat_idx[n]], frameprob[n + 1] * betas[n + 1]) / scales[n + 1]
+
+    return np.log(scales).sum() + frame_max.sum()
 
 
 @cython.wraparound(True)
 cpdef np.float64_t max_product(
         np.float64_t[:, :] framelogprob,
         np.float64_t[:, :, :] log_transmat,
+        np.int64_t[:] transmat_idx,
         np.int64_t[:] state_sequence) except *:
 
     cdef int n, i, j
@@ -1261,7 +2481,7 @@ cpdef np.float64_t max_product(
     for n in range(1, n_observations):
         for j in range(n_components):
             for i in range(n_components):
-                work_buffer[i] = viterbi_lattice[n - 1, i] + log_transmat[n - 1, i, j]
+                work_buffer[i] = viterbi_lattice[n - 1, i] + log_transmat[transmat_idx[n - 1], i, j]
             viterbi_lattice[n, j] = _max(work_buffer) + framelogprob[n, j]
 
     # Observation traceback
@@ -1271,7 +2491,7 @@ cpdef np.float64_t max_product(
 
     for n in range(n_observations - 2, -1, -1):
         for i in range(n_components):
-            work_buffer[i] = viterbi_lattice[n, i] + log_transmat[n, i, state_sequence[n + 1]]
+            work_buffer[i] = viterbi_lattice[n, i] + log_transmat[transmat_idx[n], i, state_sequence[n + 1]]
         max_pos = _argmax(work_buffer)
         state_sequence[n] = max_pos
 
@@ -1,11 +1,14 @@
+import os
 import itertools
 import collections
 import numpy as np
 import pandas as pd
 import scipy.misc
+import scipy.optimize
 import pickle
 import contextlib
 import datetime
+import time
 import statsmodels.tools.numdiff
 
 import remixt.bpmodel
@@ -48,6 +51,10 @@ class BreakpointModel(object):
             transition_log_prob (float): penalty on transitions, per copy number change
             disable_breakpoints (bool): disable integrated breakpoint copy number inference
             normal_copies (numpy.array): germline copy number
+            cn_state_prune_threshold (float): log likelihood threshold for candidate copy number states, None for all states
+            fused_variational_update (bool): update outlier and allele swap indicators in a single pass
+            hmm_precision (int): storage of transition and joint marginal matrices, 0 for double, 1 for single
+            param_optimize_method (str): 'brute' for a grid search, 'brent' for a root search of the derivative
 
         """
         
@@ -68,6 +75,12 @@ class BreakpointModel(object):
         self.max_depth = kwargs.get('max_depth')
         self.transition_log_prob = kwargs.get('transition_log_prob', 10.)
         self.transition_model = kwargs.get('transition_model', 0)
+        self.sum_product_engine = kwargs.get('sum_product_engine', 0)
+        self.num_threads = kwargs.get('num_threads', 1)
+        self.cn_state_prune_threshold = kwargs.get('cn_state_prune_threshold', None)
+        self.fused_variational_update = kwargs.get('fused_variational_update', False)
+        self.hmm_precision = kwargs.get('hmm_precision', 0)
+        self.param_optimize_method = kwargs.get('param_optimize_method', 'brute')
         self.disable_breakpoints = kwargs.get('disable_breakpoints', False)
         self.breakpoint_init = kwargs.get('breakpoint_init', None)
         self.normal_copies = kwargs.get('normal_copies', np.array([[1, 1]] * self.N))
@@ -193,7 +206,17 @@ class BreakpointModel(object):
         self.prev_elbo = None
         self.prev_elbo_diff = None
         self.num_em_iter = 1
+        self.num_em_iter_completed = 0
+        self.elbo_abs_tol = None
+        self.elbo_rel_tol = None
+        self.converged = False
+        self.iter_stats = []
         self.num_update_iter = 1
+        self.param_search_step = np.log(2.)
+        self.param_search_xtol = 1e-3
+        self.num_param_evals = 0
+        self.checkpoint_filename = None
+        self.checkpoint_interval = None
         
         self.likelihood_params = [
             'negbin_r_0',
@@ -305,18 +328,120 @@ class BreakpointModel(object):
         for a in dir(self.model):
             if a in data:
                 setattr(self.model, a, data[a])
+        self.model.invalidate_likelihood()
+
+    def write_fit_state(self, state_filename):
+        """ Write the model and progress of the fit for resuming with read_fit_state.
+        """
+        data = self.get_model_data()
+        data['fit_state'] = {
+            'prev_elbo': self.prev_elbo,
+            'prev_elbo_diff': self.prev_elbo_diff,
+            'num_em_iter_completed': self.num_em_iter_completed,
+            'converged': self.converged,
+            'iter_stats': self.iter_stats,
+            'num_param_evals': self.num_param_evals,
+        }
+        with open(state_filename, 'w') as f:
+            pickle.dump(data, f)
+
+    def read_fit_state(self, h_init, state_filename):
+        """ Create the model and restore the progress of a fit written by write_fit_state.
+        """
+        self.create_model(h_init)
+        self._read_model(state_filename)
+
+        with open(state_filename, 'r') as f:
+            fit_state = pickle.load(f)['fit_state']
+
+        self.prev_elbo = fit_state['prev_elbo']
+        self.prev_elbo_diff = fit_state['prev_elbo_diff']
+        self.num_em_iter_completed = fit_state['num_em_iter_completed']
+        self.converged = fit_state['converged']
+        self.iter_stats = fit_state['iter_stats']
+        self.num_param_evals = fit_state['num_param_evals']
+
+    def write_checkpoint(self, checkpoint_filename):
+        """ Write a compact checkpoint of the variational state and progress of
+        the fit for resuming with read_checkpoint.
+
+        Posterior marginals of the HMM are not written, they are recalculated
+        from the restored state by read_checkpoint.  Before the first EM
+        iteration, elbos that are None are written as nan, and no iteration
+        statistics are written.
+        """
+        checkpoint = {
+            'h': np.asarray(self.model.h),
+            'p_breakpoint': np.asarray(self.model.p_breakpoint),
+            'p_outlier_total': np.asarray(self.model.p_outlier_total),
+            'p_outlier_allele': np.asarray(self.model.p_outlier_allele),
+            'p_allele_swap': np.asarray(self.model.p_allele_swap),
+            'state_offsets': np.asarray(self.model.state_offsets),
+            'state_idx': np.asarray(self.model.state_idx),
+            'prev_elbo': np.nan if self.prev_elbo is None else self.prev_elbo,
+            'prev_elbo_diff': np.nan if self.prev_elbo_diff is None else self.prev_elbo_diff,
+            'num_em_iter_completed': self.num_em_iter_completed,
+            'converged': self.converged,
+            'num_param_evals': self.num_param_evals,
+        }
+
+        if len(self.iter_stats) > 0:
+            checkpoint['iter_stats'] = pd.DataFrame(self.iter_stats).to_records(index=False)
+
+        for name, value in self.get_likelihood_param_values().iteritems():
+            checkpoint['param_' + name] = value
+
+        # Replace the previous checkpoint only once completely written
+        temp_filename = checkpoint_filename + '.tmp'
+        with open(temp_filename, 'wb') as f:
+            np.savez_compressed(f, **checkpoint)
+        os.rename(temp_filename, checkpoint_filename)
+
+    def read_checkpoint(self, h_init, checkpoint_filename):
+        """ Create the model and restore the variational state and progress of
+        a fit written by write_checkpoint.
+        """
+        self.create_model(h_init)
+
+        with open(checkpoint_filename, 'rb') as f:
+            checkpoint = np.load(f)
+
+            self.model.h = checkpoint['h']
+            for name in self.likelihood_params:
+                setattr(self.model, name, float(checkpoint['param_' + name]))
+
+            self.model.p_breakpoint = checkpoint['p_breakpoint']
+            self.model.p_outlier_total = checkpoint['p_outlier_total']
+            self.model.p_outlier_allele = checkpoint['p_outlier_allele']
+            self.model.p_allele_swap = checkpoint['p_allele_swap']
+            self.model.set_candidate_states(checkpoint['state_offsets'], checkpoint['state_idx'])
+
+            self.prev_elbo = float(checkpoint['prev_elbo'])
+            self.prev_elbo_diff = float(checkpoint['prev_elbo_diff'])
+            if np.isnan(self.prev_elbo):
+                self.prev_elbo = None
+            if np.isnan(self.prev_elbo_diff):
+                self.prev_elbo_diff = None
+            self.num_em_iter_completed = int(checkpoint['num_em_iter_completed'])
+            self.converged = bool(checkpoint['converged'])
+            self.num_param_evals = int(checkpoint['num_param_evals'])
+            self.iter_stats = []
+            if 'iter_stats' in checkpoint:
+                self.iter_stats = pd.DataFrame.from_records(checkpoint['iter_stats']).to_dict('records')
+
+        self.model.invalidate_likelihood()
+        self.model.calculate_log_transmat(self.model.cached_log_transmat)
+
+        # Recalculate posterior marginals given the restored state
+        self.model.update_p_cn()
 
     def _get_hdel_weights(self):
-        mask = np.zeros(self.model.posterior_marginals.shape)
-        n, s = np.where(np.asarray(self.model.is_hdel) == 1)
-        mask[n, s] = 1
+        mask = np.asarray(self.model.is_hdel)[np.asarray(self.model.state_class)]
         weights = (np.asarray(self.model.posterior_marginals) * mask).sum(axis=-1)
         return weights
 
     def _get_loh_weights(self):
-        mask = np.zeros(self.model.posterior_marginals.shape)
-        n, s = np.where(np.asarray(self.model.is_loh) == 1)
-        mask[n, s] = 1
+        mask = np.asarray(self.model.is_loh)[np.asarray(self.model.state_class)]
         weights = (np.asarray(self.model.posterior_marginals) * mask).sum(axis=-1)
         return weights
 
@@ -353,15 +478,34 @@ class BreakpointModel(object):
 
     def fit(self, h_init):
         """ Fit the model with a series of updates.
+
+        With checkpoint_filename and checkpoint_interval set, the state of the
+        fit is written to the checkpoint every checkpoint_interval EM iterations.
+        With checkpoint_filename set, the fit resumes from the checkpoint if it
+        exists.
+        """
+        if self.checkpoint_filename is not None and os.path.exists(self.checkpoint_filename):
+            self.read_checkpoint(h_init, self.checkpoint_filename)
+            print '[{}] resuming from checkpoint after iteration {}'.format(_gettime(), self.num_em_iter_completed)
+        else:
+            self.create_model(h_init)
+
+        self.resume_fit()
+
+    def create_model(self, h_init):
+        """ Create the underlying model prior to fitting.
         """
         M = h_init.shape[0]
 
+        # State tables for each distinct germline copy number
+        normal_copies, state_class = np.unique(self.normal_copies, axis=0, return_inverse=True)
+
         cn_states = self.create_cn_states(M, 2, self.max_copy_number, self.max_copy_number_diff)
-        cn_states = np.array([cn_states] * self.N)
-        cn_states[:, :, 0, :] = self.normal_copies[:, np.newaxis, :]
+        cn_states = np.array([cn_states] * normal_copies.shape[0])
+        cn_states[:, :, 0, :] = normal_copies[:, np.newaxis, :]
 
-        # Remap cn states
-        cn_states = cn_states[self.seg_rev_remap, :, :, :]
+        # Remap state classes
+        state_class = state_class[self.seg_rev_remap].astype(np.int64)
 
         brk_states = self.create_brk_states(M, self.max_copy_number, self.max_copy_number_diff)
 
@@ -371,6 +515,7 @@ class BreakpointModel(object):
             self.num_breakpoints,
             self.normal_contamination,
             cn_states,
+            state_class,
             brk_states,
             h_init,
             self.l1,
@@ -402,13 +547,91 @@ class BreakpointModel(object):
             self.model.p_breakpoint = p_breakpoint
 
         self.model.transition_model = self.transition_model
+        self.model.sum_product_engine = self.sum_product_engine
+        self.model.num_threads = self.num_threads
+        self.model.hmm_precision = self.hmm_precision
+
+        self.prune_cn_states()
+
+    def prune_cn_states(self, keep_candidates=False):
+        """ Restrict the copy number states of each segment to candidates plausible
+        under the current h, and update the approximating HMM for the candidates.
+
+        With keep_candidates set, candidates are added to the current candidates,
+        such that states plausible under the initial h are never removed.
+        """
+        if self.cn_state_prune_threshold is None:
+            return
+
+        num_candidate_states = self.model.state_idx.shape[0]
+
+        self.model.prune_cn_states(self.cn_state_prune_threshold, keep_candidates=keep_candidates)
+
+        # Candidates are only removed, or only added with keep_candidates
+        if self.model.state_idx.shape[0] == num_candidate_states:
+            return
+
+        self.model.update_p_cn()
+
+        num_states = np.diff(np.asarray(self.model.state_offsets))
+        print '[{}] candidate states per segment, mean: {:.1f}, max: {}'.format(
+            _gettime(), num_states.mean(), num_states.max())
+
+    def is_elbo_converged(self, elbo_diff, elbo):
+        """ Check for convergence given the change in elbo of an update.
+
+        Converged if the absolute change is less than elbo_abs_tol, or less than
+        elbo_rel_tol relative to the elbo, and never if both are None.
+        """
+        if self.elbo_abs_tol is not None and abs(elbo_diff) < self.elbo_abs_tol:
+            return True
+        if self.elbo_rel_tol is not None and abs(elbo_diff) < self.elbo_rel_tol * abs(elbo):
+            return True
+        return False
+
+    def resume_fit(self):
+        """ Run the remaining EM iterations of a created or restored model.
+
+        With elbo_abs_tol or elbo_rel_tol set, the variational updates of each
+        EM iteration, and the EM iterations, stop when the elbo converges,
+        and num_update_iter and num_em_iter are the maximum iterations.
+        """
+        check_convergence = self.elbo_abs_tol is not None or self.elbo_rel_tol is not None
 
         if self.prev_elbo is None:
             self.prev_elbo = self.model.calculate_elbo()
 
-        for i in xrange(self.num_em_iter):
+        for i in xrange(self.num_em_iter_completed, self.num_em_iter):
+            if self.converged:
+                break
+
+            start_time = time.time()
+            start_num_param_evals = self.num_param_evals
+
+            # Additional candidate states given h updated by the previous iteration
+            if i > 0:
+                self.prune_cn_states(keep_candidates=True)
+
+            # Fused sweeps update allele swap last, update it first given the
+            # likelihood of this iteration as for separate passes
+            if self.fused_variational_update:
+                with self.elbo_check('update_p_allele_swap'):
+                    self.model.update_p_allele_swap()
+
+            update_elbo = self.prev_elbo
+            num_update_iter = 0
             for j in xrange(self.num_update_iter):
                 self.variational_update()
+                num_update_iter += 1
+
+                if check_convergence:
+                    elbo = self.model.calculate_elbo()
+                    update_elbo_diff = elbo - update_elbo
+                    update_elbo = elbo
+                    if self.is_elbo_converged(update_elbo_diff, elbo):
+                        break
+
+            update_time = time.time()
 
             if self.do_h_update:
                 self.em_update_h()
@@ -419,14 +642,37 @@ class BreakpointModel(object):
 
             self.prev_elbo_diff = elbo - self.prev_elbo
             self.prev_elbo = elbo
+            self.num_em_iter_completed = i + 1
+
+            if check_convergence:
+                self.converged = self.is_elbo_converged(self.prev_elbo_diff, self.prev_elbo)
+
+            end_time = time.time()
+
+            self.iter_stats.append({
+                'em_iter': i,
+                'num_update_iter': num_update_iter,
+                'elbo': self.prev_elbo,
+                'elbo_diff': self.prev_elbo_diff,
+                'update_seconds': update_time - start_time,
+                'em_seconds': end_time - update_time,
+                'seconds': end_time - start_time,
+                'num_param_evals': self.num_param_evals - start_num_param_evals,
+                'num_candidate_states': self.model.state_idx.shape[0],
+            })
 
             print '[{}] completed iteration {}'.format(_gettime(), i)
             print '[{}]     elbo: {:.10f}'.format(_gettime(), self.prev_elbo)
             print '[{}]     elbo diff: {:.10f}'.format(_gettime(), self.prev_elbo_diff)
+            print '[{}]     seconds: {:.3f}'.format(_gettime(), end_time - start_time)
             print '[{}]     h = {}'.format(_gettime(), np.asarray(self.model.h))
             for name, value in self.get_likelihood_param_values().iteritems():
                 print '[{}]     {} = {}'.format(_gettime(), name, value)
 
+            if self.checkpoint_filename is not None and self.checkpoint_interval is not None:
+                if self.num_em_iter_completed % self.checkpoint_interval == 0:
+                    self.write_checkpoint(self.checkpoint_filename)
+
     @contextlib.contextmanager
     def elbo_check(self, name, threshold=-1e-6):
         print '[{}] optimizing {}'.format(_gettime(), name)
@@ -444,6 +690,10 @@ class BreakpointModel(object):
     def variational_update(self):
         """ Single update of all variational parameters.
         """
+        if self.fused_variational_update:
+            self.fused_variational_sweep()
+            return
+
         with self.elbo_check('update_p_allele_swap'):
             self.model.update_p_allele_swap()
 
@@ -459,6 +709,27 @@ class BreakpointModel(object):
         with self.elbo_check('p_outlier_allele'):
             self.model.update_p_outlier_allele()
 
+    def fused_variational_sweep(self):
+        """ Single update of all variational parameters, updating the outlier and
+        allele swap indicators in one pass after the HMM and breakpoints.
+
+        Cycles through the same updates as the separate passes, with the allele
+        swap update at the end of the sweep rather than the start, and an
+        additional allele swap update at the start of each EM iteration.  Each
+        EM iteration therefore ends with an allele swap update not made by the
+        separate passes, and fits differ slightly from those with separate
+        passes.  As for separate passes, each update is a coordinate ascent
+        step, and the elbo does not decrease over a sweep.
+        """
+        with self.elbo_check('p_cn'):
+            self.model.update_p_cn()
+
+        with self.elbo_check('p_breakpoint'):
+            self.model.update_p_breakpoint()
+
+        with self.elbo_check('p_indicators'):
+            self.model.update_p_indicators()
+
     def em_update_h(self):
         """ Single EM update of haploid read depth parameter.
         """
@@ -482,21 +753,22 @@ class BreakpointModel(object):
     def update_h(self):
         """ Update haploid depths by optimizing expected likelihood.
         """
-        def calculate_nll(h, model, sample):
+        def calculate_nll(h, model):
             model.h = h
-            nll = -model.calculate_expected_log_likelihood(sample)
+            nll = -model.calculate_sample_expected_log_likelihood()
             return nll
 
-        def calculate_nll_partial_h(h, model, sample):
+        def calculate_nll_partial_h(h, model):
             model.h = h
             partial_h = np.zeros((model.num_clones,))
-            model.calculate_expected_log_likelihood_partial_h(sample, partial_h)
+            model.calculate_sample_expected_log_likelihood_partial_h(partial_h)
             return -partial_h
 
         h_before = self.model.h
         elbo_before = self.model.calculate_expected_log_likelihood(np.ones((self.model.num_segments,), dtype=int))
 
         sample = self._create_sample()
+        self.model.set_likelihood_sample(sample)
 
         result = scipy.optimize.minimize(
             calculate_nll,
@@ -504,15 +776,15 @@ class BreakpointModel(object):
             method='L-BFGS-B',
             jac=calculate_nll_partial_h,
             bounds=[(1e-8, 10.)] * self.model.num_clones,
-            args=(self.model, sample),
+            args=(self.model,),
         )
 
         if not result.success:
 
             # Check the gradiant if optimization failed
             if result.message == 'ABNORMAL_TERMINATION_IN_LNSRCH':
-                analytic_fprime = calculate_nll_partial_h(result.x, self.model, sample)
-                numerical_fprime = statsmodels.tools.numdiff.approx_fprime(result.x, calculate_nll, args=(self.model, sample))
+                analytic_fprime = calculate_nll_partial_h(result.x, self.model)
+                numerical_fprime = statsmodels.tools.numdiff.approx_fprime(result.x, calculate_nll, args=(self.model,))
 
                 if not np.allclose(analytic_fprime, numerical_fprime, atol=2.):
                     raise ValueError('gradiant error, analytic: {}, numerical: {}\n'.format(analytic_fprime, numerical_fprime))
@@ -532,28 +804,97 @@ class BreakpointModel(object):
 
     def update_param(self, name):
         """ Update named param by optimizing expected likelihood.
+
+        With param_optimize_method 'brute', the expected likelihood is
+        maximized over a grid spanning the bounds of the param.  With 'brent',
+        the expected likelihood is maximized by a bounded Brent search for the
+        root of its analytic derivative in log space, bracketed by stepping from
+        the previous value of the param.  The optimum is at the bound reached
+        if the derivative does not change sign within the bounds, and the grid
+        is searched if the derivative is undefined.
         """
         bounds = self.likelihood_param_bounds[name]
         weights = self.get_param_sample_weight(name)
 
-        def calculate_nll(value, model, name, bounds, sample):
+        num_evals = [0]
+
+        def calculate_nll(value, model, name, bounds):
             if value < bounds[0] or value > bounds[1]:
                 return np.inf
+            num_evals[0] += 1
             setattr(model, name, value)
-            nll = -model.calculate_expected_log_likelihood(sample)
+            nll = -model.calculate_sample_expected_log_likelihood()
             return nll
 
+        def calculate_nll_partial_log_value(log_value, model, name):
+            num_evals[0] += 1
+            value = np.exp(log_value)
+            setattr(model, name, value)
+            return -model.calculate_sample_expected_log_likelihood_partial_param(name) * value
+
         value_before = getattr(self.model, name)
         elbo_before = self.model.calculate_expected_log_likelihood(np.ones((self.model.num_segments,), dtype=int))
 
         sample = self._create_sample(weights)
+        self.model.set_likelihood_sample(sample)
+
+        value = None
+
+        if self.param_optimize_method == 'brent':
+            log_bounds = np.log(bounds)
+            log_value = np.clip(np.log(value_before), log_bounds[0], log_bounds[1])
+            partial = calculate_nll_partial_log_value(log_value, self.model, name)
+
+            # Step away from the previous value, doubling the step, until the
+            # derivative changes sign or the search reaches a bound
+            direction = 1. if partial < 0. else -1.
+            step = self.param_search_step
+            bracket = [log_value, log_value]
+            while np.isfinite(partial) and partial != 0. and np.sign(partial) != direction:
+                next_log_value = np.clip(log_value + direction * step, log_bounds[0], log_bounds[1])
+                if next_log_value == log_value:
+                    break
+                bracket = sorted([log_value, next_log_value])
+                log_value = next_log_value
+                partial = calculate_nll_partial_log_value(log_value, self.model, name)
+                step *= 2.
+
+            if not np.isfinite(partial):
+                print '[{}]     {} derivative undefined, searching grid'.format(_gettime(), name)
+
+            elif partial == 0.:
+                value = np.exp(log_value)
+
+            elif np.sign(partial) == direction:
+                log_value = scipy.optimize.brentq(
+                    calculate_nll_partial_log_value,
+                    bracket[0], bracket[1],
+                    args=(self.model, name),
+                    xtol=self.param_search_xtol,
+                )
+                value = np.exp(log_value)
 
-        result = scipy.optimize.brute(
-            calculate_nll,
-            args=(self.model, name, bounds, sample),
-            ranges=[bounds],
-            full_output=True,
-        )
+            else:
+                value = np.exp(log_value)
+
+            if value is not None:
+                value = float(np.clip(value, bounds[0], bounds[1]))
+
+        elif self.param_optimize_method != 'brute':
+            raise ValueError('unknown param_optimize_method {}'.format(self.param_optimize_method))
+
+        if value is None:
+            result = scipy.optimize.brute(
+                calculate_nll,
+                args=(self.model, name, bounds),
+                ranges=[bounds],
+                full_output=True,
+            )
+            value = float(np.squeeze(result[0]))
+
+        setattr(self.model, name, value)
+
+        self.num_param_evals += num_evals[0]
 
         elbo_after = self.model.calculate_expected_log_likelihood(np.ones((self.model.num_segments,), dtype=int))
         if elbo_after < elbo_before:
@@ -561,7 +902,7 @@ class BreakpointModel(object):
             setattr(self.model, name, value_before)
 
         else:
-            setattr(self.model, name, result[0])
+            print '[{}]     {} = {} in {} evaluations'.format(_gettime(), name, value, num_evals[0])
 
     def optimal_cn(self):
         cn = np.zeros((self.model.num_segments, self.model.num_clones, self.model.num_alleles), dtype=int)
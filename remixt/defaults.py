@@ -78,6 +78,29 @@ bam_max_soft_clipped                        = 8
 # disable for irregular fragment length distribution
 bam_check_proper_pair                       = True
 
+# Number of threads extracting regions of each chromosome from the bam
+bam_num_threads                             = 1
+
+# Storage format of extracted seqdata, 'hdf' for a compressed hdf store,
+# or 'columnar' for uncompressed memory mappable per chromosome columns
+seqdata_format                              = 'hdf'
+
+# Compression of hdf seqdata, complib is any compression library supported
+# by pandas.HDFStore, for instance 'zlib', 'lzo', 'blosc:lz4' or 'blosc:zstd',
+# and complevel is from 0 (no compression) to 9.  Pytables applies a byte
+# shuffle filter to all compressed tables.  Setting 'blosc:lz4' at level 5
+# writes and reads about twice as fast for files about 20% larger.
+seqdata_complib                             = 'zlib'
+seqdata_complevel                           = 9
+
+# Merge per chromosome hdf seqdata as a container of links to the per
+# chromosome files, which are then kept alongside the merged seqdata
+seqdata_merge_links                         = False
+
+# Count reads directly from bams instead of extracting seqdata, avoiding
+# writing and rereading seqdata files
+bam_stream_counts                           = False
+
 # Heterozygous snp calling
 sequencing_base_call_error                  = 0.01
 het_snp_call_threshold                      = 0.9
@@ -141,6 +164,55 @@ num_em_iter                                 = 5
 # Number of iterations of Variational Inference per EM iteration
 num_update_iter                             = 5
 
+# Convergence tolerance on the change in elbo, absolute and relative to the
+# elbo, for stopping EM iterations and Variational Inference iterations,
+# None to disable.  With convergence enabled num_em_iter and num_update_iter
+# are the maximum number of iterations
+elbo_abs_tol                                = None
+elbo_rel_tol                                = None
+
+# Restrict the copy number states of each segment to those with log likelihood
+# within the threshold of the most likely state given the initial h, adding
+# states within the threshold given the current h before each EM iteration,
+# None to use all states
+cn_state_prune_threshold                    = None
+
+# Update the outlier and allele swap indicators of each segment in a single
+# pass after the HMM update, rather than as separate passes over segments,
+# the order of updates differs and fits are close to but not the same as
+# fits with separate passes
+fused_variational_update                    = False
+
+# Precision of the stored transition and joint posterior marginal matrices of
+# the HMM, 0 for double or 1 for single precision, with log sums accumulated in
+# double precision in both cases
+hmm_precision                               = 0
+
+# Method for optimizing likelihood parameters, 'brute' for a grid search
+# across the bounds of each parameter, or 'brent' for a root search of the
+# derivative bracketed from the previous value, with fewer likelihood
+# evaluations, falling back to the grid if the root is not bracketed
+param_optimize_method                       = 'brute'
+
+# Number of threads for updating independent chromosome chains of each fit
+fit_num_threads                             = 1
+
+# Number of EM iterations between checkpoints of the state of each fit, written
+# alongside the fit results, from which an interrupted fit resumes, including
+# fits of the local fit engine, None to disable
+fit_checkpoint_interval                     = None
+
+# Fit all initializations in a single job on a pool of local processes,
+# 0 to fit each initialization as a separate job
+fit_local_num_processes                     = 0
+
+# Successive halving of initializations fit by the local fit engine, after
+# each number of EM iterations in the list, continue fitting only the top
+# fraction of initializations, preferring non-divergent solutions then by elbo,
+# and record the others as truncated.  An empty list disables pruning
+fit_prune_em_iters                          = []
+fit_prune_keep_fraction                     = 0.5
+
 # Disable breakpoints for benchmarking purposes
 disable_breakpoints                         = False
 
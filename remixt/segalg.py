@@ -47,8 +47,27 @@ def contained_counts(X, Y):
 
     """
 
-    idx = np.searchsorted(X[:,1], Y[:,0])
-    end_idx = np.searchsorted(X[:,1], Y[:,1])
+    return contained_interval_counts(X, Y[:,0], Y[:,1])
+
+
+def contained_interval_counts(X, y_start, y_end):
+    """ Find counts of overlapping segments fully contained in non-overlapping segments
+
+    Args:
+        X (numpy.array): start and end of non-overlapping segments with shape (N,2) for N segments
+        y_start (numpy.array): start of M overlapping segments
+        y_end (numpy.array): end of M overlapping segments
+
+    Returns:
+        numpy.array: N length array of counts of Y countained in X
+
+    X is assumed to be ordered by start position.  As for `contained_counts`
+    with the start and end of Y as separate arrays.
+
+    """
+
+    idx = np.searchsorted(X[:,1], y_start)
+    end_idx = np.searchsorted(X[:,1], y_end)
 
     # Mask Y segments outside last X segment
     outside = end_idx >= X.shape[0]
@@ -56,8 +75,8 @@ def contained_counts(X, Y):
 
     # Filter for containment, same X segment, not outside
     idx = idx[
-        (Y[:,0] >= X[idx,0]) &
-        (Y[:,1] <= X[idx,1]) &
+        (y_start >= X[idx,0]) &
+        (y_end <= X[idx,1]) &
         (idx == end_idx) &
         (~outside)
     ]
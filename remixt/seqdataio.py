@@ -1,5 +1,12 @@
+import os
+import json
+import collections
+import shutil
+import struct
+import multiprocessing.pool
 import numpy as np
 import pandas as pd
+import tables
 
 import remixt.bamreader
 
@@ -14,6 +21,19 @@ def _get_key(record_type, chromosome):
     return '/{}/chromosome_{}'.format(record_type, chromosome)
 
 
+_columnar_magic = 'RMXTCOL1'
+_columnar_alignment = 64
+_columnar_footer = struct.Struct('<Q8s')
+
+# Column by which each record type is sorted, and number of rows per block
+# of the block index of sorted tables
+_sort_columns = {
+    'fragments': 'start',
+    'alleles': 'position',
+}
+_index_block_size = 1 << 16
+
+
 def _unique_index_append(store, key, data):
     try:
         nrows = store.get_storer(key).nrows
@@ -26,7 +46,7 @@ def _unique_index_append(store, key, data):
         store.append(key, data)
 
 
-def create_chromosome_seqdata(seqdata_filename, bam_filename, snp_filename, chromosome, max_fragment_length, max_soft_clipped, check_proper_pair):
+def create_chromosome_seqdata(seqdata_filename, bam_filename, snp_filename, chromosome, max_fragment_length, max_soft_clipped, check_proper_pair, seqdata_format='hdf', num_threads=1, chromosome_length=None, complib='zlib', complevel=9):
     """ Create seqdata from bam for one chromosome.
 
     Args:
@@ -38,8 +58,68 @@ def create_chromosome_seqdata(seqdata_filename, bam_filename, snp_filename, chro
         max_soft_clipped(int): maximum soft clipping for considering a read concordant
         check_proper_pair(boo): check proper pair flag
 
+    KwArgs:
+        seqdata_format (str): 'hdf' for a compressed hdf store, 'columnar' for memory mappable columns
+        num_threads (int): number of threads extracting regions of the chromosome concurrently
+        chromosome_length (int): length of the chromosome, required for multithreaded extraction
+        complib (str): compression library for hdf seqdata, as for `pandas.HDFStore`
+        complevel (int): compression level for hdf seqdata, 0 for no compression
+
+    Multithreaded extraction splits the chromosome into contiguous regions, each
+    extracted by a separate reader into a temporary shard.  Each fragment is
+    extracted by the reader for the region containing its start.  Shards are
+    concatenated in region order, offsetting fragment ids to be unique across
+    the chromosome.
+
+    Fragments are written sorted by start and alleles sorted by position, with
+    a block index for region queries.  The reader produces each in nearly sorted
+    order, out of order by at most max_fragment_length, and they are sorted
+    within that window as they are written.
+
     """
 
+    if num_threads <= 1 or chromosome_length is None:
+        regions = [(0, -1)]
+    else:
+        boundaries = np.linspace(0, chromosome_length, num_threads + 1).astype(int)
+        regions = zip(boundaries[:-1], boundaries[1:])
+        regions[-1] = (regions[-1][0], -1)
+
+    if len(regions) == 1:
+        _extract_region_seqdata(
+            _SortingTableStore(
+                _create_table_store(seqdata_filename, seqdata_format, complib=complib, complevel=complevel),
+                max_fragment_length),
+            bam_filename, snp_filename, chromosome,
+            max_fragment_length, max_soft_clipped, check_proper_pair,
+            0, -1)
+        return
+
+    shard_filenames = ['{}.shard{}'.format(seqdata_filename, idx) for idx in xrange(len(regions))]
+
+    def extract_shard(idx):
+        region_start, region_end = regions[idx]
+        _extract_region_seqdata(
+            _SortingTableStore(_ColumnarTableStore(shard_filenames[idx]), max_fragment_length),
+            bam_filename, snp_filename, chromosome,
+            max_fragment_length, max_soft_clipped, check_proper_pair,
+            int(region_start), int(region_end))
+
+    pool = multiprocessing.pool.ThreadPool(num_threads)
+
+    try:
+        pool.map(extract_shard, xrange(len(regions)))
+        _concatenate_shards(seqdata_filename, shard_filenames, chromosome, seqdata_format, max_fragment_length, complib=complib, complevel=complevel)
+
+    finally:
+        pool.close()
+        pool.join()
+        for shard_filename in shard_filenames:
+            if os.path.exists(shard_filename):
+                os.remove(shard_filename)
+
+
+def _extract_region_seqdata(store, bam_filename, snp_filename, chromosome, max_fragment_length, max_soft_clipped, check_proper_pair, region_start, region_end):
     reader = remixt.bamreader.AlleleReader(
         bam_filename,
         snp_filename,
@@ -47,40 +127,665 @@ def create_chromosome_seqdata(seqdata_filename, bam_filename, snp_filename, chro
         max_fragment_length,
         max_soft_clipped,
         check_proper_pair,
+        region_start=region_start,
+        region_end=region_end,
     )
 
-    with pd.HDFStore(seqdata_filename, 'w', complevel=9, complib='zlib') as store:
-        while reader.ReadAlignments(10000000):
-            _unique_index_append(store, _get_key('fragments', chromosome), reader.GetFragmentTable())
-            _unique_index_append(store, _get_key('alleles', chromosome), reader.GetAlleleTable())
+    while reader.ReadAlignments(10000000):
+        store.append(_get_key('fragments', chromosome), reader.GetFragmentTable())
+        store.append(_get_key('alleles', chromosome), reader.GetAlleleTable())
+
+    store.close()
+
+
+def _concatenate_shards(seqdata_filename, shard_filenames, chromosome, seqdata_format, max_fragment_length, complib='zlib', complevel=9, chunksize=10000000):
+    # Alleles of fragments near the end of a region overlap the next region
+    store = _SortingTableStore(
+        _create_table_store(seqdata_filename, seqdata_format, complib=complib, complevel=complevel),
+        max_fragment_length)
+
+    fragment_id_offset = 0
+
+    for shard_filename in shard_filenames:
+        manifest = _read_columnar_manifest(shard_filename)
+
+        num_fragments = 0
+        for record_type in ('fragments', 'alleles'):
+            key = _get_key(record_type, chromosome)
+
+            if key not in manifest['tables']:
+                continue
+
+            nrows = manifest['tables'][key]['nrows']
+
+            for start in xrange(0, nrows, chunksize):
+                data = _read_columnar_table(shard_filename, key, start=start, stop=start + chunksize, manifest=manifest)
+                data['fragment_id'] = (data['fragment_id'] + fragment_id_offset).astype(np.int32)
+                store.append(key, data)
 
+            if record_type == 'fragments':
+                num_fragments = nrows
 
-def merge_seqdata(out_filename, in_filenames):
+        fragment_id_offset += num_fragments
+
+    store.close()
+
+
+def merge_seqdata(out_filename, in_filenames, link=False, num_threads=1, validate=True, complib='zlib', complevel=9):
     """ Merge seqdata files for non-overlapping sets of chromosomes
 
     Args:
         out_filename(str): seqdata hdf store to write to
-        out_filename(dict): seqdata hdf store to read from
+        in_filenames(dict): seqdata hdf store to read from
+
+    KwArgs:
+        link(bool): merge hdf seqdata as links to the tables of the inputs
+        num_threads(int): number of threads copying columnar data concurrently
+        validate(bool): check the merged seqdata against the inputs
+        complib(str): compression library for rewritten hdf seqdata
+        complevel(int): compression level for rewritten hdf seqdata
+
+    The format of the merged seqdata matches the format of the inputs.
+
+    Columnar seqdata is merged by copying the bytes of each column of each
+    input directly into place in the merged file, without decoding.  Hdf
+    seqdata is merged by rewriting each table, or if link is set, as a
+    container of external links to the tables of each input, in which case
+    the inputs must be kept alongside the merged file.
 
     """
 
-    with pd.HDFStore(out_filename, 'w', complevel=9, complib='zlib') as out_store:
-        for in_filename in in_filenames.itervalues():
-            with pd.HDFStore(in_filename, 'r') as in_store:
-                for key in in_store.keys():
-                    out_store.put(key, in_store[key], format='table')
+    in_filenames = list(in_filenames.itervalues())
 
+    in_formats = set([get_seqdata_format(a) for a in in_filenames])
+    if len(in_formats) > 1:
+        raise ValueError('unable to merge seqdata of mixed formats {}'.format(', '.join(in_formats)))
+    seqdata_format = in_formats.pop() if len(in_formats) > 0 else 'hdf'
+
+    if seqdata_format == 'columnar':
+        _merge_columnar_seqdata(out_filename, in_filenames, num_threads=num_threads)
+
+    elif link:
+        _link_hdf_seqdata(out_filename, in_filenames)
+
+    else:
+        with pd.HDFStore(out_filename, 'w', complevel=complevel, complib=complib) as out_store:
+            for in_filename in in_filenames:
+                with pd.HDFStore(in_filename, 'r') as in_store:
+                    for key in in_store.keys():
+                        out_store.put(key, in_store[key], format='table')
+                        _write_hdf_block_index(out_store, key, _read_block_index(in_filename, key))
+
+    if validate:
+        validate_merged_seqdata(out_filename, in_filenames)
+
+
+def _merge_columnar_seqdata(out_filename, in_filenames, num_threads=1, blocksize=1<<24):
+    manifest = {'format': 'columnar', 'version': 1, 'tables': dict()}
+
+    # Lay out the columns of all inputs, aligned as for the columnar store,
+    # and collect the byte ranges to copy
+    copies = list()
+    offset = len(_columnar_magic)
+
+    for in_filename in in_filenames:
+        in_manifest = _read_columnar_manifest(in_filename)
+
+        for key, in_table in in_manifest['tables'].iteritems():
+            if key in manifest['tables']:
+                raise ValueError('duplicate table {} in merged seqdata'.format(key))
+
+            columns = list()
+
+            for in_column in in_table['columns']:
+                offset += -offset % _columnar_alignment
+                size = in_table['nrows'] * np.dtype(str(in_column['dtype'])).itemsize
+                columns.append({'name': in_column['name'], 'dtype': in_column['dtype'], 'offset': offset})
+                copies.append((in_filename, in_column['offset'], offset, size))
+                offset += size
+
+            manifest['tables'][key] = {'nrows': in_table['nrows'], 'columns': columns}
+
+            for field in ('sorted_by', 'block_size', 'block_index'):
+                if field in in_table:
+                    manifest['tables'][key][field] = in_table[field]
+
+    with open(out_filename, 'wb') as f:
+        f.write(_columnar_magic)
+        f.truncate(offset)
+        f.seek(offset)
+        f.write(json.dumps(manifest))
+        f.write(_columnar_footer.pack(offset, _columnar_magic))
+
+    # Ranges are disjoint, each copy writes through its own file handle
+    def copy_range(args):
+        in_filename, in_offset, out_offset, size = args
+        with open(in_filename, 'rb') as in_file, open(out_filename, 'r+b') as out_file:
+            in_file.seek(in_offset)
+            out_file.seek(out_offset)
+            while size > 0:
+                data = in_file.read(min(size, blocksize))
+                if len(data) == 0:
+                    raise ValueError('truncated columnar seqdata {}'.format(in_filename))
+                out_file.write(data)
+                size -= len(data)
+
+    pool = multiprocessing.pool.ThreadPool(max(1, num_threads))
+
+    try:
+        pool.map(copy_range, copies)
+
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _link_hdf_seqdata(out_filename, in_filenames):
+    out_directory = os.path.dirname(os.path.abspath(out_filename))
+
+    with tables.open_file(out_filename, 'w') as out_file:
+        for in_filename in in_filenames:
+            target_filename = os.path.relpath(os.path.abspath(in_filename), out_directory)
+
+            for key in _read_hdf_keys(in_filename):
+                where, name = key.rsplit('/', 1)
+                out_file.create_external_link(
+                    where or '/', name, '{}:{}'.format(target_filename, key),
+                    createparents=True)
+
+
+def _read_hdf_keys(seqdata_filename):
+    with pd.HDFStore(seqdata_filename, 'r') as store:
+        keys = store.keys()
+
+        for link in store._handle.walk_nodes('/', classname='ExternalLink'):
+            keys.append(link._v_pathname)
+
+    return keys
+
+
+def _resolve_hdf_key(seqdata_filename, key):
+    """ Resolve the file and key of a table that may be linked from a merged seqdata.
+    """
+
+    with tables.open_file(seqdata_filename, 'r') as f:
+        try:
+            node = f.get_node(key)
+        except tables.NoSuchNodeError:
+            return seqdata_filename, key
+
+        if not isinstance(node, tables.link.ExternalLink):
+            return seqdata_filename, key
+
+        target_filename, target_key = node.target.rsplit(':', 1)
+
+    if not os.path.isabs(target_filename):
+        target_filename = os.path.join(os.path.dirname(os.path.abspath(seqdata_filename)), target_filename)
+
+    return target_filename, target_key
+
+
+def _read_seq_data_keys(seqdata_filename):
+    if get_seqdata_format(seqdata_filename) == 'columnar':
+        return _read_columnar_manifest(seqdata_filename)['tables'].keys()
+    return _read_hdf_keys(seqdata_filename)
+
+
+def _calculate_seq_data_checksum(seqdata_filename, key, chunksize=10000000):
+    """ Sum of the sort column of a table, read in chunks.
+    """
+
+    seqdata_format = get_seqdata_format(seqdata_filename)
+    column = _get_sort_column(key)
+    nrows = _get_seq_data_nrows(seqdata_filename, key)
+
+    manifest = None
+    if seqdata_format == 'columnar':
+        manifest = _read_columnar_manifest(seqdata_filename)
+    else:
+        seqdata_filename, key = _resolve_hdf_key(seqdata_filename, key)
+
+    checksum = 0
+    for start in xrange(0, nrows, chunksize):
+        data = _read_seq_data_row_columns(
+            seqdata_filename, key, [column], seqdata_format,
+            start=start, stop=start + chunksize, manifest=manifest)
+        checksum += int(data[column].sum(dtype=np.int64))
+
+    return checksum
+
+
+def validate_merged_seqdata(merged_filename, in_filenames):
+    """ Check that a merged seqdata file contains each table of the inputs.
+
+    Args:
+        merged_filename (str): merged seqdata file
+        in_filenames (list of str): seqdata files that were merged
+
+    Raises:
+        ValueError: a table is missing, or has a different number of rows,
+        different first and last rows, or a different sum of its sort column
+        in the merged seqdata, or the merged seqdata has tables not in the inputs
+
+    """
+
+    merged_nrows = dict([(key, _get_seq_data_nrows(merged_filename, key)) for key in _read_seq_data_keys(merged_filename)])
+
+    expected_nrows = dict()
+
+    for in_filename in in_filenames:
+        for key in _read_seq_data_keys(in_filename):
+            nrows = _get_seq_data_nrows(in_filename, key)
+            expected_nrows[key] = nrows
+
+            if merged_nrows.get(key) != nrows:
+                raise ValueError('table {} of {} has {} rows in merged seqdata {}, expected {}'.format(
+                    key, in_filename, merged_nrows.get(key, 0), merged_filename, nrows))
+
+            for start in set([0, nrows - 1]):
+                if start < 0:
+                    continue
+                row = _read_seq_data_rows(in_filename, key, start, start + 1)
+                merged_row = _read_seq_data_rows(merged_filename, key, start, start + 1)
+                if not np.array_equal(row.values, merged_row[row.columns].values):
+                    raise ValueError('table {} of {} differs at row {} in merged seqdata {}'.format(
+                        key, in_filename, start, merged_filename))
+
+            if _get_sort_column(key) is None:
+                continue
+
+            checksum = _calculate_seq_data_checksum(in_filename, key)
+            merged_checksum = _calculate_seq_data_checksum(merged_filename, key)
+
+            if merged_checksum != checksum:
+                raise ValueError('table {} of {} has {} sum {} in merged seqdata {}, expected {}'.format(
+                    key, in_filename, _get_sort_column(key), merged_checksum, merged_filename, checksum))
+
+    # Tables are per chromosome and record type, so additional tables in the
+    # merged seqdata are chromosomes not present in any input
+    extra_keys = set(merged_nrows.keys()) - set(expected_nrows.keys())
+    if len(extra_keys) > 0:
+        raise ValueError('tables {} of merged seqdata {} are not in the inputs'.format(
+            ', '.join(sorted(extra_keys)), merged_filename))
+
+
+def _get_sort_column(key):
+    return _sort_columns.get(key.strip('/').split('/')[0])
+
+
+class _BlockIndex(object):
+    """ Coarse index of a table sorted by a column.
+
+    Records the value of the sort column at the first row of each block of
+    rows, and whether the rows appended so far are sorted.
+
+    """
+
+    def __init__(self, column, block_size=_index_block_size):
+        self.column = column
+        self.block_size = block_size
+        self.nrows = 0
+        self.is_sorted = True
+        self.last_value = None
+        self.values = list()
+
+    def update(self, data):
+        values = data[self.column].values
+
+        if len(values) == 0:
+            return
+
+        if self.is_sorted:
+            if self.last_value is not None and values[0] < self.last_value:
+                self.is_sorted = False
+            elif np.any(values[1:] < values[:-1]):
+                self.is_sorted = False
+
+        self.last_value = values[-1]
+        self.values.extend(values[-self.nrows % self.block_size::self.block_size])
+        self.nrows += len(values)
+
+    def to_dict(self):
+        if not self.is_sorted:
+            return None
+
+        return {
+            'sorted_by': self.column,
+            'block_size': self.block_size,
+            'block_index': [int(a) for a in self.values],
+        }
+
+
+class _TableStore(object):
+    """ Base class for append only table storage, indexing sorted tables.
+    """
+
+    def __init__(self):
+        self.block_indices = dict()
+
+    def _update_index(self, key, data):
+        column = _get_sort_column(key)
+
+        if column is None or column not in data:
+            return
+
+        if key not in self.block_indices:
+            self.block_indices[key] = _BlockIndex(column)
+
+        self.block_indices[key].update(data)
+
+    def _get_index(self, key):
+        if key not in self.block_indices:
+            return None
+
+        return self.block_indices[key].to_dict()
+
+
+class _SortingTableStore(object):
+    """ Sort nearly sorted tables while appending to another table store.
+
+    Args:
+        store (object): table store to which sorted rows are appended
+        max_disorder (int): maximum distance by which the sort column of a
+            row can be less than that of any previous row
+
+    Rows are buffered until no row appended later can sort before them.
+    Rows out of order by more than max_disorder raise ValueError.
+
+    """
+
+    def __init__(self, store, max_disorder):
+        self.store = store
+        self.max_disorder = max_disorder
+        self.pending = dict()
+        self.max_value = dict()
+        self.last_value = dict()
+
+    def append(self, key, data):
+        column = _get_sort_column(key)
+
+        if column is None:
+            self.store.append(key, data)
+            return
+
+        if key in self.pending:
+            data = pd.concat([self.pending[key], data], ignore_index=True)
+
+        if len(data.index) > 0:
+            self.max_value[key] = max(self.max_value.get(key, data[column].min()), data[column].max())
+
+        is_ready = data[column] < self.max_value.get(key, 0) - self.max_disorder
+
+        self.pending[key] = data[~is_ready]
+        self._append_sorted(key, data[is_ready])
+
+    def _append_sorted(self, key, data):
+        if len(data.index) == 0:
+            return
+
+        column = _get_sort_column(key)
+        data = data.sort_values(column, kind='mergesort')
+
+        if key in self.last_value and data[column].iloc[0] < self.last_value[key]:
+            raise ValueError('rows of {} out of order by more than {}'.format(key, self.max_disorder))
+
+        self.last_value[key] = data[column].iloc[-1]
+        self.store.append(key, data.reset_index(drop=True))
+
+    def close(self):
+        for key, data in self.pending.iteritems():
+            self._append_sorted(key, data)
+
+        self.store.close()
+
+
+class _HDFTableStore(_TableStore):
+    """ Append only table storage in a compressed pandas hdf store.
+    """
+
+    def __init__(self, seqdata_filename, complib='zlib', complevel=9):
+        super(_HDFTableStore, self).__init__()
+        self.store = pd.HDFStore(seqdata_filename, 'w', complevel=complevel, complib=complib)
+
+    def append(self, key, data):
+        self._update_index(key, data)
+        _unique_index_append(self.store, key, data)
+
+    def close(self):
+        for key in self.block_indices.keys():
+            _write_hdf_block_index(self.store, key, self._get_index(key))
+
+        self.store.close()
+
+
+def _write_hdf_block_index(store, key, block_index):
+    if block_index is None:
+        return
+
+    attrs = store.get_storer(key).attrs
+    attrs.remixt_sorted_by = block_index['sorted_by']
+    attrs.remixt_block_size = block_index['block_size']
+    attrs.remixt_block_index = np.array(block_index['block_index'], dtype=np.int64)
+
+
+def _read_block_index(seqdata_filename, key):
+    """ Read the block index of a sorted table, None if the table is not sorted.
+    """
+
+    if get_seqdata_format(seqdata_filename) == 'columnar':
+        table = _read_columnar_manifest(seqdata_filename)['tables'].get(key)
+
+        if table is None or table.get('sorted_by') is None:
+            return None
+
+        return {
+            'sorted_by': str(table['sorted_by']),
+            'block_size': table['block_size'],
+            'block_index': table['block_index'],
+        }
+
+    seqdata_filename, key = _resolve_hdf_key(seqdata_filename, key)
+
+    with pd.HDFStore(seqdata_filename, 'r') as store:
+        try:
+            attrs = store.get_storer(key).attrs
+        except (AttributeError, KeyError):
+            return None
+
+        if 'remixt_sorted_by' not in attrs:
+            return None
+
+        return {
+            'sorted_by': str(attrs.remixt_sorted_by),
+            'block_size': int(attrs.remixt_block_size),
+            'block_index': [int(a) for a in attrs.remixt_block_index],
+        }
+
+
+class _ColumnarTableStore(_TableStore):
+    """ Append only table storage as flat typed columns in a single file.
+
+    Columns are spilled to a temporary directory while appending, and
+    concatenated into the seqdata file on close.  The file starts with
+    a magic string, followed by the raw little endian column arrays, each
+    aligned for memory mapping, followed by a json manifest giving the
+    offset, length and dtype of each column.  The last 16 bytes of the
+    file give the offset of the manifest and a repeat of the magic string.
+
+    """
 
-class Writer(object):
     def __init__(self, seqdata_filename):
+        super(_ColumnarTableStore, self).__init__()
+        self.seqdata_filename = seqdata_filename
+        self.spill_dir = seqdata_filename + '.spill'
+        self.tables = dict()
+
+        if os.path.exists(self.spill_dir):
+            shutil.rmtree(self.spill_dir)
+        os.makedirs(self.spill_dir)
+
+    def _spill_filename(self, key, column):
+        return os.path.join(self.spill_dir, '{}.{}'.format(key.strip('/').replace('/', '.'), column))
+
+    def append(self, key, data):
+        if key not in self.tables:
+            self.tables[key] = {
+                'nrows': 0,
+                'columns': [(col, data[col].dtype.newbyteorder('<').str) for col in data.columns],
+            }
+
+        table = self.tables[key]
+
+        if [col for col, _ in table['columns']] != list(data.columns):
+            raise ValueError('inconsistent columns for {}'.format(key))
+
+        for col, dtype in table['columns']:
+            with open(self._spill_filename(key, col), 'ab') as f:
+                np.ascontiguousarray(data[col].values, dtype=dtype).tofile(f)
+
+        table['nrows'] += len(data.index)
+
+        self._update_index(key, data)
+
+    def close(self):
+        manifest = {'format': 'columnar', 'version': 1, 'tables': dict()}
+
+        with open(self.seqdata_filename, 'wb') as f:
+            f.write(_columnar_magic)
+
+            for key, table in self.tables.iteritems():
+                columns = list()
+
+                for col, dtype in table['columns']:
+                    f.write('\0' * (-f.tell() % _columnar_alignment))
+                    columns.append({'name': col, 'dtype': dtype, 'offset': f.tell()})
+
+                    with open(self._spill_filename(key, col), 'rb') as spill:
+                        shutil.copyfileobj(spill, f)
+
+                manifest['tables'][key] = {'nrows': table['nrows'], 'columns': columns}
+
+                block_index = self._get_index(key)
+                if block_index is not None:
+                    manifest['tables'][key].update(block_index)
+
+            manifest_offset = f.tell()
+            f.write(json.dumps(manifest))
+            f.write(_columnar_footer.pack(manifest_offset, _columnar_magic))
+
+        shutil.rmtree(self.spill_dir)
+
+
+def _create_table_store(seqdata_filename, seqdata_format, complib='zlib', complevel=9):
+    if seqdata_format == 'hdf':
+        return _HDFTableStore(seqdata_filename, complib=complib, complevel=complevel)
+    elif seqdata_format == 'columnar':
+        return _ColumnarTableStore(seqdata_filename)
+    else:
+        raise ValueError('unknown seqdata format {}'.format(seqdata_format))
+
+
+def get_seqdata_format(seqdata_filename):
+    """ Identify the storage format of a seqdata file.
+
+    Args:
+        seqdata_filename (str): name of seqdata file
+
+    Returns:
+        str: 'columnar' or 'hdf'
+
+    """
+
+    with open(seqdata_filename, 'rb') as f:
+        if f.read(len(_columnar_magic)) == _columnar_magic:
+            return 'columnar'
+
+    return 'hdf'
+
+
+def _read_columnar_manifest(seqdata_filename):
+    with open(seqdata_filename, 'rb') as f:
+        f.seek(-_columnar_footer.size, os.SEEK_END)
+        manifest_end = f.tell()
+        manifest_offset, magic = _columnar_footer.unpack(f.read(_columnar_footer.size))
+
+        if magic != _columnar_magic:
+            raise ValueError('truncated or corrupt columnar seqdata {}'.format(seqdata_filename))
+
+        f.seek(manifest_offset)
+        manifest = json.loads(f.read(manifest_end - manifest_offset))
+
+    # Keys and column names as str for consistency with hdf seqdata
+    manifest['tables'] = dict([(str(key), table) for key, table in manifest['tables'].iteritems()])
+
+    return manifest
+
+
+def read_seq_columns(seqdata_filename, record_type, chromosome, start=None, stop=None):
+    """ Read memory mapped columns from a columnar seqdata file.
+
+    Args:
+        seqdata_filename (str): name of columnar seqdata file
+        record_type (str): record type, can be 'alleles' or 'fragments'
+        chromosome (str): select specific chromosome
+
+    KwArgs:
+        start (int): first row to read
+        stop (int): one past the last row to read
+
+    Returns:
+        dict of numpy.memmap: read only views of each column
+
+    """
+
+    return _read_columnar_columns(seqdata_filename, _get_key(record_type, chromosome), start=start, stop=stop)
+
+
+def _read_columnar_columns(seqdata_filename, key, start=None, stop=None, manifest=None):
+    if manifest is None:
+        manifest = _read_columnar_manifest(seqdata_filename)
+
+    table = manifest['tables'].get(key)
+    if table is None:
+        raise KeyError(key)
+
+    nrows = table['nrows']
+    columns = collections.OrderedDict()
+
+    for column in table['columns']:
+        if nrows == 0:
+            values = np.zeros((0,), dtype=column['dtype'])
+        else:
+            values = np.memmap(seqdata_filename, dtype=column['dtype'], mode='r', offset=column['offset'], shape=(nrows,))
+        columns[str(column['name'])] = values[start:stop]
+
+    return columns
+
+
+def _read_columnar_table(seqdata_filename, key, start=None, stop=None, manifest=None):
+    # Tables are built from copies of the memory mapped columns, readers
+    # requiring views use read_seq_data_columns
+    columns = _read_columnar_columns(seqdata_filename, key, start=start, stop=stop, manifest=manifest)
+    nrows = len(columns.values()[0])
+    index_start = 0 if start is None else start
+    return pd.DataFrame(columns, index=pd.RangeIndex(index_start, index_start + nrows))
+
+
+class Writer(object):
+    def __init__(self, seqdata_filename, seqdata_format='hdf', complib='zlib', complevel=9):
         """ Streaming writer of seq data hdf5 files 
 
         Args:
             seqdata_filename (str): name of seqdata hdf5 file
 
+        KwArgs:
+            seqdata_format (str): 'hdf' for a compressed hdf store, 'columnar' for memory mappable columns
+            complib (str): compression library for hdf seqdata, as for `pandas.HDFStore`
+            complevel (int): compression level for hdf seqdata, 0 for no compression
+
         """
 
-        self.store = pd.HDFStore(seqdata_filename, 'w', complevel=9, complib='zlib')
+        self.store = _create_table_store(seqdata_filename, seqdata_format, complib=complib, complevel=complevel)
 
     def write(self, chromosome, fragment_data, allele_data):
         """ Write a chunk of reads and alleles data
@@ -108,8 +813,8 @@ class Writer(object):
         fragment_data = fragment_data[['fragment_id', 'start', 'end', 'is_duplicate', 'mapping_quality']]
         allele_data = allele_data[['position', 'fragment_id', 'is_alt']]
 
-        _unique_index_append(self.store, _get_key('fragments', chromosome), fragment_data)
-        _unique_index_append(self.store, _get_key('alleles', chromosome), allele_data)
+        self.store.append(_get_key('fragments', chromosome), fragment_data)
+        self.store.append(_get_key('alleles', chromosome), allele_data)
 
     def close(self):
         """ Close seq data file
@@ -122,15 +827,31 @@ class Writer(object):
 _identity = lambda x: x
 
 
+def _read_seq_data_rows(seqdata_filename, key, start=None, stop=None):
+    if get_seqdata_format(seqdata_filename) == 'columnar':
+        return _read_columnar_table(seqdata_filename, key, start=start, stop=stop)
+
+    seqdata_filename, key = _resolve_hdf_key(seqdata_filename, key)
+    return pd.read_hdf(seqdata_filename, key, start=start, stop=stop)
+
+
 def _read_seq_data_full(seqdata_filename, record_type, chromosome, post=_identity):
     key = _get_key(record_type, chromosome)
     try:
-        return post(pd.read_hdf(seqdata_filename, key))
+        return post(_read_seq_data_rows(seqdata_filename, key))
     except KeyError:
         return empty_data[record_type]
 
 
 def _get_seq_data_nrows(seqdata_filename, key):
+    if get_seqdata_format(seqdata_filename) == 'columnar':
+        table = _read_columnar_manifest(seqdata_filename)['tables'].get(key)
+        if table is None:
+            return 0
+        return table['nrows']
+
+    seqdata_filename, key = _resolve_hdf_key(seqdata_filename, key)
+
     with pd.HDFStore(seqdata_filename, 'r') as store:
         try:
             return store.get_storer(key).nrows
@@ -143,12 +864,96 @@ def _read_seq_data_chunks(seqdata_filename, record_type, chromosome, chunksize,
     nrows = _get_seq_data_nrows(seqdata_filename, key)
     if nrows == 0:
         yield empty_data[record_type]
+    elif get_seqdata_format(seqdata_filename) == 'columnar':
+        manifest = _read_columnar_manifest(seqdata_filename)
+        for i in xrange(nrows//chunksize + 1):
+            yield post(_read_columnar_table(seqdata_filename, key, start=i*chunksize, stop=(i+1)*chunksize, manifest=manifest))
     else:
+        seqdata_filename, key = _resolve_hdf_key(seqdata_filename, key)
         for i in xrange(nrows//chunksize + 1):
             yield post(pd.read_hdf(seqdata_filename, key, start=i*chunksize, stop=(i+1)*chunksize))
 
 
-def read_seq_data(seqdata_filename, record_type, chromosome, chunksize=None, post=_identity):
+def _merge_regions(regions):
+    """ Sort and merge overlapping half open regions, None for unbounded.
+    """
+
+    regions = np.array(
+        [(np.iinfo(np.int64).min if start is None else start, np.iinfo(np.int64).max if end is None else end)
+         for start, end in regions], dtype=np.int64).reshape(-1, 2)
+
+    regions = regions[regions[:, 0] < regions[:, 1]]
+    regions = regions[np.argsort(regions[:, 0], kind='mergesort')]
+
+    if len(regions) == 0:
+        return regions
+
+    # Start a new merged region where a region starts after all previous ends
+    previous_end = np.maximum.accumulate(regions[:, 1])
+    is_new = np.concatenate([[True], regions[1:, 0] > previous_end[:-1]])
+    new_idx = np.flatnonzero(is_new)
+
+    return np.array([regions[new_idx, 0], np.maximum.reduceat(regions[:, 1], new_idx)]).T
+
+
+def _get_region_rows(seqdata_filename, key, regions):
+    """ Row ranges of a table containing all records in merged regions.
+    """
+
+    nrows = _get_seq_data_nrows(seqdata_filename, key)
+
+    if nrows == 0 or len(regions) == 0:
+        return []
+
+    block_index = _read_block_index(seqdata_filename, key)
+
+    if block_index is None:
+        return [(0, nrows)]
+
+    values = block_index['block_index']
+    block_size = block_index['block_size']
+
+    # Rows equal to start may be at the end of the block preceding the first
+    # block starting at or after start
+    row_starts = np.maximum(0, np.searchsorted(values, regions[:, 0], side='left') - 1) * block_size
+    row_stops = np.minimum(nrows, np.searchsorted(values, regions[:, 1], side='left') * block_size)
+
+    # Merge row ranges of regions sharing blocks
+    row_ranges = list()
+    for row_start, row_stop in zip(row_starts, row_stops):
+        if row_start >= row_stop:
+            continue
+        if len(row_ranges) > 0 and row_start <= row_ranges[-1][1]:
+            row_ranges[-1] = (row_ranges[-1][0], max(row_ranges[-1][1], row_stop))
+        else:
+            row_ranges.append((row_start, row_stop))
+
+    return row_ranges
+
+
+def _filter_regions(values, regions):
+    region_idx = np.searchsorted(regions[:, 0], values, side='right') - 1
+    return (region_idx >= 0) & (values < regions[np.maximum(region_idx, 0), 1])
+
+
+def _read_seq_data_region_chunks(seqdata_filename, record_type, chromosome, regions, chunksize, post=_identity):
+    key = _get_key(record_type, chromosome)
+    column = _sort_columns[record_type]
+
+    row_ranges = _get_region_rows(seqdata_filename, key, regions)
+
+    if len(row_ranges) == 0:
+        yield empty_data[record_type]
+        return
+
+    for row_start, row_stop in row_ranges:
+        for chunk_start in xrange(row_start, row_stop, chunksize):
+            data = _read_seq_data_rows(seqdata_filename, key, start=chunk_start, stop=min(row_stop, chunk_start + chunksize))
+            data = data[_filter_regions(data[column].values, regions)]
+            yield post(data)
+
+
+def read_seq_data(seqdata_filename, record_type, chromosome, chunksize=None, post=_identity, start=None, end=None, regions=None):
     """ Read sequence data from a HDF seqdata file.
 
     Args:
@@ -159,19 +964,205 @@ def read_seq_data(seqdata_filename, record_type, chromosome, chunksize=None, pos
     KwArgs:
         chunksize (int): number of rows to stream at a time, None for the entire file
         post (callable): post processing function
+        start (int): read only records at or after this position
+        end (int): read only records before this position
+        regions (list): read only records within any of these (start, end) intervals
 
     Yields:
         pandas.DataFrame
 
+    Both hdf and columnar seqdata files are supported, the format is detected
+    from the file contents.
+
+    Region queries select fragments by start and alleles by position, within
+    half open intervals.  Tables written sorted have a block index, from which
+    only the blocks overlapping the regions are read, otherwise the entire
+    table is scanned.
+
     """
 
+    if start is not None or end is not None:
+        if regions is not None:
+            raise ValueError('specify either start and end or regions')
+        regions = [(start, end)]
+
+    if regions is not None:
+        chunks = _read_seq_data_region_chunks(
+            seqdata_filename, record_type, chromosome, _merge_regions(regions),
+            chunksize or _index_block_size * 64, post=post)
+        if chunksize is None:
+            return pd.concat(list(chunks), ignore_index=True)
+        return chunks
+
     if chunksize is None:
         return _read_seq_data_full(seqdata_filename, record_type, chromosome, post=post)
     else:
         return _read_seq_data_chunks(seqdata_filename, record_type, chromosome, chunksize, post=post)
 
 
-def read_fragment_data(seqdata_filename, chromosome, filter_duplicates=False, map_qual_threshold=1, chunksize=None):
+def _read_seq_data_row_columns(seqdata_filename, key, columns, seqdata_format, start=None, stop=None, manifest=None):
+    if seqdata_format == 'columnar':
+        data = _read_columnar_columns(seqdata_filename, key, start=start, stop=stop, manifest=manifest)
+        return collections.OrderedDict([(column, data[column]) for column in columns])
+
+    data = pd.read_hdf(seqdata_filename, key, start=start, stop=stop, columns=list(columns))
+    return collections.OrderedDict([(column, data[column].values) for column in columns])
+
+
+def _select_columns(data, columns, is_selected=None):
+    if is_selected is not None and not np.all(is_selected):
+        return collections.OrderedDict([(column, data[column][is_selected]) for column in columns])
+    return collections.OrderedDict([(column, data[column]) for column in columns])
+
+
+def read_seq_data_columns(seqdata_filename, record_type, chromosome, columns, chunksize=None, regions=None):
+    """ Read columns of sequence data as numpy arrays.
+
+    Args:
+        seqdata_filename (str): name of seqdata file
+        record_type (str): record type, can be 'alleles' or 'fragments'
+        chromosome (str): select specific chromosome
+        columns (list of str): columns to read
+
+    KwArgs:
+        chunksize (int): number of rows to stream at a time, None for the entire table
+        regions (list): read only records within any of these (start, end) intervals
+
+    Yields:
+        dict of numpy.array: values of each column for each chunk
+
+    Columns of columnar seqdata are memory mapped views of the file, copied
+    only where records are selected by region.  Only the requested columns
+    are read from hdf seqdata.  At least one, possibly empty, chunk is yielded.
+
+    """
+
+    key = _get_key(record_type, chromosome)
+    sort_column = _sort_columns[record_type]
+    seqdata_format = get_seqdata_format(seqdata_filename)
+
+    read_columns = list(columns)
+    if regions is not None:
+        regions = _merge_regions(regions)
+        if sort_column not in read_columns:
+            read_columns.append(sort_column)
+        row_ranges = _get_region_rows(seqdata_filename, key, regions)
+    else:
+        nrows = _get_seq_data_nrows(seqdata_filename, key)
+        row_ranges = [(0, nrows)] if nrows > 0 else []
+
+    if len(row_ranges) == 0:
+        yield collections.OrderedDict([(column, empty_data[record_type][column].values) for column in columns])
+        return
+
+    manifest = None
+    if seqdata_format == 'columnar':
+        manifest = _read_columnar_manifest(seqdata_filename)
+    else:
+        seqdata_filename, key = _resolve_hdf_key(seqdata_filename, key)
+
+    for row_start, row_stop in row_ranges:
+        row_chunksize = chunksize or (row_stop - row_start)
+        for chunk_start in xrange(row_start, row_stop, row_chunksize):
+            data = _read_seq_data_row_columns(
+                seqdata_filename, key, read_columns, seqdata_format,
+                start=chunk_start, stop=min(row_stop, chunk_start + row_chunksize), manifest=manifest)
+
+            is_selected = None
+            if regions is not None:
+                is_selected = _filter_regions(data[sort_column], regions)
+
+            yield _select_columns(data, columns, is_selected)
+
+
+def read_fragment_columns(seqdata_filename, chromosome, columns, filter_duplicates=False, map_qual_threshold=1, chunksize=None, regions=None):
+    """ Read columns of filtered fragment data as numpy arrays.
+
+    Args:
+        seqdata_filename (str): name of seqdata file
+        chromosome (str): select specific chromosome
+        columns (list of str): columns to read, from 'fragment_id', 'start', 'end'
+
+    KwArgs:
+        filter_duplicates (bool): filter reads marked as duplicate
+        map_qual_threshold (int): filter reads with less than this mapping quality
+        chunksize (int): number of rows to stream at a time, None for the entire table
+        regions (list): read only fragments starting within any of these (start, end) intervals
+
+    Yields:
+        dict of numpy.array: values of each column for each chunk
+
+    Fragments are filtered as for `filter_fragment_data`.  Columns of columnar
+    seqdata are memory mapped views of the file where no fragments are filtered.
+
+    """
+
+    filter_columns = list()
+    if filter_duplicates:
+        filter_columns.append('is_duplicate')
+    if map_qual_threshold is not None:
+        filter_columns.append('mapping_quality')
+
+    read_columns = list(columns) + [a for a in filter_columns if a not in columns]
+
+    for data in read_seq_data_columns(seqdata_filename, 'fragments', chromosome, read_columns, chunksize=chunksize, regions=regions):
+        is_selected = np.ones(len(data[read_columns[0]]), dtype=bool)
+        if filter_duplicates:
+            is_selected &= (data['is_duplicate'] == 0)
+        if map_qual_threshold is not None:
+            is_selected &= (data['mapping_quality'] >= map_qual_threshold)
+
+        yield _select_columns(data, columns, is_selected)
+
+
+def is_seq_data_sorted(seqdata_filename, record_type, chromosome):
+    """ Check whether sequence data was written sorted.
+
+    Args:
+        seqdata_filename (str): name of seqdata file
+        record_type (str): record type, can be 'alleles' or 'fragments'
+        chromosome (str): select specific chromosome
+
+    Returns:
+        bool: fragments are sorted by start, or alleles by position
+
+    """
+
+    return _read_block_index(seqdata_filename, _get_key(record_type, chromosome)) is not None
+
+
+def filter_fragment_data(reads, filter_duplicates=False, map_qual_threshold=1):
+    """ Filter fragment data on duplicate status and mapping quality.
+
+    Args:
+        reads (pandas.DataFrame): fragment data
+
+    KwArgs:
+        filter_duplicates (bool): filter reads marked as duplicate
+        map_qual_threshold (int): filter reads with less than this mapping quality
+
+    Returns:
+        pandas.DataFrame
+
+    The 'is_duplicate' and 'mapping_quality' columns are removed.
+
+    """
+
+    # Filter duplicates if necessary
+    if 'is_duplicate' in reads and filter_duplicates is not None:
+        if filter_duplicates:
+            reads = reads[reads['is_duplicate'] == 0]
+        reads = reads.drop(['is_duplicate'], axis=1)
+
+    # Filter poor quality reads
+    if 'mapping_quality' in reads and map_qual_threshold is not None:
+        reads = reads[reads['mapping_quality'] >= map_qual_threshold]
+        reads = reads.drop(['mapping_quality'], axis=1)
+
+    return reads
+
+
+def read_fragment_data(seqdata_filename, chromosome, filter_duplicates=False, map_qual_threshold=1, chunksize=None, start=None, end=None, regions=None):
     """ Read fragment data from a HDF seqdata file.
 
     Args:
@@ -182,6 +1173,9 @@ def read_fragment_data(seqdata_filename, chromosome, filter_duplicates=False, ma
         filter_duplicates (bool): filter reads marked as duplicate
         map_qual_threshold (int): filter reads with less than this mapping quality
         chunksize (int): number of rows to stream at a time, None for the entire file
+        start (int): read only fragments starting at or after this position
+        end (int): read only fragments starting before this position
+        regions (list): read only fragments starting within any of these (start, end) intervals
 
     Yields:
         pandas.DataFrame
@@ -191,23 +1185,12 @@ def read_fragment_data(seqdata_filename, chromosome, filter_duplicates=False, ma
     """
 
     def filter_reads(reads):
-        # Filter duplicates if necessary
-        if 'is_duplicate' in reads and filter_duplicates is not None:
-            if filter_duplicates:
-                reads = reads[reads['is_duplicate'] == 0]
-            reads.drop(['is_duplicate'], axis=1, inplace=True)
-
-        # Filter poor quality reads
-        if 'mapping_quality' in reads and map_qual_threshold is not None:
-            reads = reads[reads['mapping_quality'] >= map_qual_threshold]
-            reads.drop(['mapping_quality'], axis=1, inplace=True)
+        return filter_fragment_data(reads, filter_duplicates=filter_duplicates, map_qual_threshold=map_qual_threshold)
 
-        return reads
+    return read_seq_data(seqdata_filename, 'fragments', chromosome, chunksize=chunksize, post=filter_reads, start=start, end=end, regions=regions)
 
-    return read_seq_data(seqdata_filename, 'fragments', chromosome, chunksize=chunksize, post=filter_reads)
 
-
-def read_allele_data(seqdata_filename, chromosome, chunksize=None):
+def read_allele_data(seqdata_filename, chromosome, chunksize=None, start=None, end=None, regions=None):
     """ Read allele data from a HDF seqdata file.
 
     Args:
@@ -216,6 +1199,9 @@ def read_allele_data(seqdata_filename, chromosome, chunksize=None):
 
     KwArgs:
         chunksize (int): number of rows to stream at a time, None for the entire file
+        start (int): read only alleles at or after this position
+        end (int): read only alleles before this position
+        regions (list): read only alleles within any of these (start, end) intervals
 
     Yields:
         pandas.DataFrame
@@ -224,7 +1210,7 @@ def read_allele_data(seqdata_filename, chromosome, chunksize=None):
 
     """
 
-    return read_seq_data(seqdata_filename, 'alleles', chromosome, chunksize=chunksize)
+    return read_seq_data(seqdata_filename, 'alleles', chromosome, chunksize=chunksize, start=start, end=end, regions=regions)
 
 
 def read_chromosomes(seqdata_filename):
@@ -238,12 +1224,11 @@ def read_chromosomes(seqdata_filename):
 
     """
 
-    with pd.HDFStore(seqdata_filename, 'r') as store:
-        chromosomes = set()
-        for key in store.keys():
-            if 'chromosome_' in key:
-                chromosomes.add(key[key.index('chromosome_') + len('chromosome_'):])
+    chromosomes = set()
+    for key in _read_seq_data_keys(seqdata_filename):
+        if 'chromosome_' in key:
+            chromosomes.add(key[key.index('chromosome_') + len('chromosome_'):])
 
-        return chromosomes
+    return chromosomes
 
 
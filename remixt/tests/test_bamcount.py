@@ -0,0 +1,129 @@
+import os
+import unittest
+import numpy as np
+import pandas as pd
+
+import remixt.seqdataio
+import remixt.analysis.bamcount
+import remixt.analysis.gcbias
+import remixt.analysis.haplotype
+import remixt.analysis.segment
+
+
+np.random.seed(2014)
+
+
+def generate_read_data(num_reads=50000, chromosome_length=int(1e7), max_fragment_length=1000):
+
+    fragments = pd.DataFrame({'start':np.sort(np.random.randint(0, chromosome_length, size=num_reads))})
+    fragments['end'] = fragments['start'] + np.random.randint(100, 500, size=num_reads)
+    fragments['fragment_id'] = np.arange(num_reads)
+    fragments['is_duplicate'] = np.random.randint(0, 2, size=num_reads)
+    fragments['mapping_quality'] = np.random.randint(0, 3, size=num_reads)
+
+    # Up to two snps per fragment at positions within the fragment, sorted by
+    # position as produced by the reader
+    alleles = list()
+    for offset in (1, 200):
+        fragment_alleles = pd.DataFrame({
+            'fragment_id':fragments['fragment_id'].values,
+            'position':(fragments['start'].values + offset) // 100 * 100,
+            'is_alt':np.random.randint(0, 2, size=num_reads),
+        })
+        fragment_alleles = fragment_alleles[
+            (fragment_alleles['position'] > fragments['start'].values) &
+            (fragment_alleles['position'] <= fragments['end'].values)]
+        alleles.append(fragment_alleles)
+    alleles = pd.concat(alleles, ignore_index=True)
+    alleles.sort_values(['position', 'fragment_id'], inplace=True, kind='mergesort')
+    alleles.reset_index(drop=True, inplace=True)
+
+    return fragments, alleles
+
+
+def stream_read_data(fragments, alleles, num_chunks=7, lag=500):
+    """ Split read data into chunks with alleles produced after their fragment.
+    """
+
+    boundaries = np.linspace(0, fragments['end'].max() + lag + 1, num_chunks + 1).astype(int)
+
+    for chunk_start, chunk_end in zip(boundaries[:-1], boundaries[1:]):
+        fragments_chunk = fragments[(fragments['start'] >= chunk_start) & (fragments['start'] < chunk_end)]
+        alleles_chunk = alleles[(alleles['position'] + lag >= chunk_start) & (alleles['position'] + lag < chunk_end)]
+        yield fragments_chunk.copy(), alleles_chunk.copy()
+
+
+class bamcount_unittest(unittest.TestCase):
+
+    def test_chromosome_counter(self):
+
+        seqdata_filename = './test.bamcount.seqdata'
+
+        fragments, alleles = generate_read_data()
+
+        writer = remixt.seqdataio.Writer(seqdata_filename, seqdata_format='columnar')
+        writer.write('1', fragments.copy(), alleles.copy())
+        writer.close()
+
+        boundaries = np.arange(0, int(1e7) + 1, 500000)
+        segments = pd.DataFrame({'chromosome':'1', 'start':boundaries[:-1], 'end':boundaries[1:]})
+
+        snp_positions = np.unique(alleles['position'].values)
+        snp_positions = snp_positions[np.random.random(size=snp_positions.shape) < 0.5]
+        haps = pd.DataFrame({'position':snp_positions, 'allele':0})
+        haps = pd.concat([haps, haps.assign(allele=1)], ignore_index=True)
+        haps['chromosome'] = '1'
+        haps['hap_label'] = haps['position'] // 100000
+        haps['allele_id'] = (haps['allele'] + haps['hap_label']) % 2
+
+        gc_positions = np.sort(np.random.randint(0, int(1e7), size=10000))
+
+        counter = remixt.analysis.bamcount.ChromosomeCounter(
+            segments=segments,
+            haps=haps,
+            gc_positions=gc_positions,
+            filter_duplicates=True,
+            map_qual_threshold=1,
+            record_alleles=True,
+        )
+
+        for fragments_chunk, alleles_chunk in stream_read_data(fragments, alleles):
+            counter.add(fragments_chunk, alleles_chunk)
+
+        # Segment counts
+        segment_counts = remixt.analysis.segment.count_segment_reads(
+            seqdata_filename, '1', segments.copy(), filter_duplicates=True, map_qual_threshold=1)
+        self.assertTrue(np.all(segment_counts['readcount'].values == counter.get_segment_counts()['readcount'].values))
+
+        # Allele counts, streamed and from recorded alleles
+        columns = ['chromosome', 'start', 'end', 'hap_label', 'allele_id', 'readcount']
+        allele_counts = remixt.analysis.haplotype.count_allele_reads(
+            seqdata_filename, haps, '1', segments.copy(), filter_duplicates=True, map_qual_threshold=1)
+        allele_counts = allele_counts[columns].sort_values(columns).values
+
+        self.assertTrue(len(allele_counts) > 0)
+
+        allele_counts_test = counter.get_allele_counts('1')[columns].sort_values(columns).values
+        self.assertTrue(np.all(allele_counts == allele_counts_test))
+
+        allele_counts_test = remixt.analysis.bamcount.count_haplotype_allele_reads(
+            counter.get_allele_reads(), haps, segments, '1')[columns].sort_values(columns).values
+        self.assertTrue(np.all(allele_counts == allele_counts_test))
+
+        # Snp counts
+        snp_counts = remixt.analysis.haplotype.read_snp_counts(seqdata_filename, '1')
+        snp_counts_test = counter.get_snp_counts()
+        for col in ('position', 'ref_count', 'alt_count'):
+            self.assertTrue(np.all(snp_counts[col].values == snp_counts_test[col].values))
+
+        # Gc position counts
+        reads = remixt.seqdataio.read_fragment_data(seqdata_filename, '1', filter_duplicates=True, map_qual_threshold=1)
+        gc_read_count = remixt.analysis.gcbias.count_position_reads(gc_positions, reads['start'].values)
+        self.assertTrue(np.all(gc_read_count == counter.gc_read_count))
+
+        os.remove(seqdata_filename)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
@@ -0,0 +1,655 @@
+import os
+import shutil
+import tempfile
+import unittest
+import collections
+import numpy as np
+
+import remixt.simulations.simple as sim_simple
+import remixt.cn_model as cn_model
+import remixt.analysis.pipeline
+
+
+np.random.seed(2014)
+
+
+def generate_breakpoint_model_data(N=100, M=3, depth=1.):
+
+    r = 200.
+
+    l = np.random.uniform(low=500000, high=1000000, size=N)
+    cn = sim_simple.generate_cn(N, M, 2.0, 0.5, 0.5, 1)
+    h = np.array([0.05, 0.08, 0.04])[:M] * depth
+
+    depth = (h[np.newaxis, :, np.newaxis] * cn).sum(axis=1)
+
+    mu_total = depth.sum(axis=1) * l
+    x_total = np.random.negative_binomial(r, r / (r + mu_total))
+
+    mu_allele = depth * l[:, np.newaxis] * 0.05
+    x_allele = np.random.negative_binomial(r, r / (r + mu_allele))
+    x_allele = np.sort(x_allele, axis=1)[:, ::-1]
+
+    x = np.array([x_allele[:, 0], x_allele[:, 1], x_total]).T
+
+    adjacencies = set([(n, n + 1) for n in range(N - 1)])
+    breakpoints = {0: frozenset([(N // 4, 1), (N // 2, 0)])}
+
+    return cn, h, l, x, adjacencies, breakpoints
+
+
+class bpmodel_unittest(unittest.TestCase):
+
+    def create_breakpoint_model(self, data, **kwargs):
+        cn, h, l, x, adjacencies, breakpoints = data
+
+        model = cn_model.BreakpointModel(
+            x, l, adjacencies, breakpoints,
+            max_copy_number=4,
+            max_depth=1e9,
+            **kwargs)
+
+        model.num_em_iter = 2
+        model.num_update_iter = 2
+
+        return model
+
+    def fit_breakpoint_model(self, data, **kwargs):
+        cn, h, l, x, adjacencies, breakpoints = data
+
+        model = self.create_breakpoint_model(data, **kwargs)
+
+        # Same likelihood samples for fits being compared
+        np.random.seed(2015)
+
+        model.fit(h * np.array([1., 0.9, 1.1])[:h.shape[0]])
+
+        return model
+
+    def create_remixt_model(self, data, **kwargs):
+        """ Create the underlying model with outlier and allele swap indicators
+        updated from the initial approximating HMM.
+        """
+        cn, h, l, x, adjacencies, breakpoints = data
+
+        model = self.create_breakpoint_model(data, **kwargs)
+        model.create_model(h * np.array([1., 0.9, 1.1])[:h.shape[0]])
+
+        model = model.model
+        model.update_p_cn()
+        model.update_p_breakpoint()
+        model.update_p_outlier_total()
+        model.update_p_outlier_allele()
+        model.update_p_allele_swap()
+
+        return model
+
+    def expand_transmats(self, model):
+        """ Give each adjacency its own transition matrix, breakpoint matrices last.
+        """
+        transmat_idx = np.asarray(model.transmat_idx)
+
+        shared_adjacencies = np.where((transmat_idx > 0) & (transmat_idx < model.num_shared_transmats))[0]
+        breakpoint_adjacencies = np.where(transmat_idx >= model.num_shared_transmats)[0]
+        transmat_adjacency = np.concatenate([[-1], shared_adjacencies, breakpoint_adjacencies]).astype(np.int64)
+
+        expanded_idx = np.zeros(transmat_idx.shape, dtype=np.int64)
+        expanded_idx[transmat_adjacency[1:]] = np.arange(1, transmat_adjacency.shape[0])
+
+        model.transmat_idx = expanded_idx
+        model.transmat_adjacency = transmat_adjacency
+        model.num_shared_transmats = 1 + shared_adjacencies.shape[0]
+        model.num_transmats = transmat_adjacency.shape[0]
+
+        shape = (model.num_transmats, model.num_cn_states, model.num_cn_states)
+        model.log_transmat = np.zeros(shape)
+        model.cached_log_transmat = np.zeros(shape)
+        model.joint_posterior_marginals = np.zeros(shape)
+        model.calculate_log_transmat(model.cached_log_transmat)
+        model.invalidate_elbo()
+
+    def assert_likelihood_cache_valid(self, model):
+        model.update_log_likelihood()
+
+        log_likelihood_total = np.zeros(np.asarray(model.log_likelihood_total).shape)
+        log_likelihood_allele = np.zeros(np.asarray(model.log_likelihood_allele).shape)
+
+        # Likelihoods are cached for candidate states only
+        is_candidate = np.zeros((model.num_segments, model.num_cn_states), dtype=bool)
+
+        for n in xrange(model.num_segments):
+            for j in xrange(model.state_offsets[n], model.state_offsets[n + 1]):
+                s = model.state_idx[j]
+                is_candidate[n, s] = True
+                for u in xrange(2):
+                    log_likelihood_total[n, s, u] = model.calculate_log_likelihood_total(n, s, u)
+                for v in xrange(2):
+                    for w in xrange(2):
+                        log_likelihood_allele[n, s, v, w] = model.calculate_log_likelihood_allele(n, s, v, w)
+
+        np.testing.assert_array_equal(np.asarray(model.log_likelihood_total)[is_candidate], log_likelihood_total[is_candidate])
+        np.testing.assert_array_equal(np.asarray(model.log_likelihood_allele)[is_candidate], log_likelihood_allele[is_candidate])
+
+    def test_likelihood_cache(self):
+
+        data = generate_breakpoint_model_data()
+
+        model = self.create_breakpoint_model(data)
+        model.create_model(data[1])
+        model = model.model
+
+        self.assert_likelihood_cache_valid(model)
+
+        # Each setter invalidates the cached likelihoods
+        model.h = np.asarray(model.h) * 1.1
+        self.assert_likelihood_cache_valid(model)
+
+        for name in ('negbin_r_0', 'negbin_r_1', 'negbin_hdel_mu', 'negbin_hdel_r_0', 'negbin_hdel_r_1',
+                     'betabin_M_0', 'betabin_M_1', 'betabin_loh_p', 'betabin_loh_M_0', 'betabin_loh_M_1'):
+            setattr(model, name, getattr(model, name) * 0.5)
+            self.assert_likelihood_cache_valid(model)
+
+        model.x = np.asarray(model.x) + 1.
+        self.assert_likelihood_cache_valid(model)
+
+        model.y = np.asarray(model.y)[:, ::-1].copy()
+        self.assert_likelihood_cache_valid(model)
+
+        total_likelihood_mask = np.asarray(model.total_likelihood_mask).copy()
+        total_likelihood_mask[::2] = 0
+        model.total_likelihood_mask = total_likelihood_mask
+        self.assert_likelihood_cache_valid(model)
+
+        allele_likelihood_mask = np.asarray(model.allele_likelihood_mask).copy()
+        allele_likelihood_mask[1::2] = 0
+        model.allele_likelihood_mask = allele_likelihood_mask
+        self.assert_likelihood_cache_valid(model)
+
+        # In place modification requires explicit invalidation
+        np.asarray(model.h)[:] *= 0.9
+        model.invalidate_likelihood()
+        self.assert_likelihood_cache_valid(model)
+
+    def test_sum_product_engine(self):
+
+        # Low depth and transition penalty for uncertain posteriors
+        data = generate_breakpoint_model_data(depth=1e-3)
+
+        model_log = self.create_remixt_model(data, sum_product_engine=0, transition_log_prob=0.1)
+        model_scaled = self.create_remixt_model(data, sum_product_engine=1, transition_log_prob=0.1)
+
+        model_log.update_p_cn()
+        model_scaled.update_p_cn()
+
+        np.testing.assert_allclose(model_scaled.hmm_log_norm_const, model_log.hmm_log_norm_const, rtol=1e-10)
+        np.testing.assert_allclose(
+            np.asarray(model_scaled.posterior_marginals),
+            np.asarray(model_log.posterior_marginals),
+            rtol=1e-6, atol=1e-9)
+        np.testing.assert_allclose(
+            np.asarray(model_scaled.joint_posterior_marginals),
+            np.asarray(model_log.joint_posterior_marginals),
+            rtol=1e-6, atol=1e-9)
+
+        np.testing.assert_allclose(model_scaled.calculate_elbo(), model_log.calculate_elbo(), rtol=1e-10)
+
+    def test_shared_transmats(self):
+
+        cn, h, l, x, adjacencies, breakpoints = generate_breakpoint_model_data()
+
+        # Telomere within the segments, and two state classes
+        adjacencies = adjacencies - set([(60, 61)])
+        normal_copies = np.array([[1, 1]] * 80 + [[2, 1]] * 20)
+        data = cn, h, l, x, adjacencies, breakpoints
+
+        models = list()
+        for expand in (False, True):
+            model = self.create_breakpoint_model(data, normal_copies=normal_copies)
+            model.create_model(h * np.array([1., 0.9, 1.1]))
+            model = model.model
+
+            if expand:
+                self.expand_transmats(model)
+
+            model.update_p_cn()
+            model.update_p_breakpoint()
+            model.update_p_outlier_total()
+            model.update_p_outlier_allele()
+            model.update_p_allele_swap()
+            model.update_p_cn()
+
+            models.append(model)
+
+        model_shared, model_expanded = models
+
+        transmat_idx = np.asarray(model_shared.transmat_idx)
+        expanded_idx = np.asarray(model_expanded.transmat_idx)
+
+        # Telomere matrix and matrices between classes 0 and 0, 0 and 1, and 1 and 1
+        self.assertEqual(model_shared.num_shared_transmats, 4)
+
+        # Expanded to the telomere matrix and one matrix per other adjacency
+        self.assertEqual(model_expanded.num_transmats, transmat_idx.shape[0])
+
+        np.testing.assert_array_equal(
+            np.asarray(model_expanded.log_transmat)[expanded_idx],
+            np.asarray(model_shared.log_transmat)[transmat_idx])
+
+        # Joint posteriors of shared matrices are sums over their adjacencies
+        joint_posterior_marginals = np.zeros(np.asarray(model_shared.joint_posterior_marginals).shape)
+        for n in xrange(transmat_idx.shape[0]):
+            joint_posterior_marginals[transmat_idx[n]] += np.asarray(model_expanded.joint_posterior_marginals)[expanded_idx[n]]
+
+        np.testing.assert_allclose(
+            np.asarray(model_shared.joint_posterior_marginals),
+            joint_posterior_marginals,
+            rtol=1e-8, atol=1e-10)
+
+        np.testing.assert_allclose(np.asarray(model_shared.posterior_marginals), np.asarray(model_expanded.posterior_marginals), rtol=1e-8, atol=1e-10)
+        np.testing.assert_allclose(np.asarray(model_shared.p_breakpoint), np.asarray(model_expanded.p_breakpoint), rtol=1e-8, atol=1e-10)
+        np.testing.assert_allclose(model_shared.hmm_log_norm_const, model_expanded.hmm_log_norm_const, rtol=1e-12)
+        np.testing.assert_allclose(model_shared.calculate_elbo(), model_expanded.calculate_elbo(), rtol=1e-12)
+
+    def test_num_threads(self):
+
+        data = generate_breakpoint_model_data()
+
+        model_serial = self.fit_breakpoint_model(data, num_threads=1)
+        model_parallel = self.fit_breakpoint_model(data, num_threads=3)
+
+        np.testing.assert_allclose(model_parallel.model.calculate_elbo(), model_serial.model.calculate_elbo(), rtol=1e-10)
+        np.testing.assert_allclose(model_parallel.h, model_serial.h, rtol=1e-8)
+        np.testing.assert_allclose(
+            np.asarray(model_parallel.model.posterior_marginals),
+            np.asarray(model_serial.model.posterior_marginals),
+            rtol=1e-8, atol=1e-10)
+        np.testing.assert_allclose(
+            np.asarray(model_parallel.model.joint_posterior_marginals),
+            np.asarray(model_serial.model.joint_posterior_marginals),
+            rtol=1e-8, atol=1e-10)
+        np.testing.assert_allclose(model_parallel.p_outlier_total, model_serial.p_outlier_total, rtol=1e-8, atol=1e-10)
+
+        cn_serial, brk_cn_serial = model_serial.optimal_cn()
+        cn_parallel, brk_cn_parallel = model_parallel.optimal_cn()
+
+        np.testing.assert_array_equal(cn_parallel, cn_serial)
+
+    def test_cached_elbo(self):
+
+        data = generate_breakpoint_model_data()
+
+        model = self.create_breakpoint_model(data)
+        model.create_model(data[1] * np.array([1., 0.9, 1.1]))
+        model = model.model
+
+        def assert_elbo_equal():
+            elbo = model.calculate_variational_energy() - model.calculate_variational_entropy()
+            np.testing.assert_allclose(model.calculate_elbo(), elbo, rtol=1e-12)
+
+        assert_elbo_equal()
+
+        for update in (model.update_p_cn, model.update_p_breakpoint, model.update_p_outlier_total,
+                       model.update_p_outlier_allele, model.update_p_allele_swap, model.update_p_indicators):
+            update()
+            assert_elbo_equal()
+
+        # Changes to h and likelihood parameters invalidate likelihood energies
+        model.h = np.asarray(model.h) * 1.05
+        assert_elbo_equal()
+
+        model.negbin_r_0 = model.negbin_r_0 * 2.
+        assert_elbo_equal()
+
+        model.update_p_cn()
+        assert_elbo_equal()
+
+        # Direct modification of variational parameters requires invalidation
+        np.asarray(model.posterior_marginals)[:] = np.asarray(model.posterior_marginals)[::-1].copy()
+        model.invalidate_elbo()
+        assert_elbo_equal()
+
+    def test_sample_expected_log_likelihood(self):
+
+        data = generate_breakpoint_model_data(depth=1e-3)
+
+        model = self.create_remixt_model(data, transition_log_prob=0.1)
+
+        sample = np.zeros((model.num_segments,), dtype=np.int64)
+        sample[::3] = 1
+
+        def calculate_partial_h():
+            partial_h = np.zeros((model.num_clones,))
+            model.calculate_expected_log_likelihood_partial_h(sample, partial_h)
+            sample_partial_h = np.zeros((model.num_clones,))
+            model.calculate_sample_expected_log_likelihood_partial_h(sample_partial_h)
+            return partial_h, sample_partial_h
+
+        # Exact without omitting low posterior states
+        model.sample_min_posterior = 0.
+        model.set_likelihood_sample(sample)
+
+        np.testing.assert_allclose(
+            model.calculate_sample_expected_log_likelihood(),
+            model.calculate_expected_log_likelihood(sample),
+            rtol=1e-12)
+
+        partial_h, sample_partial_h = calculate_partial_h()
+        np.testing.assert_allclose(sample_partial_h, partial_h, rtol=1e-10)
+
+        # Contracted weights remain valid as h and parameters change
+        model.h = np.asarray(model.h) * 1.1
+        model.negbin_r_0 = model.negbin_r_0 * 0.5
+
+        np.testing.assert_allclose(
+            model.calculate_sample_expected_log_likelihood(),
+            model.calculate_expected_log_likelihood(sample),
+            rtol=1e-12)
+
+        partial_h, sample_partial_h = calculate_partial_h()
+        np.testing.assert_allclose(sample_partial_h, partial_h, rtol=1e-10)
+
+        # Parameter derivatives match finite differences of the full objective
+        for name in ('negbin_r_0', 'betabin_M_0'):
+            value = getattr(model, name)
+            partial = model.calculate_sample_expected_log_likelihood_partial_param(name)
+
+            delta = value * 1e-6
+            setattr(model, name, value + delta)
+            ll_plus = model.calculate_expected_log_likelihood(sample)
+            setattr(model, name, value - delta)
+            ll_minus = model.calculate_expected_log_likelihood(sample)
+            setattr(model, name, value)
+
+            np.testing.assert_allclose(partial, (ll_plus - ll_minus) / (2. * delta), rtol=1e-4)
+
+        # Approximate when omitting low posterior states
+        model.sample_min_posterior = 1e-8
+        model.set_likelihood_sample(sample)
+
+        np.testing.assert_allclose(
+            model.calculate_sample_expected_log_likelihood(),
+            model.calculate_expected_log_likelihood(sample),
+            rtol=1e-8)
+
+    def test_param_optimize_method(self):
+
+        data = generate_breakpoint_model_data()
+
+        param_values = dict()
+        num_param_evals = dict()
+
+        for method in ('brute', 'brent'):
+            model = self.create_breakpoint_model(data, param_optimize_method=method)
+            model.create_model(data[1] * np.array([1., 0.9, 1.1]))
+            model.variational_update()
+
+            # Optimum below the bounds, brent search stops at the lower bound
+            model.likelihood_param_bounds['negbin_r_0'] = (500., 2000.)
+
+            num_param_evals[method] = dict()
+            for name in model.likelihood_params:
+                np.random.seed(2016)
+                num_evals_before = model.num_param_evals
+                model.update_param(name)
+                num_param_evals[method][name] = model.num_param_evals - num_evals_before
+
+            param_values[method] = model.get_likelihood_param_values()
+
+        for name, value in param_values['brute'].iteritems():
+            np.testing.assert_allclose(param_values['brent'][name], value, rtol=1e-3)
+
+        self.assertEqual(param_values['brent']['negbin_r_0'], 500.)
+        self.assertLess(num_param_evals['brent']['negbin_r_0'], 10)
+
+        for name in num_param_evals['brute']:
+            self.assertLess(num_param_evals['brent'][name], num_param_evals['brute'][name])
+
+    def test_prune_cn_states(self):
+
+        data = generate_breakpoint_model_data()
+
+        def fit(cn_state_prune_threshold):
+            model = self.fit_breakpoint_model(data, cn_state_prune_threshold=cn_state_prune_threshold)
+            return model.model.calculate_elbo(), np.asarray(model.h), np.asarray(model.model.state_idx).shape[0]
+
+        elbo, h, num_states = fit(None)
+
+        # Threshold retaining all states with finite score reproduces the unpruned fit
+        for threshold in (np.inf, 1e20):
+            elbo_pruned, h_pruned, num_states_pruned = fit(threshold)
+            self.assertEqual(num_states_pruned, num_states)
+            np.testing.assert_allclose(elbo_pruned, elbo, rtol=1e-12)
+            np.testing.assert_allclose(h_pruned, h, rtol=1e-12)
+
+        # Moderate threshold prunes most states and gives a similar fit
+        model = self.create_breakpoint_model(data, cn_state_prune_threshold=100.)
+        model.num_em_iter = 5
+        model.num_update_iter = 5
+        np.random.seed(2015)
+        model.fit(data[1] * np.array([1., 0.9, 1.1]))
+
+        model_unpruned = self.create_breakpoint_model(data)
+        model_unpruned.num_em_iter = 5
+        model_unpruned.num_update_iter = 5
+        np.random.seed(2015)
+        model_unpruned.fit(data[1] * np.array([1., 0.9, 1.1]))
+
+        self.assertLess(model.model.state_idx.shape[0], 0.5 * model_unpruned.model.state_idx.shape[0])
+        np.testing.assert_allclose(model.model.calculate_elbo(), model_unpruned.model.calculate_elbo(), rtol=1e-2)
+
+        # Candidates are retained and added to when pruning for a different h
+        model.model.prune_cn_states(1.)
+        model.model.h = np.asarray(model.model.h) * 1.5
+        model.model.update_log_likelihood()
+        state_idx = np.asarray(model.model.state_idx).copy()
+        state_offsets = np.asarray(model.model.state_offsets).copy()
+        model.model.prune_cn_states(10., keep_candidates=True)
+
+        self.assertGreater(model.model.state_idx.shape[0], state_idx.shape[0])
+
+        for n in xrange(model.model.num_segments):
+            candidates = np.asarray(model.model.state_idx)[model.model.state_offsets[n]:model.model.state_offsets[n + 1]]
+            self.assertTrue(set(state_idx[state_offsets[n]:state_offsets[n + 1]]).issubset(candidates))
+
+        # Cached likelihoods and transition matrices include the added candidates
+        self.assert_likelihood_cache_valid(model.model)
+
+        log_transmat = np.zeros(np.asarray(model.model.cached_log_transmat).shape)
+        model.model.calculate_log_transmat(log_transmat)
+        np.testing.assert_array_equal(np.asarray(model.model.cached_log_transmat), log_transmat)
+
+    def test_update_p_indicators(self):
+
+        data = generate_breakpoint_model_data(depth=1e-3)
+
+        model_separate = self.create_remixt_model(data, transition_log_prob=0.1)
+        model_fused = self.create_remixt_model(data, transition_log_prob=0.1)
+
+        model_separate.update_p_cn()
+        model_fused.update_p_cn()
+
+        model_separate.update_p_outlier_total()
+        model_separate.update_p_outlier_allele()
+        model_separate.update_p_allele_swap()
+
+        model_fused.update_p_indicators()
+
+        for name in ('p_outlier_total', 'p_outlier_allele', 'p_allele_swap'):
+            np.testing.assert_allclose(
+                np.asarray(getattr(model_fused, name)),
+                np.asarray(getattr(model_separate, name)),
+                rtol=1e-12, atol=1e-15)
+
+        np.testing.assert_allclose(model_fused.calculate_elbo(), model_separate.calculate_elbo(), rtol=1e-12)
+
+    def test_fused_variational_sweep(self):
+
+        data = generate_breakpoint_model_data()
+
+        model = self.create_breakpoint_model(data, fused_variational_update=True)
+        model.create_model(data[1] * np.array([1., 0.9, 1.1]))
+        model.model.update_p_allele_swap()
+
+        # Each update of a sweep is checked for a decrease in elbo
+        model.check_elbo = True
+
+        elbo = None
+        for i in xrange(5):
+            model.fused_variational_sweep()
+
+            if elbo is not None:
+                self.assertGreaterEqual(model.model.calculate_elbo(), elbo - 1e-6)
+            elbo = model.model.calculate_elbo()
+
+    def test_hmm_precision(self):
+
+        data = generate_breakpoint_model_data()
+
+        model_double = self.fit_breakpoint_model(data, hmm_precision=0)
+        model_single = self.fit_breakpoint_model(data, hmm_precision=1)
+
+        self.assertEqual(model_single.model.log_transmat.dtype, np.float32)
+        self.assertEqual(model_single.model.joint_posterior_marginals.dtype, np.float32)
+
+        elbo_double = model_double.model.calculate_elbo()
+        elbo_single = model_single.model.calculate_elbo()
+
+        np.testing.assert_allclose(elbo_single, elbo_double, rtol=1e-4)
+
+        cn_double, brk_cn_double = model_double.optimal_cn()
+        cn_single, brk_cn_single = model_single.optimal_cn()
+
+        np.testing.assert_array_equal(cn_single, cn_double)
+        for brk_id in brk_cn_double:
+            np.testing.assert_array_equal(brk_cn_single[brk_id], brk_cn_double[brk_id])
+
+    def test_elbo_convergence(self):
+
+        data = generate_breakpoint_model_data()
+
+        experiment = collections.namedtuple('Experiment', ['x', 'l', 'adjacencies', 'breakpoints'])(
+            data[3], data[2], data[4], data[5])
+        init_params = {'mode_idx': 0, 'divergence_weight': 1e-7}
+
+        # Both tolerances None runs all iterations
+        model = self.create_breakpoint_model(data)
+        model.num_em_iter = 4
+        model.num_update_iter = 3
+        model.fit(data[1])
+
+        self.assertEqual(model.num_em_iter_completed, 4)
+        self.assertFalse(model.converged)
+        self.assertEqual([a['em_iter'] for a in model.iter_stats], [0, 1, 2, 3])
+        self.assertEqual([a['num_update_iter'] for a in model.iter_stats], [3, 3, 3, 3])
+
+        # Large tolerances stop the update and em iterations early, the first
+        # em iteration changes the elbo of the initial posteriors by far more
+        for tolerances in ({'elbo_abs_tol': 1e3}, {'elbo_rel_tol': 1.}):
+            model = self.create_breakpoint_model(data)
+            model.num_em_iter = 4
+            model.num_update_iter = 3
+            for name, value in tolerances.iteritems():
+                setattr(model, name, value)
+            model.fit(data[1])
+
+            self.assertEqual(model.num_em_iter_completed, 2)
+            self.assertTrue(model.converged)
+            self.assertEqual([a['em_iter'] for a in model.iter_stats], [0, 1])
+            self.assertTrue(all(a['num_update_iter'] < 3 for a in model.iter_stats))
+
+            fit_results = remixt.analysis.pipeline.create_fit_results(model, experiment, init_params, {})
+
+            self.assertEqual(fit_results['stats']['num_em_iter'], 2)
+            self.assertEqual(fit_results['stats']['num_update_iter'], sum(a['num_update_iter'] for a in model.iter_stats))
+            self.assertTrue(fit_results['stats']['converged'])
+            self.assertEqual(fit_results['stats']['elbo'], model.iter_stats[-1]['elbo'])
+            self.assertEqual(fit_results['stats']['elbo_diff'], model.iter_stats[-1]['elbo_diff'])
+
+            iter_stats = fit_results['iter_stats']
+            self.assertTrue(np.all(iter_stats['update_seconds'] >= 0.))
+            self.assertTrue(np.all(iter_stats['em_seconds'] >= 0.))
+            np.testing.assert_allclose(iter_stats['seconds'], iter_stats['update_seconds'] + iter_stats['em_seconds'])
+            self.assertAlmostEqual(fit_results['stats']['fit_seconds'], iter_stats['seconds'].sum())
+
+        # Small tolerance converges after some iterations
+        model = self.create_breakpoint_model(data)
+        model.num_em_iter = 20
+        model.elbo_rel_tol = 1e-3
+        model.fit(data[1])
+
+        self.assertTrue(model.converged)
+        self.assertLess(model.num_em_iter_completed, model.num_em_iter)
+        self.assertLess(abs(model.prev_elbo_diff), 1e-3 * abs(model.prev_elbo))
+        self.assertTrue(all(abs(a['elbo_diff']) >= 1e-3 * abs(a['elbo']) for a in model.iter_stats[:-1]))
+
+    def test_checkpoint(self):
+
+        data = generate_breakpoint_model_data()
+        h_init = data[1] * np.array([1., 0.9, 1.1])
+
+        temp_directory = tempfile.mkdtemp()
+
+        try:
+            checkpoint_filename = os.path.join(temp_directory, 'fit.checkpoint')
+
+            # Checkpoint before the first em iteration
+            model = self.create_breakpoint_model(data)
+            model.num_em_iter = 0
+            model.fit(h_init)
+            model.write_checkpoint(checkpoint_filename)
+
+            restored = self.create_breakpoint_model(data)
+            restored.read_checkpoint(h_init, checkpoint_filename)
+
+            self.assertEqual(restored.prev_elbo, model.prev_elbo)
+            self.assertIsNone(restored.prev_elbo_diff)
+            self.assertEqual(restored.num_em_iter_completed, 0)
+            self.assertEqual(restored.iter_stats, [])
+
+            os.remove(checkpoint_filename)
+
+            # Checkpoints are disabled by default
+            model = self.create_breakpoint_model(data)
+            model.checkpoint_filename = checkpoint_filename
+            model.fit(h_init)
+
+            self.assertFalse(os.path.exists(checkpoint_filename))
+
+            model = self.create_breakpoint_model(data)
+            model.checkpoint_filename = checkpoint_filename
+            model.checkpoint_interval = 1
+            model.fit(h_init)
+
+            self.assertTrue(os.path.exists(checkpoint_filename))
+
+            restored = self.create_breakpoint_model(data)
+            restored.read_checkpoint(h_init, checkpoint_filename)
+
+            np.testing.assert_array_equal(restored.h, model.h)
+            np.testing.assert_array_equal(restored.p_breakpoint, model.p_breakpoint)
+            np.testing.assert_array_equal(restored.p_outlier_total, model.p_outlier_total)
+            np.testing.assert_array_equal(np.asarray(restored.model.p_allele_swap), np.asarray(model.model.p_allele_swap))
+            self.assertEqual(restored.get_likelihood_param_values(), model.get_likelihood_param_values())
+            self.assertEqual(restored.num_em_iter_completed, 2)
+            self.assertEqual(len(restored.iter_stats), 2)
+
+            # Recalculated posterior marginals are optimal given the restored state
+            self.assertGreaterEqual(restored.model.calculate_elbo(), model.model.calculate_elbo() - 1e-6)
+
+            # Fit resumes from the checkpoint for the remaining iterations
+            resumed = self.create_breakpoint_model(data)
+            resumed.checkpoint_filename = checkpoint_filename
+            resumed.checkpoint_interval = 1
+            resumed.num_em_iter = 3
+            resumed.fit(h_init)
+
+            self.assertEqual(resumed.num_em_iter_completed, 3)
+            self.assertEqual([a['em_iter'] for a in resumed.iter_stats], [0, 1, 2])
+
+        finally:
+            shutil.rmtree(temp_directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
@@ -434,6 +434,31 @@ class remixt_unittest(unittest.TestCase):
         self.assertTrue(brks_1 == brks_2)
 
 
+    def test_select_pruned_fits(self):
+
+        stats = pd.DataFrame({
+            'init_id': [0, 1, 2, 3, 4],
+            'elbo': [-10., -1., -5., -2., -20.],
+            'proportion_divergent': [0.1, 0.6, 0.2, 0.0, 0.9],
+        })
+
+        config = {'max_prop_diverge': 0.5}
+
+        # Non-divergent solutions first, by decreasing elbo
+        self.assertEqual(remixt.analysis.pipeline.select_pruned_fits(stats, 1., config), [3, 2, 0, 1, 4])
+
+        # Top ceil(keep_fraction * n) solutions
+        self.assertEqual(remixt.analysis.pipeline.select_pruned_fits(stats, 0.5, config), [3, 2, 0])
+        self.assertEqual(remixt.analysis.pipeline.select_pruned_fits(stats, 0.7, config), [3, 2, 0, 1])
+
+        # At least one solution
+        self.assertEqual(remixt.analysis.pipeline.select_pruned_fits(stats, 0., config), [3])
+        self.assertEqual(remixt.analysis.pipeline.select_pruned_fits(stats.iloc[:1], 0.1, config), [0])
+
+        # Divergence threshold from the config
+        self.assertEqual(remixt.analysis.pipeline.select_pruned_fits(stats, 0.2, {'max_prop_diverge': 1.}), [1])
+
+
     def test_create_rearranged_sequence(self):
 
         rparams = remixt.simulations.experiment.RearrangedGenome.default_params.copy()
@@ -62,6 +62,319 @@ class seqdata_unittest(unittest.TestCase):
         self.assertTrue(np.all(fragments.values == fragments_test.values))
         self.assertTrue(np.all(alleles.values == alleles_test.values))
 
+    def test_columnar_seqdataio(self):
+
+        seqdata_filename = './test.columnar.seqdata'
+
+        writer = remixt.seqdataio.Writer(seqdata_filename, seqdata_format='columnar')
+
+        chromosome = '1'
+
+        num_reads = 100000
+        chunk_size = 30000
+
+        fragments = pd.DataFrame({'start':np.sort(np.random.randint(0, int(1e8), size=num_reads))})
+        fragments['end'] = fragments['start'] + np.random.randint(0, 100, size=num_reads)
+        fragments['fragment_id'] = np.arange(num_reads)
+
+        alleles = pd.DataFrame({
+            'fragment_id':np.arange(num_reads),
+            'position':fragments['start'].values,
+            'is_alt':np.random.randint(0, 2, size=num_reads),
+        })
+
+        for idx in xrange(0, num_reads, chunk_size):
+            writer.write(chromosome, fragments.iloc[idx:idx+chunk_size].copy(), alleles.iloc[idx:idx+chunk_size].copy())
+
+        writer.close()
+
+        self.assertEqual(remixt.seqdataio.get_seqdata_format(seqdata_filename), 'columnar')
+        self.assertEqual(remixt.seqdataio.read_chromosomes(seqdata_filename), set([chromosome]))
+
+        fragments_test = remixt.seqdataio.read_fragment_data(seqdata_filename, chromosome)
+        alleles_test = remixt.seqdataio.read_allele_data(seqdata_filename, chromosome)
+
+        for col in ('fragment_id', 'start', 'end'):
+            self.assertTrue(np.all(fragments[col].values == fragments_test[col].values))
+
+        for col in ('fragment_id', 'position', 'is_alt'):
+            self.assertTrue(np.all(alleles[col].values == alleles_test[col].values))
+
+        fragments_chunks = list(remixt.seqdataio.read_fragment_data(seqdata_filename, chromosome, chunksize=7000))
+        self.assertEqual(sum([len(a.index) for a in fragments_chunks]), num_reads)
+
+        starts = remixt.seqdataio.read_seq_columns(seqdata_filename, 'fragments', chromosome)['start']
+        self.assertTrue(isinstance(starts, np.memmap))
+        self.assertTrue(np.all(starts == fragments['start'].values))
+
+        os.remove(seqdata_filename)
+
+    def test_merge_seqdata(self):
+
+        for seqdata_format, link in (('columnar', False), ('hdf', False), ('hdf', True)):
+
+            chromosome_filenames = dict()
+            chromosome_data = dict()
+
+            for chromosome in ('1', '2', '3'):
+                num_reads = np.random.randint(1000, 10000)
+
+                fragments = pd.DataFrame({'start':np.sort(np.random.randint(0, int(1e8), size=num_reads))})
+                fragments['end'] = fragments['start'] + np.random.randint(0, 100, size=num_reads)
+                fragments['fragment_id'] = np.arange(num_reads)
+
+                alleles = pd.DataFrame({
+                    'fragment_id':np.arange(num_reads),
+                    'position':fragments['start'].values,
+                    'is_alt':np.random.randint(0, 2, size=num_reads),
+                })
+
+                chromosome_filenames[chromosome] = './test.merge.{}.seqdata'.format(chromosome)
+                chromosome_data[chromosome] = (fragments, alleles)
+
+                writer = remixt.seqdataio.Writer(chromosome_filenames[chromosome], seqdata_format=seqdata_format)
+                writer.write(chromosome, fragments.copy(), alleles.copy())
+                writer.close()
+
+            merged_filename = './test.merge.seqdata'
+
+            remixt.seqdataio.merge_seqdata(merged_filename, chromosome_filenames, link=link, num_threads=2)
+
+            self.assertEqual(remixt.seqdataio.get_seqdata_format(merged_filename), seqdata_format)
+            self.assertEqual(remixt.seqdataio.read_chromosomes(merged_filename), set(chromosome_filenames.keys()))
+
+            for chromosome, (fragments, alleles) in chromosome_data.iteritems():
+                fragments_test = remixt.seqdataio.read_fragment_data(merged_filename, chromosome)
+                alleles_test = pd.concat(list(remixt.seqdataio.read_allele_data(merged_filename, chromosome, chunksize=3000)))
+
+                for col in ('fragment_id', 'start', 'end'):
+                    self.assertTrue(np.all(fragments[col].values == fragments_test[col].values))
+
+                for col in ('fragment_id', 'position', 'is_alt'):
+                    self.assertTrue(np.all(alleles[col].values == alleles_test[col].values))
+
+            remixt.seqdataio.validate_merged_seqdata(merged_filename, chromosome_filenames.values())
+
+            # Validation detects chromosomes in the merged seqdata missing from the inputs
+            self.assertRaises(ValueError, remixt.seqdataio.validate_merged_seqdata, merged_filename,
+                [chromosome_filenames[a] for a in ('1', '2')])
+
+            # Validation detects inputs modified after merging
+            if seqdata_format == 'hdf' and not link:
+                with pd.HDFStore(chromosome_filenames['2'], 'a') as store:
+                    fragments = store['/fragments/chromosome_2']
+                    fragments.loc[len(fragments.index) // 2, 'start'] += 1
+                    store.put('/fragments/chromosome_2', fragments, format='table')
+                self.assertRaises(ValueError, remixt.seqdataio.validate_merged_seqdata, merged_filename, chromosome_filenames.values())
+
+                with pd.HDFStore(chromosome_filenames['2'], 'a') as store:
+                    store.append('/fragments/chromosome_2', store['/fragments/chromosome_2'].iloc[:10])
+                self.assertRaises(ValueError, remixt.seqdataio.validate_merged_seqdata, merged_filename, chromosome_filenames.values())
+
+            for filename in chromosome_filenames.values() + [merged_filename]:
+                os.remove(filename)
+
+    def test_sorted_seqdata(self):
+
+        for seqdata_format in ('columnar', 'hdf'):
+
+            seqdata_filename = './test.sorted.seqdata'
+
+            num_reads = 200000
+
+            fragments = pd.DataFrame({'start':np.sort(np.random.randint(0, int(1e7), size=num_reads))})
+            fragments['end'] = fragments['start'] + np.random.randint(0, 100, size=num_reads)
+            fragments['fragment_id'] = np.arange(num_reads)
+
+            # Alleles of each fragment are not sorted by position
+            alleles = pd.DataFrame({
+                'fragment_id':np.arange(num_reads),
+                'position':np.random.randint(0, int(1e7), size=num_reads),
+                'is_alt':np.random.randint(0, 2, size=num_reads),
+            })
+
+            writer = remixt.seqdataio.Writer(seqdata_filename, seqdata_format=seqdata_format)
+            for idx in np.array_split(np.arange(num_reads), 7):
+                writer.write('1', fragments.iloc[idx].copy(), alleles.iloc[idx].copy())
+            writer.close()
+
+            self.assertTrue(remixt.seqdataio.is_seq_data_sorted(seqdata_filename, 'fragments', '1'))
+            self.assertFalse(remixt.seqdataio.is_seq_data_sorted(seqdata_filename, 'alleles', '1'))
+
+            for start, end in ((None, 5000000), (2000000, 2000001), (3000000, 7000000), (int(2e7), None)):
+                selected = np.ones(num_reads, dtype=bool)
+                if start is not None:
+                    selected &= fragments['start'].values >= start
+                if end is not None:
+                    selected &= fragments['start'].values < end
+
+                fragments_test = remixt.seqdataio.read_fragment_data(seqdata_filename, '1', start=start, end=end)
+                self.assertTrue(np.all(fragments['fragment_id'].values[selected] == fragments_test['fragment_id'].values))
+
+                fragments_test = pd.concat(list(remixt.seqdataio.read_fragment_data(seqdata_filename, '1', start=start, end=end, chunksize=30000)))
+                self.assertTrue(np.all(fragments['fragment_id'].values[selected] == fragments_test['fragment_id'].values))
+
+                selected = np.ones(num_reads, dtype=bool)
+                if start is not None:
+                    selected &= alleles['position'].values >= start
+                if end is not None:
+                    selected &= alleles['position'].values < end
+
+                alleles_test = remixt.seqdataio.read_allele_data(seqdata_filename, '1', start=start, end=end)
+                self.assertTrue(np.all(alleles['fragment_id'].values[selected] == alleles_test['fragment_id'].values))
+
+            os.remove(seqdata_filename)
+
+    def test_read_fragment_columns(self):
+
+        import remixt.segalg
+        import remixt.analysis.segment
+
+        for seqdata_format in ('columnar', 'hdf'):
+
+            seqdata_filename = './test.columns.seqdata'
+
+            num_reads = 100000
+
+            fragments = pd.DataFrame({'start':np.sort(np.random.randint(0, int(1e7), size=num_reads))})
+            fragments['end'] = fragments['start'] + np.random.randint(100, 500, size=num_reads)
+            fragments['fragment_id'] = np.arange(num_reads)
+            fragments['is_duplicate'] = np.random.randint(0, 2, size=num_reads)
+            fragments['mapping_quality'] = np.random.randint(0, 3, size=num_reads)
+
+            alleles = pd.DataFrame({
+                'fragment_id':np.arange(num_reads),
+                'position':fragments['start'].values,
+                'is_alt':np.random.randint(0, 2, size=num_reads),
+            })
+
+            writer = remixt.seqdataio.Writer(seqdata_filename, seqdata_format=seqdata_format)
+            writer.write('1', fragments.copy(), alleles.copy())
+            writer.close()
+
+            columns = ['fragment_id', 'start', 'end']
+
+            # Unfiltered columns of columnar seqdata are views of the file
+            data = list(remixt.seqdataio.read_fragment_columns(seqdata_filename, '1', columns, map_qual_threshold=None))
+            self.assertEqual(len(data), 1)
+            self.assertEqual(isinstance(data[0]['start'], np.memmap), seqdata_format == 'columnar')
+
+            regions = [(1000000, 2000000), (5000000, 5500000)]
+
+            for filter_duplicates, chunksize, query_regions in itertools.product((False, True), (None, 7000), (None, regions)):
+                fragments_test = pd.concat(list(remixt.seqdataio.read_fragment_data(
+                    seqdata_filename, '1', filter_duplicates=filter_duplicates,
+                    chunksize=chunksize or num_reads, regions=query_regions)))
+
+                data = list(remixt.seqdataio.read_fragment_columns(
+                    seqdata_filename, '1', columns, filter_duplicates=filter_duplicates,
+                    chunksize=chunksize, regions=query_regions))
+
+                for col in columns:
+                    self.assertTrue(np.all(fragments_test[col].values == np.concatenate([a[col] for a in data])))
+
+            boundaries = np.arange(0, int(1e7) + 1, 500000)
+            segments = pd.DataFrame({'start':boundaries[:-1], 'end':boundaries[1:]})
+
+            reads = remixt.seqdataio.read_fragment_data(seqdata_filename, '1', filter_duplicates=True)
+            expected = remixt.segalg.contained_counts(segments[['start', 'end']].values, reads[['start', 'end']].values)
+
+            for query_segments in (False, True):
+                counts = remixt.analysis.segment.count_segment_reads(
+                    seqdata_filename, '1', segments.copy(), filter_duplicates=True,
+                    chunksize=30000, query_segments=query_segments)
+                self.assertTrue(np.all(counts['readcount'].values == expected))
+
+            os.remove(seqdata_filename)
+
+    def test_sorting_table_store(self):
+
+        class _ListStore(object):
+            def __init__(self):
+                self.tables = list()
+            def append(self, key, data):
+                self.tables.append(data)
+            def close(self):
+                pass
+
+        positions = np.arange(100000) + np.random.randint(0, 1000, size=100000)
+
+        store = _ListStore()
+        sorting_store = remixt.seqdataio._SortingTableStore(store, 1000)
+        for idx in np.array_split(np.arange(len(positions)), 13):
+            sorting_store.append('/fragments/chromosome_1', pd.DataFrame({'start':positions[idx]}))
+        sorting_store.close()
+
+        self.assertTrue(np.all(np.sort(positions) == pd.concat(store.tables)['start'].values))
+
+        sorting_store = remixt.seqdataio._SortingTableStore(_ListStore(), 10)
+        sorting_store.append('/fragments/chromosome_1', pd.DataFrame({'start':[100, 200]}))
+        self.assertRaises(ValueError, sorting_store.append, '/fragments/chromosome_1', pd.DataFrame({'start':[300, 50]}))
+
+    def test_cached_segment_counts(self):
+
+        import remixt.analysis.segment
+        import remixt.analysis.haplotype
+
+        seqdata_filename = './test.cached.seqdata'
+        haps_filename = './test.cached.haps.tsv'
+
+        num_reads = 200000
+
+        fragments = pd.DataFrame({'start':np.sort(np.random.randint(0, int(1e7), size=num_reads))})
+        fragments['end'] = fragments['start'] + np.random.randint(100, 500, size=num_reads)
+        fragments['fragment_id'] = np.arange(num_reads)
+        fragments['is_duplicate'] = np.random.randint(0, 2, size=num_reads)
+
+        snp_positions = np.arange(1000, int(1e7), 1000)
+
+        alleles = pd.DataFrame({
+            'fragment_id':np.arange(num_reads),
+            'position':(fragments['start'].values // 1000 + 1) * 1000,
+            'is_alt':np.random.randint(0, 2, size=num_reads),
+        })
+        alleles = alleles[alleles['position'] <= fragments['end'].values]
+
+        haps = pd.DataFrame({'position':snp_positions, 'allele':0})
+        haps = pd.concat([haps, haps.assign(allele=1)], ignore_index=True)
+        haps['chromosome'] = '1'
+        haps['hap_label'] = haps['position'] // 100000
+        haps['allele_id'] = haps['allele']
+        haps.to_csv(haps_filename, sep='\t', index=False)
+
+        writer = remixt.seqdataio.Writer(seqdata_filename, seqdata_format='columnar')
+        writer.write('1', fragments.copy(), alleles.copy())
+        writer.close()
+
+        boundaries = np.arange(0, int(1e7) + 1, 500000)
+        segments = pd.DataFrame({'chromosome':'1', 'start':boundaries[:-1], 'end':boundaries[1:]})
+
+        # Split a few segments as for additional breakpoints
+        split_boundaries = np.sort(np.concatenate([boundaries, [1234567, 7654321]]))
+        split_segments = pd.DataFrame({'chromosome':'1', 'start':split_boundaries[:-1], 'end':split_boundaries[1:]})
+
+        cached_counts = remixt.analysis.segment.create_segment_counts(segments, seqdata_filename, filter_duplicates=True)
+        counts = remixt.analysis.segment.create_segment_counts(split_segments, seqdata_filename, filter_duplicates=True)
+        counts_test = remixt.analysis.segment.create_segment_counts(split_segments, seqdata_filename, filter_duplicates=True, cached_counts=cached_counts)
+
+        self.assertTrue(np.all(counts.values == counts_test[counts.columns].values))
+
+        cached_counts = remixt.analysis.haplotype.create_allele_counts(segments, seqdata_filename, haps_filename, filter_duplicates=True)
+        counts = remixt.analysis.haplotype.create_allele_counts(split_segments, seqdata_filename, haps_filename, filter_duplicates=True)
+        counts_test = remixt.analysis.haplotype.create_allele_counts(
+            split_segments, seqdata_filename, haps_filename, filter_duplicates=True,
+            cached_segments=segments, cached_counts=cached_counts)
+
+        columns = ['chromosome', 'start', 'end', 'hap_label', 'allele_id', 'readcount']
+        counts = counts[columns].sort_values(columns).values
+        counts_test = counts_test[columns].sort_values(columns).values
+
+        self.assertTrue(len(counts) > 0)
+        self.assertTrue(np.all(counts == counts_test))
+
+        os.remove(seqdata_filename)
+        os.remove(haps_filename)
+
 
 if __name__ == '__main__':
     unittest.main()
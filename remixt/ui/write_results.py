@@ -9,6 +9,10 @@ def write_results_tables(**args):
 
     stats = store['stats']
 
+    # Filter solutions pruned before completing the fit
+    if 'truncated' in stats:
+        stats = stats[~stats['truncated'].astype(bool)]
+
     # Filter high proportion subclonal
     stats = stats[stats['proportion_divergent'] <= args['max_proportion_divergent']]
 
@@ -3,6 +3,7 @@ import pypeliner
 import pypeliner.managed as mgd
 
 import remixt.config
+import remixt.analysis.bamcount
 import remixt.analysis.gcbias
 import remixt.analysis.haplotype
 import remixt.analysis.pipeline
@@ -20,24 +21,41 @@ def create_extract_seqdata_workflow(
      config,
      ref_data_dir,
 ):
-    chromosomes = remixt.config.get_chromosomes(config, ref_data_dir)
+    chromosome_lengths = remixt.config.get_chromosome_lengths(config, ref_data_dir)
     snp_positions_filename = remixt.config.get_filename(config, ref_data_dir, 'snp_positions')
 
     bam_max_fragment_length = remixt.config.get_param(config, 'bam_max_fragment_length')
     bam_max_soft_clipped = remixt.config.get_param(config, 'bam_max_soft_clipped')
     bam_check_proper_pair = remixt.config.get_param(config, 'bam_check_proper_pair')
+    bam_num_threads = remixt.config.get_param(config, 'bam_num_threads')
+    seqdata_format = remixt.config.get_param(config, 'seqdata_format')
+    seqdata_merge_links = remixt.config.get_param(config, 'seqdata_merge_links')
+    seqdata_complib = remixt.config.get_param(config, 'seqdata_complib')
+    seqdata_complevel = remixt.config.get_param(config, 'seqdata_complevel')
+
+    # Linked tables are kept next to the merged seqdata, otherwise they
+    # are temporary, and only hdf tables are decoded when merging
+    if seqdata_format == 'hdf' and seqdata_merge_links:
+        chromosome_seqdata_template = seqdata_filename + '.chromosome_{chromosome}'
+        chromosome_seqdata_output = mgd.OutputFile('chromosome_seqdata', 'chromosome', template=chromosome_seqdata_template)
+        chromosome_seqdata_input = mgd.InputFile('chromosome_seqdata', 'chromosome', template=chromosome_seqdata_template)
+    else:
+        chromosome_seqdata_output = mgd.TempOutputFile('seqdata', 'chromosome')
+        chromosome_seqdata_input = mgd.TempInputFile('seqdata', 'chromosome')
+
+    merge_mem = 16 if seqdata_format == 'hdf' and not seqdata_merge_links else 4
 
     workflow = pypeliner.workflow.Workflow()
 
-    workflow.setobj(obj=mgd.OutputChunks('chromosome'), value=chromosomes)
+    workflow.setobj(obj=mgd.TempOutputObj('chromosome_length', 'chromosome'), value=chromosome_lengths)
 
     workflow.transform(
         name='create_chromosome_seqdata',
         axes=('chromosome',),
-        ctx={'mem': 16},
+        ctx={'mem': 16, 'ncpus': bam_num_threads},
         func=remixt.seqdataio.create_chromosome_seqdata,
         args=(
-            mgd.TempOutputFile('seqdata', 'chromosome'),
+            chromosome_seqdata_output,
             mgd.InputFile(bam_filename),
             mgd.InputFile(snp_positions_filename),
             mgd.InputInstance('chromosome'),
@@ -45,21 +63,61 @@ def create_extract_seqdata_workflow(
             bam_max_soft_clipped,
             bam_check_proper_pair,
         ),
+        kwargs={
+            'seqdata_format': seqdata_format,
+            'num_threads': bam_num_threads,
+            'chromosome_length': mgd.TempInputObj('chromosome_length', 'chromosome'),
+            'complib': seqdata_complib,
+            'complevel': seqdata_complevel,
+        },
     )
 
     workflow.transform(
         name='merge_seqdata',
-        ctx={'mem': 16},
+        ctx={'mem': merge_mem, 'ncpus': bam_num_threads},
         func=remixt.seqdataio.merge_seqdata,
         args=(
             mgd.OutputFile(seqdata_filename),
-            mgd.TempInputFile('seqdata', 'chromosome'),
+            chromosome_seqdata_input,
         ),
+        kwargs={
+            'link': seqdata_merge_links,
+            'num_threads': bam_num_threads,
+            'complib': seqdata_complib,
+            'complevel': seqdata_complevel,
+        },
     )
 
     return workflow
 
 
+def _add_infer_haps_transforms(workflow, haps_filename, config, ref_data_dir):
+    workflow.transform(
+        name='infer_haps',
+        axes=('chromosome',),
+        ctx={'mem': 16},
+        func=remixt.analysis.haplotype.infer_haps,
+        args=(
+            mgd.TempOutputFile('haps.tsv', 'chromosome'),
+            mgd.TempInputFile('snp_genotype.tsv', 'chromosome'),
+            mgd.InputInstance('chromosome'),
+            mgd.TempSpace('haplotyping', 'chromosome'),
+            config,
+            ref_data_dir,
+        )
+    )
+
+    workflow.transform(
+        name='merge_haps',
+        ctx={'mem': 16},
+        func=remixt.utils.merge_tables,
+        args=(
+            mgd.OutputFile(haps_filename),
+            mgd.TempInputFile('haps.tsv', 'chromosome'),
+        )
+    )
+
+
 def create_infer_haps_workflow(
     seqdata_filenames,
     haps_filename,
@@ -108,67 +166,12 @@ def create_infer_haps_workflow(
             ),
         )
 
-    workflow.transform(
-        name='infer_haps',
-        axes=('chromosome',),
-        ctx={'mem': 16},
-        func=remixt.analysis.haplotype.infer_haps,
-        args=(
-            mgd.TempOutputFile('haps.tsv', 'chromosome'),
-            mgd.TempInputFile('snp_genotype.tsv', 'chromosome'),
-            mgd.InputInstance('chromosome'),
-            mgd.TempSpace('haplotyping', 'chromosome'),
-            config,
-            ref_data_dir,
-        )
-    )
-
-    workflow.transform(
-        name='merge_haps',
-        ctx={'mem': 16},
-        func=remixt.utils.merge_tables,
-        args=(
-            mgd.OutputFile(haps_filename),
-            mgd.TempInputFile('haps.tsv', 'chromosome'),
-        )
-    )
+    _add_infer_haps_transforms(workflow, haps_filename, config, ref_data_dir)
 
     return workflow
 
 
-def create_calc_bias_workflow(
-    tumour_seqdata_filename,
-    segment_filename,
-    segment_length_filename,
-    config,
-    ref_data_dir,
-):
-    workflow = pypeliner.workflow.Workflow(default_ctx={'mem': 4})
-
-    workflow.transform(
-        name='calc_fragment_stats',
-        ctx={'mem': 16},
-        func=remixt.analysis.stats.calculate_fragment_stats,
-        ret=mgd.TempOutputObj('fragstats'),
-        args=(
-            mgd.InputFile(tumour_seqdata_filename),
-            config,
-        )
-    )
-
-    workflow.transform(
-        name='sample_gc',
-        ctx={'mem': 16},
-        func=remixt.analysis.gcbias.sample_gc,
-        args=(
-            mgd.TempOutputFile('gcsamples.tsv'),
-            mgd.InputFile(tumour_seqdata_filename),
-            mgd.TempInputObj('fragstats').prop('fragment_mean'),
-            config,
-            ref_data_dir,
-        )
-    )
-
+def _add_gc_bias_transforms(workflow, segment_filename, segment_length_filename, config, ref_data_dir):
     workflow.transform(
         name='gc_lowess',
         ctx={'mem': 16},
@@ -224,9 +227,69 @@ def create_calc_bias_workflow(
         ),
     )
 
+
+def create_calc_bias_workflow(
+    tumour_seqdata_filename,
+    segment_filename,
+    segment_length_filename,
+    config,
+    ref_data_dir,
+):
+    workflow = pypeliner.workflow.Workflow(default_ctx={'mem': 4})
+
+    workflow.transform(
+        name='calc_fragment_stats',
+        ctx={'mem': 16},
+        func=remixt.analysis.stats.calculate_fragment_stats,
+        ret=mgd.TempOutputObj('fragstats'),
+        args=(
+            mgd.InputFile(tumour_seqdata_filename),
+            config,
+        )
+    )
+
+    workflow.transform(
+        name='sample_gc',
+        ctx={'mem': 16},
+        func=remixt.analysis.gcbias.sample_gc,
+        args=(
+            mgd.TempOutputFile('gcsamples.tsv'),
+            mgd.InputFile(tumour_seqdata_filename),
+            mgd.TempInputObj('fragstats').prop('fragment_mean'),
+            config,
+            ref_data_dir,
+        )
+    )
+
+    _add_gc_bias_transforms(workflow, segment_filename, segment_length_filename, config, ref_data_dir)
+
     return workflow
 
 
+def _add_phase_counts_transforms(workflow, count_filenames):
+    workflow.transform(
+        name='phase_segments',
+        ctx={'mem': 16},
+        func=remixt.analysis.readcount.phase_segments,
+        args=(
+            mgd.TempInputFile('allele_counts.tsv', 'tumour_id'),
+            mgd.TempOutputFile('phased_allele_counts.tsv', 'tumour_id', axes_origin=[]),
+        ),
+    )
+
+    workflow.transform(
+        name='prepare_readcount_table',
+        axes=('tumour_id',),
+        ctx={'mem': 16},
+        func=remixt.analysis.readcount.prepare_readcount_table,
+        args=(
+            mgd.TempInputFile('segment_counts.tsv', 'tumour_id'),
+            mgd.TempInputFile('phased_allele_counts.tsv', 'tumour_id'),
+            mgd.OutputFile('count_file', 'tumour_id', fnames=count_filenames),
+        ),
+    )
+
+
 def create_prepare_counts_workflow(
     segment_filename,
     haplotypes_filename,
@@ -246,7 +309,7 @@ def create_prepare_counts_workflow(
     workflow.transform(
         name='segment_readcount',
         axes=('tumour_id',),
-        ctx={'mem': 20},
+        ctx={'mem': 8},
         func=remixt.analysis.readcount.segment_readcount,
         args=(
             mgd.TempOutputFile('segment_counts.tsv', 'tumour_id'),
@@ -270,27 +333,7 @@ def create_prepare_counts_workflow(
         ),
     )
 
-    workflow.transform(
-        name='phase_segments',
-        ctx={'mem': 16},
-        func=remixt.analysis.readcount.phase_segments,
-        args=(
-            mgd.TempInputFile('allele_counts.tsv', 'tumour_id'),
-            mgd.TempOutputFile('phased_allele_counts.tsv', 'tumour_id', axes_origin=[]),
-        ),
-    )
-
-    workflow.transform(
-        name='prepare_readcount_table',
-        axes=('tumour_id',),
-        ctx={'mem': 16},
-        func=remixt.analysis.readcount.prepare_readcount_table,
-        args=(
-            mgd.TempInputFile('segment_counts.tsv', 'tumour_id'),
-            mgd.TempInputFile('phased_allele_counts.tsv', 'tumour_id'),
-            mgd.OutputFile('count_file', 'tumour_id', fnames=count_filenames),
-        ),
-    )
+    _add_phase_counts_transforms(workflow, count_filenames)
 
     return workflow
 
@@ -303,6 +346,9 @@ def create_fit_model_workflow(
     tumour_id=None,
 ):
     config = remixt.config.get_sample_config(config, tumour_id)
+
+    fit_num_threads = remixt.config.get_param(config, 'fit_num_threads')
+    fit_local_num_processes = remixt.config.get_param(config, 'fit_local_num_processes')
     
     workflow = pypeliner.workflow.Workflow(default_ctx={'mem': 16})
 
@@ -317,17 +363,32 @@ def create_fit_model_workflow(
         ),
     )
 
-    workflow.transform(
-        name='fit',
-        axes=('init_id',),
-        func=remixt.analysis.pipeline.fit_task,
-        args=(
-            mgd.TempOutputFile('fit_results', 'init_id'),
-            mgd.InputFile(experiment_filename),
-            mgd.TempInputObj('init_params', 'init_id'),
-            config,
-        ),
-    )
+    if fit_local_num_processes > 0:
+        workflow.transform(
+            name='fit_local',
+            ctx={'mem': 16, 'ncpus': fit_local_num_processes * fit_num_threads},
+            func=remixt.analysis.pipeline.fit_local,
+            args=(
+                mgd.TempOutputFile('fit_results', 'init_id', axes_origin=[]),
+                mgd.InputFile(experiment_filename),
+                mgd.TempInputObj('init_params', 'init_id'),
+                config,
+            ),
+        )
+
+    else:
+        workflow.transform(
+            name='fit',
+            axes=('init_id',),
+            ctx={'mem': 16, 'ncpus': fit_num_threads},
+            func=remixt.analysis.pipeline.fit_task,
+            args=(
+                mgd.TempOutputFile('fit_results', 'init_id'),
+                mgd.InputFile(experiment_filename),
+                mgd.TempInputObj('init_params', 'init_id'),
+                config,
+            ),
+        )
 
     workflow.transform(
         name='collate',
@@ -344,6 +405,55 @@ def create_fit_model_workflow(
     return workflow
 
 
+def _add_fit_model_transforms(
+    workflow,
+    breakpoint_filename,
+    results_filenames,
+    counts_table_template,
+    experiment_template,
+    ploidy_plots_template,
+    config,
+    ref_data_dir,
+):
+    workflow.transform(
+        name='create_experiment',
+        axes=('tumour_id',),
+        ctx={'mem': 8},
+        func=remixt.analysis.experiment.create_experiment,
+        args=(
+            mgd.InputFile('counts', 'tumour_id', template=counts_table_template),
+            mgd.InputFile(breakpoint_filename),
+            mgd.OutputFile('experiment', 'tumour_id', template=experiment_template),
+        ),
+    )
+
+    workflow.transform(
+        name='ploidy_analysis_plots',
+        axes=('tumour_id',),
+        ctx={'mem': 8},
+        func=remixt.cn_plot.ploidy_analysis_plots,
+        args=(
+            mgd.InputFile('experiment', 'tumour_id', template=experiment_template),
+            mgd.OutputFile('plots', 'tumour_id', template=ploidy_plots_template),
+        ),
+    )
+
+    workflow.subworkflow(
+        name='fit_model',
+        axes=('tumour_id',),
+        func=remixt.workflow.create_fit_model_workflow,
+        args=(
+            mgd.InputFile('experiment', 'tumour_id', template=experiment_template),
+            mgd.OutputFile('results', 'tumour_id', fnames=results_filenames),
+            config,
+            ref_data_dir,
+        ),
+        kwargs={
+            'tumour_id': mgd.InputInstance('tumour_id'),
+        },
+    )
+
+
 def create_remixt_seqdata_workflow(
     breakpoint_filename,
     seqdata_filenames,
@@ -431,44 +541,504 @@ def create_remixt_seqdata_workflow(
         ),
     )
 
-    workflow.transform(
-        name='create_experiment',
-        axes=('tumour_id',),
-        ctx={'mem': 8},
-        func=remixt.analysis.experiment.create_experiment,
-        args=(
-            mgd.InputFile('counts', 'tumour_id', template=counts_table_template),
-            mgd.InputFile(breakpoint_filename),
-            mgd.OutputFile('experiment', 'tumour_id', template=experiment_template),
-        ),
+    _add_fit_model_transforms(
+        workflow,
+        breakpoint_filename,
+        results_filenames,
+        counts_table_template,
+        experiment_template,
+        ploidy_plots_template,
+        config,
+        ref_data_dir,
     )
 
-    workflow.transform(
-        name='ploidy_analysis_plots',
-        axes=('tumour_id',),
-        ctx={'mem': 8},
-        func=remixt.cn_plot.ploidy_analysis_plots,
-        args=(
-            mgd.InputFile('experiment', 'tumour_id', template=experiment_template),
-            mgd.OutputFile('plots', 'tumour_id', template=ploidy_plots_template),
-        ),
+    return workflow
+
+
+def create_infer_haps_bam_workflow(
+    bam_filenames,
+    haps_filename,
+    config,
+    ref_data_dir,
+    normal_id=None,
+):
+    chromosomes = remixt.config.get_chromosomes(config, ref_data_dir)
+
+    workflow = pypeliner.workflow.Workflow()
+
+    workflow.setobj(obj=mgd.OutputChunks('chromosome'), value=chromosomes)
+
+    if normal_id is not None:
+        normal_bam_filename = bam_filenames[normal_id]
+
+        workflow.transform(
+            name='count_normal_snps',
+            axes=('chromosome',),
+            ctx={'mem': 8},
+            func=remixt.analysis.bamcount.count_bam_snps,
+            args=(
+                mgd.TempOutputFile('snp_counts.tsv', 'chromosome'),
+                mgd.InputFile(normal_bam_filename),
+                mgd.InputInstance('chromosome'),
+                config,
+                ref_data_dir,
+            ),
+        )
+
+        workflow.transform(
+            name='infer_snp_genotype_from_normal',
+            axes=('chromosome',),
+            ctx={'mem': 16},
+            func=remixt.analysis.haplotype.infer_snp_genotype_from_normal_counts,
+            args=(
+                mgd.TempOutputFile('snp_genotype.tsv', 'chromosome'),
+                mgd.TempInputFile('snp_counts.tsv', 'chromosome'),
+                mgd.InputInstance('chromosome'),
+                config,
+            ),
+        )
+
+    else:
+        tumour_ids = bam_filenames.keys()
+
+        workflow.setobj(
+            obj=mgd.OutputChunks('tumour_id', 'tumour_chromosome'),
+            value=[(tumour_id, chromosome) for tumour_id in tumour_ids for chromosome in chromosomes],
+        )
+
+        workflow.transform(
+            name='count_tumour_snps',
+            axes=('tumour_id', 'tumour_chromosome'),
+            ctx={'mem': 8},
+            func=remixt.analysis.bamcount.count_bam_snps,
+            args=(
+                mgd.TempOutputFile('chromosome_snp_counts.tsv', 'tumour_id', 'tumour_chromosome'),
+                mgd.InputFile('tumour_bam', 'tumour_id', fnames=bam_filenames),
+                mgd.InputInstance('tumour_chromosome'),
+                config,
+                ref_data_dir,
+            ),
+        )
+
+        # Snps are counted per tumour and chromosome, and genotyped per
+        # chromosome from the counts of all tumours
+        workflow.transform(
+            name='merge_tumour_snp_counts',
+            axes=('tumour_id',),
+            func=remixt.utils.merge_tables,
+            args=(
+                mgd.TempOutputFile('snp_counts.tsv', 'tumour_id'),
+                mgd.TempInputFile('chromosome_snp_counts.tsv', 'tumour_id', 'tumour_chromosome'),
+            ),
+        )
+
+        workflow.transform(
+            name='infer_snp_genotype_from_tumour',
+            axes=('chromosome',),
+            ctx={'mem': 16},
+            func=remixt.analysis.haplotype.infer_snp_genotype_from_tumour_counts,
+            args=(
+                mgd.TempOutputFile('snp_genotype.tsv', 'chromosome'),
+                mgd.TempInputFile('snp_counts.tsv', 'tumour_id'),
+                mgd.InputInstance('chromosome'),
+                config,
+            ),
+        )
+
+    _add_infer_haps_transforms(workflow, haps_filename, config, ref_data_dir)
+
+    return workflow
+
+
+def create_prepare_bam_counts_workflow(
+    segment_filename,
+    haplotypes_filename,
+    gc_positions_filename,
+    tumour_bam_filenames,
+    count_filenames,
+    gc_read_counts_filenames,
+    fragment_length_sums_filenames,
+    config,
+    ref_data_dir,
+):
+    tumour_ids = tumour_bam_filenames.keys()
+    count_filenames = dict([(tumour_id, count_filenames[tumour_id]) for tumour_id in tumour_ids])
+    gc_read_counts_filenames = dict([(tumour_id, gc_read_counts_filenames[tumour_id]) for tumour_id in tumour_ids])
+    fragment_length_sums_filenames = dict([(tumour_id, fragment_length_sums_filenames[tumour_id]) for tumour_id in tumour_ids])
+
+    chromosomes = remixt.config.get_chromosomes(config, ref_data_dir)
+
+    workflow = pypeliner.workflow.Workflow()
+
+    workflow.setobj(
+        obj=mgd.OutputChunks('tumour_id', 'chromosome'),
+        value=[(tumour_id, chromosome) for tumour_id in tumour_ids for chromosome in chromosomes],
     )
 
-    workflow.subworkflow(
-        name='fit_model',
+    workflow.transform(
+        name='count_bam_segments',
+        axes=('tumour_id', 'chromosome'),
+        ctx={'mem': 8},
+        func=remixt.analysis.bamcount.count_bam_segments,
+        args=(
+            mgd.TempOutputFile('chromosome_segment_counts.tsv', 'tumour_id', 'chromosome'),
+            mgd.TempOutputFile('chromosome_allele_counts.tsv', 'tumour_id', 'chromosome'),
+            mgd.TempOutputFile('chromosome_gc_read_counts.tsv', 'tumour_id', 'chromosome'),
+            mgd.TempOutputFile('chromosome_fragment_length_sums.tsv', 'tumour_id', 'chromosome'),
+            mgd.InputFile('tumour_bam', 'tumour_id', fnames=tumour_bam_filenames),
+            mgd.InputFile(segment_filename),
+            mgd.InputFile(haplotypes_filename),
+            mgd.InputFile(gc_positions_filename),
+            mgd.InputInstance('chromosome'),
+            config,
+            ref_data_dir,
+        ),
+    )
+
+    _add_merge_bam_counts_transforms(
+        workflow,
+        segment_filename,
+        count_filenames,
+        gc_read_counts_filenames,
+        fragment_length_sums_filenames,
+        'chromosome',
+    )
+
+    return workflow
+
+
+def _add_merge_bam_counts_transforms(
+    workflow,
+    segment_filename,
+    count_filenames,
+    gc_read_counts_filenames,
+    fragment_length_sums_filenames,
+    chromosome_axis,
+):
+    workflow.transform(
+        name='merge_segment_counts',
         axes=('tumour_id',),
-        func=remixt.workflow.create_fit_model_workflow,
+        func=remixt.analysis.bamcount.merge_segment_counts,
         args=(
-            mgd.InputFile('experiment', 'tumour_id', template=experiment_template),
-            mgd.OutputFile('results', 'tumour_id', fnames=results_filenames),
+            mgd.TempOutputFile('segment_counts.tsv', 'tumour_id'),
+            mgd.InputFile(segment_filename),
+            mgd.TempInputFile('chromosome_segment_counts.tsv', 'tumour_id', chromosome_axis),
+        ),
+    )
+
+    workflow.transform(
+        name='merge_allele_counts',
+        axes=('tumour_id',),
+        func=remixt.utils.merge_tables,
+        args=(
+            mgd.TempOutputFile('allele_counts.tsv', 'tumour_id'),
+            mgd.TempInputFile('chromosome_allele_counts.tsv', 'tumour_id', chromosome_axis),
+        ),
+    )
+
+    workflow.transform(
+        name='merge_gc_read_counts',
+        axes=('tumour_id',),
+        func=remixt.utils.merge_tables,
+        args=(
+            mgd.OutputFile('gc_read_counts', 'tumour_id', fnames=gc_read_counts_filenames),
+            mgd.TempInputFile('chromosome_gc_read_counts.tsv', 'tumour_id', chromosome_axis),
+        ),
+    )
+
+    workflow.transform(
+        name='merge_fragment_length_sums',
+        axes=('tumour_id',),
+        func=remixt.utils.merge_tables,
+        args=(
+            mgd.OutputFile('fragment_length_sums', 'tumour_id', fnames=fragment_length_sums_filenames),
+            mgd.TempInputFile('chromosome_fragment_length_sums.tsv', 'tumour_id', chromosome_axis),
+        ),
+    )
+
+    _add_phase_counts_transforms(workflow, count_filenames)
+
+
+def create_prepare_tumour_bam_counts_workflow(
+    segment_filename,
+    haplotypes_filename,
+    gc_positions_filename,
+    tumour_bam_filenames,
+    count_filenames,
+    gc_read_counts_filenames,
+    fragment_length_sums_filenames,
+    config,
+    ref_data_dir,
+):
+    """ Count reads of tumour bams in a single pass, inferring haplotypes from the tumour snp counts.
+
+    Snp, segment and gc position reads are counted, and alleles of each
+    fragment recorded, in one pass of each bam.  Allele counts are calculated
+    from the recorded alleles once haplotypes are inferred.
+    """
+    tumour_ids = tumour_bam_filenames.keys()
+    count_filenames = dict([(tumour_id, count_filenames[tumour_id]) for tumour_id in tumour_ids])
+    gc_read_counts_filenames = dict([(tumour_id, gc_read_counts_filenames[tumour_id]) for tumour_id in tumour_ids])
+    fragment_length_sums_filenames = dict([(tumour_id, fragment_length_sums_filenames[tumour_id]) for tumour_id in tumour_ids])
+
+    chromosomes = remixt.config.get_chromosomes(config, ref_data_dir)
+
+    workflow = pypeliner.workflow.Workflow()
+
+    workflow.setobj(obj=mgd.OutputChunks('chromosome'), value=chromosomes)
+
+    workflow.setobj(
+        obj=mgd.OutputChunks('tumour_id', 'tumour_chromosome'),
+        value=[(tumour_id, chromosome) for tumour_id in tumour_ids for chromosome in chromosomes],
+    )
+
+    workflow.transform(
+        name='count_bam_chromosome',
+        axes=('tumour_id', 'tumour_chromosome'),
+        ctx={'mem': 8},
+        func=remixt.analysis.bamcount.count_bam_chromosome,
+        args=(
+            mgd.TempOutputFile('chromosome_snp_counts.tsv', 'tumour_id', 'tumour_chromosome'),
+            mgd.TempOutputFile('chromosome_segment_counts.tsv', 'tumour_id', 'tumour_chromosome'),
+            mgd.TempOutputFile('chromosome_allele_reads.h5', 'tumour_id', 'tumour_chromosome'),
+            mgd.TempOutputFile('chromosome_gc_read_counts.tsv', 'tumour_id', 'tumour_chromosome'),
+            mgd.TempOutputFile('chromosome_fragment_length_sums.tsv', 'tumour_id', 'tumour_chromosome'),
+            mgd.InputFile('tumour_bam', 'tumour_id', fnames=tumour_bam_filenames),
+            mgd.InputFile(segment_filename),
+            mgd.InputFile(gc_positions_filename),
+            mgd.InputInstance('tumour_chromosome'),
+            config,
+            ref_data_dir,
+        ),
+    )
+
+    # Snps are counted per tumour and chromosome, and genotyped per
+    # chromosome from the counts of all tumours
+    workflow.transform(
+        name='merge_tumour_snp_counts',
+        axes=('tumour_id',),
+        func=remixt.utils.merge_tables,
+        args=(
+            mgd.TempOutputFile('snp_counts.tsv', 'tumour_id'),
+            mgd.TempInputFile('chromosome_snp_counts.tsv', 'tumour_id', 'tumour_chromosome'),
+        ),
+    )
+
+    workflow.transform(
+        name='infer_snp_genotype_from_tumour',
+        axes=('chromosome',),
+        ctx={'mem': 16},
+        func=remixt.analysis.haplotype.infer_snp_genotype_from_tumour_counts,
+        args=(
+            mgd.TempOutputFile('snp_genotype.tsv', 'chromosome'),
+            mgd.TempInputFile('snp_counts.tsv', 'tumour_id'),
+            mgd.InputInstance('chromosome'),
+            config,
+        ),
+    )
+
+    _add_infer_haps_transforms(workflow, haplotypes_filename, config, ref_data_dir)
+
+    workflow.transform(
+        name='count_allele_reads',
+        axes=('tumour_id', 'tumour_chromosome'),
+        ctx={'mem': 8},
+        func=remixt.analysis.bamcount.count_allele_reads_from_table,
+        args=(
+            mgd.TempOutputFile('chromosome_allele_counts.tsv', 'tumour_id', 'tumour_chromosome'),
+            mgd.TempInputFile('chromosome_allele_reads.h5', 'tumour_id', 'tumour_chromosome'),
+            mgd.InputFile(haplotypes_filename),
+            mgd.InputFile(segment_filename),
+            mgd.InputInstance('tumour_chromosome'),
+        ),
+    )
+
+    _add_merge_bam_counts_transforms(
+        workflow,
+        segment_filename,
+        count_filenames,
+        gc_read_counts_filenames,
+        fragment_length_sums_filenames,
+        'tumour_chromosome',
+    )
+
+    return workflow
+
+
+def create_calc_bias_from_counts_workflow(
+    fragment_length_sums_filename,
+    gc_read_counts_filename,
+    segment_filename,
+    segment_length_filename,
+    config,
+    ref_data_dir,
+):
+    workflow = pypeliner.workflow.Workflow(default_ctx={'mem': 4})
+
+    workflow.transform(
+        name='calc_fragment_stats',
+        func=remixt.analysis.bamcount.calculate_fragment_stats,
+        ret=mgd.TempOutputObj('fragstats'),
+        args=(
+            mgd.InputFile(fragment_length_sums_filename),
+        )
+    )
+
+    workflow.transform(
+        name='sample_gc',
+        ctx={'mem': 16},
+        func=remixt.analysis.gcbias.sample_gc_from_counts,
+        args=(
+            mgd.TempOutputFile('gcsamples.tsv'),
+            mgd.InputFile(gc_read_counts_filename),
+            mgd.TempInputObj('fragstats').prop('fragment_mean'),
+            config,
+            ref_data_dir,
+        )
+    )
+
+    _add_gc_bias_transforms(workflow, segment_filename, segment_length_filename, config, ref_data_dir)
+
+    return workflow
+
+
+def create_remixt_bam_streaming_workflow(
+    breakpoint_filename,
+    bam_filenames,
+    results_filenames,
+    raw_data_directory,
+    config,
+    ref_data_dir,
+    normal_id=None,
+):
+    sample_ids = bam_filenames.keys()
+
+    tumour_ids = bam_filenames.keys()
+    if normal_id is not None:
+        tumour_ids.remove(normal_id)
+
+    results_filenames = dict([(tumour_id, results_filenames[tumour_id]) for tumour_id in tumour_ids])
+
+    segment_filename = os.path.join(raw_data_directory, 'segments.tsv')
+    haplotypes_filename = os.path.join(raw_data_directory, 'haplotypes.tsv')
+    gc_positions_filename = os.path.join(raw_data_directory, 'gc_positions.tsv')
+    gc_read_counts_template = os.path.join(raw_data_directory, 'gc_read_counts', 'sample_{tumour_id}.tsv')
+    fragment_length_sums_template = os.path.join(raw_data_directory, 'fragment_length_sums', 'sample_{tumour_id}.tsv')
+    counts_table_template = os.path.join(raw_data_directory, 'counts', 'sample_{tumour_id}.tsv')
+    experiment_template = os.path.join(raw_data_directory, 'experiment', 'sample_{tumour_id}.pickle')
+    ploidy_plots_template = os.path.join(raw_data_directory, 'ploidy_plots', 'sample_{tumour_id}.pdf')
+
+    workflow = pypeliner.workflow.Workflow()
+
+    workflow.setobj(
+        obj=mgd.OutputChunks('sample_id'),
+        value=sample_ids,
+    )
+
+    workflow.setobj(
+        obj=mgd.OutputChunks('tumour_id'),
+        value=tumour_ids,
+    )
+
+    workflow.transform(
+        name='create_segments',
+        func=remixt.analysis.segment.create_segments,
+        args=(
+            mgd.OutputFile(segment_filename),
             config,
             ref_data_dir,
         ),
         kwargs={
-            'tumour_id': mgd.InputInstance('tumour_id'),
+            'breakpoint_filename': mgd.InputFile(breakpoint_filename),
         },
     )
 
+    workflow.transform(
+        name='sample_gc_positions',
+        ctx={'mem': 16},
+        func=remixt.analysis.gcbias.sample_gc_positions,
+        args=(
+            mgd.OutputFile(gc_positions_filename),
+            config,
+            ref_data_dir,
+        ),
+    )
+
+    if normal_id is not None:
+        workflow.subworkflow(
+            name='infer_haps_workflow',
+            func=remixt.workflow.create_infer_haps_bam_workflow,
+            args=(
+                mgd.InputFile('bam', 'sample_id', fnames=bam_filenames),
+                mgd.OutputFile(haplotypes_filename),
+                config,
+                ref_data_dir,
+            ),
+            kwargs={
+                'normal_id': normal_id,
+            }
+        )
+
+        workflow.subworkflow(
+            name='prepare_counts_workflow',
+            func=remixt.workflow.create_prepare_bam_counts_workflow,
+            args=(
+                mgd.InputFile(segment_filename),
+                mgd.InputFile(haplotypes_filename),
+                mgd.InputFile(gc_positions_filename),
+                mgd.InputFile('bam', 'tumour_id', fnames=bam_filenames),
+                mgd.TempOutputFile('rawcounts', 'tumour_id', axes_origin=[]),
+                mgd.OutputFile('gc_read_counts', 'tumour_id', template=gc_read_counts_template, axes_origin=[]),
+                mgd.OutputFile('fragment_length_sums', 'tumour_id', template=fragment_length_sums_template, axes_origin=[]),
+                config,
+                ref_data_dir,
+            ),
+        )
+
+    else:
+        # Without a normal, haplotypes are inferred from the tumours, which
+        # are read once for both snp and segment counts
+        workflow.subworkflow(
+            name='prepare_counts_workflow',
+            func=remixt.workflow.create_prepare_tumour_bam_counts_workflow,
+            args=(
+                mgd.InputFile(segment_filename),
+                mgd.OutputFile(haplotypes_filename),
+                mgd.InputFile(gc_positions_filename),
+                mgd.InputFile('bam', 'tumour_id', fnames=bam_filenames),
+                mgd.TempOutputFile('rawcounts', 'tumour_id', axes_origin=[]),
+                mgd.OutputFile('gc_read_counts', 'tumour_id', template=gc_read_counts_template, axes_origin=[]),
+                mgd.OutputFile('fragment_length_sums', 'tumour_id', template=fragment_length_sums_template, axes_origin=[]),
+                config,
+                ref_data_dir,
+            ),
+        )
+
+    workflow.subworkflow(
+        name='calc_bias_workflow',
+        axes=('tumour_id',),
+        func=remixt.workflow.create_calc_bias_from_counts_workflow,
+        args=(
+            mgd.InputFile('fragment_length_sums', 'tumour_id', template=fragment_length_sums_template),
+            mgd.InputFile('gc_read_counts', 'tumour_id', template=gc_read_counts_template),
+            mgd.TempInputFile('rawcounts', 'tumour_id'),
+            mgd.OutputFile('counts', 'tumour_id', template=counts_table_template),
+            config,
+            ref_data_dir,
+        ),
+    )
+
+    _add_fit_model_transforms(
+        workflow,
+        breakpoint_filename,
+        results_filenames,
+        counts_table_template,
+        experiment_template,
+        ploidy_plots_template,
+        config,
+        ref_data_dir,
+    )
+
     return workflow
 
 
@@ -481,6 +1051,17 @@ def create_remixt_bam_workflow(
     ref_data_dir,
     normal_id=None,
 ):
+    if remixt.config.get_param(config, 'bam_stream_counts'):
+        return create_remixt_bam_streaming_workflow(
+            breakpoint_filename,
+            bam_filenames,
+            results_filenames,
+            raw_data_directory,
+            config,
+            ref_data_dir,
+            normal_id=normal_id,
+        )
+
     sample_ids = bam_filenames.keys()
     
     tumour_ids = bam_filenames.keys()
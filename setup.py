@@ -32,7 +32,7 @@ if 'linux' in sys.platform:
 extensions = [
     Extension(
         name='remixt.bamreader',
-        sources=['remixt/bamreader.pyx', 'src/BamAlleleReader.cpp'] + bamtools_sources,
+        sources=['remixt/bamreader.pyx', 'src/BamAlleleReader.cpp', 'src/MateIndex.cpp'] + bamtools_sources,
         include_dirs=['src', external_dir, bamtools_dir, numpy.get_include()],
         libraries=['z', 'bz2'],
         extra_compile_args=['-g'],
@@ -41,7 +41,8 @@ extensions = [
         name='remixt.bpmodel',
         sources=['remixt/bpmodel.pyx'],
         include_dirs=[numpy.get_include()],
-        extra_compile_args=['-g', '-Wno-unused-function'],
+        extra_compile_args=['-g', '-Wno-unused-function', '-fopenmp'],
+        extra_link_args=['-fopenmp'],
     ),
 ]
 
@@ -64,13 +64,19 @@ AlleleReader::AlleleReader(const string& bamFilename,
                            const string& chromosome,
                            int maxFragmentLength,
                            int maxSoftClipped,
-                           bool checkProperPair)
+                           bool checkProperPair,
+                           int regionStart,
+                           int regionEnd,
+                           bool hashMateIndex)
 	: mChromosome(chromosome),
 	  mMaxFragmentLength(maxFragmentLength),
 	  mMaxSoftClipped(maxSoftClipped),
+	  mCheckProperPair(checkProperPair),
+	  mRegionStart(regionStart),
+	  mRegionEnd(regionEnd),
+	  mMateIndex(0),
 	  mRefID(-1),
-	  mNextFragmentID(0),
-	  mCheckProperPair(checkProperPair)
+	  mNextFragmentID(0)
 {
 	if (!mBamReader.Open(bamFilename))
 	{
@@ -105,8 +111,21 @@ AlleleReader::AlleleReader(const string& bamFilename,
 		}
 	}
 
-	// Set region in bam
-	mBamReader.SetRegion(BamRegion(mRefID, 0, mRefID+1, 1));
+	// Set region in bam, extending past the end of the region so that
+	// mates of fragments starting in the region are available
+	if (mRegionEnd < 0)
+	{
+		mBamReader.SetRegion(BamRegion(mRefID, max(0, mRegionStart), mRefID+1, 1));
+	}
+	else
+	{
+		if (mRegionEnd <= mRegionStart)
+		{
+			throw invalid_argument("Empty region for chromosome " + mChromosome);
+		}
+
+		mBamReader.SetRegion(BamRegion(mRefID, max(0, mRegionStart), mRefID, mRegionEnd + mMaxFragmentLength));
+	}
 
 	if (!snpFilename.empty())
 	{
@@ -115,6 +134,20 @@ AlleleReader::AlleleReader(const string& bamFilename,
 	
 	mPileupEngine.AddVisitor(dynamic_cast<PileupVisitor*>(this));
 	mPileupEngine.AddVisitor(dynamic_cast<DiscardAlignmentVisitor*>(this));
+
+	if (hashMateIndex)
+	{
+		mMateIndex = new HashMateIndex();
+	}
+	else
+	{
+		mMateIndex = new MapMateIndex();
+	}
+}
+
+AlleleReader::~AlleleReader()
+{
+	delete mMateIndex;
 }
 
 void AlleleReader::ReadSNPs(const string& snpFilename)
@@ -208,22 +241,25 @@ bool AlleleReader::ReadAlignments(int maxAlignments)
 		}
 		
 		// Pair up reads and classify as concordant, give passing reads an index
-		map<string,BamAlignment>::iterator otherEndIter = mReadBuffer[GetOtherReadEnd(alignment)].find(alignment.Name);
-		if (otherEndIter != mReadBuffer[GetOtherReadEnd(alignment)].end())
+		BamAlignment* otherEnd = mMateIndex->FindAlignment(alignment.Name, GetOtherReadEnd(alignment));
+		if (otherEnd != 0)
 		{
 			BamAlignment& alignment1 = alignment;
-			BamAlignment& alignment2 = otherEndIter->second;
+			BamAlignment& alignment2 = *otherEnd;
 			
 			bool valid1 = valid;
 			bool valid2 = IsReadValidConcordant(alignment2, mMaxSoftClipped);
-			bool validPair = valid1 && valid2;
+
+			// Calculate start and end of fragment alignment
+			int fragmentStart = min(alignment1.Position, alignment2.Position);
+			int fragmentEnd = fragmentStart + abs(alignment1.InsertSize);
+
+			// Fragments starting outside the region are extracted by the reader
+			// for the neighbouring region, and are not added to the pileup
+			bool validPair = valid1 && valid2 && IsOwnedPosition(fragmentStart);
 			
 			if (validPair)
 			{
-				// Calculate start and end of fragment alignment
-				int fragmentStart = min(alignment1.Position, alignment2.Position);
-				int fragmentEnd = fragmentStart + abs(alignment1.InsertSize);
-
 				// Set as duplicate if either is duplicate
 				int isDuplicate = (int)(alignment1.IsDuplicate() || alignment2.IsDuplicate());
 
@@ -239,8 +275,8 @@ bool AlleleReader::ReadAlignments(int maxAlignments)
 				mNextFragmentID++;
 
 				// Store fragment id for snp stage
-				mFragmentID[0].insert(make_pair(alignment.Name, fragmentID));
-				mFragmentID[1].insert(make_pair(alignment.Name, fragmentID));
+				mMateIndex->InsertFragmentID(alignment.Name, 0, fragmentID);
+				mMateIndex->InsertFragmentID(alignment.Name, 1, fragmentID);
 
 				// Save out read alignment info
 				mFragmentData.push_back(FragmentData(fragmentID, fragmentStart, fragmentEnd, mappingQuality, isDuplicate));
@@ -249,18 +285,18 @@ bool AlleleReader::ReadAlignments(int maxAlignments)
 			// Set status for alignments in the queue
 			if (valid1)
 			{
-				mReadStatus[GetReadEnd(alignment1)].insert(make_pair(alignment1.Name, validPair));
+				mMateIndex->InsertStatus(alignment1.Name, GetReadEnd(alignment1), validPair);
 			}
 			if (valid2)
 			{
-				mReadStatus[GetReadEnd(alignment2)].insert(make_pair(alignment2.Name, validPair));
+				mMateIndex->InsertStatus(alignment2.Name, GetReadEnd(alignment2), validPair);
 			}
 			
-			mReadBuffer[GetOtherReadEnd(alignment)].erase(otherEndIter);
+			mMateIndex->EraseAlignment(alignment.Name, GetOtherReadEnd(alignment));
 		}
 		else
 		{
-			mReadBuffer[GetReadEnd(alignment)].insert(make_pair(alignment.Name, alignment));
+			mMateIndex->InsertAlignment(alignment, GetReadEnd(alignment));
 		}
 		
 		// Process concordant reads from the queue
@@ -268,24 +304,27 @@ bool AlleleReader::ReadAlignments(int maxAlignments)
 		{
 			BamAlignment& nextAlignment = mReadQueue.front();
 			
-			map<string,bool>::iterator readStatusIter = mReadStatus[GetReadEnd(nextAlignment)].find(nextAlignment.Name);
+			bool validPair = false;
 			
 			// Check for existance of read pair status
-			if (readStatusIter != mReadStatus[GetReadEnd(nextAlignment)].end())
+			if (mMateIndex->FindStatus(nextAlignment.Name, GetReadEnd(nextAlignment), validPair))
 			{
 				// Add valid reads to the pileup
-				if (readStatusIter->second)
+				if (validPair)
 				{
 					mPileupEngine.AddAlignment(nextAlignment);
 				}
 				
 				// Remove read status
-				mReadStatus[GetReadEnd(nextAlignment)].erase(readStatusIter);
+				mMateIndex->EraseStatus(nextAlignment.Name, GetReadEnd(nextAlignment));
 			}
 			// Check for an unmatched read stuck in the queue
 			else if (alignment.Position - nextAlignment.Position > 2.0 * mMaxFragmentLength)
 			{
-				cerr << "Warning: Could not match read " << nextAlignment.Name << endl;
+				if (IsOwnedPosition(min(nextAlignment.Position, nextAlignment.MatePosition)))
+				{
+					cerr << "Warning: Could not match read " << nextAlignment.Name << endl;
+				}
 			}
 			// Read pair status unavailable but read not yet considered stuck
 			else
@@ -306,22 +345,23 @@ bool AlleleReader::ReadAlignments(int maxAlignments)
 		{
 			BamAlignment& nextAlignment = mReadQueue.front();
 			
-			map<string,bool>::iterator readStatusIter = mReadStatus[GetReadEnd(nextAlignment)].find(nextAlignment.Name);
+			bool validPair = false;
 			
 			// Check for existance of read pair status
-			if (readStatusIter != mReadStatus[GetReadEnd(nextAlignment)].end())
+			if (mMateIndex->FindStatus(nextAlignment.Name, GetReadEnd(nextAlignment), validPair))
 			{
 				// Add valid reads to the pileup
-				if (readStatusIter->second)
+				if (validPair)
 				{
 					mPileupEngine.AddAlignment(nextAlignment);
 				}
 				
 				// Remove read status
-				mReadStatus[GetReadEnd(nextAlignment)].erase(readStatusIter);
+				mMateIndex->EraseStatus(nextAlignment.Name, GetReadEnd(nextAlignment));
 			}
-			// Check for an unmatched read stuck in the queue
-			else
+			// Check for an unmatched read stuck in the queue, ignoring reads
+			// of fragments extracted by the reader for a neighbouring region
+			else if (IsOwnedPosition(min(nextAlignment.Position, nextAlignment.MatePosition)))
 			{
 				cerr << "Warning: Could not match read " << nextAlignment.Name << endl;
 			}
@@ -336,6 +376,11 @@ bool AlleleReader::ReadAlignments(int maxAlignments)
 	return !mFragmentData.empty() || !mAlleleData.empty();
 }
 
+bool AlleleReader::IsOwnedPosition(int position) const
+{
+	return position >= mRegionStart && (mRegionEnd < 0 || position < mRegionEnd);
+}
+
 void AlleleReader::Visit(const PileupPosition& pileupData)
 {
 	// Check if we are on the correct chromosome
@@ -381,7 +426,8 @@ void AlleleReader::Visit(const PileupPosition& pileupData)
 			continue;
 		}
 		
-		int fragmentID = mFragmentID[GetReadEnd(alignment)][alignment.Name];
+		int fragmentID = 0;
+		mMateIndex->FindFragmentID(alignment.Name, GetReadEnd(alignment), fragmentID);
 		
 		// Output 1-based positions
 		int position = mSNPIter->position + 1;
@@ -393,6 +439,6 @@ void AlleleReader::Visit(const PileupPosition& pileupData)
 
 void AlleleReader::Visit(const BamAlignment& alignment)
 {
-	mFragmentID[GetReadEnd(alignment)].erase(alignment.Name);
+	mMateIndex->EraseFragmentID(alignment.Name, GetReadEnd(alignment));
 }
 
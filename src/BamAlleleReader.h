@@ -3,11 +3,12 @@
 
 #include <string>
 #include <deque>
-#include <map>
 
 #include "external/bamtools/src/api/BamReader.h"
 #include "external/bamtools/src/utils/bamtools_pileup_engine.h"
 
+#include "MateIndex.h"
+
 
 struct FragmentData
 {
@@ -68,18 +69,25 @@ struct AlleleReader : BamTools::PileupVisitor, BamTools::DiscardAlignmentVisitor
 	             const std::string& chromosome,
 	             int maxFragmentLength,
 	             int maxSoftClipped,
-	             bool checkProperPair);
+	             bool checkProperPair,
+	             int regionStart = 0,
+	             int regionEnd = -1,
+	             bool hashMateIndex = true);
+
+	~AlleleReader();
 
 	void ReadSNPs(const std::string& snpFilename);
 
 	bool ReadAlignments(int maxAlignments);
 
+	bool IsOwnedPosition(int position) const;
+
 	void Visit(const BamTools::PileupPosition& pileupData);
 	
 	void Visit(const BamTools::BamAlignment& alignment);
 	
 	BamTools::BamReader mBamReader;
-	const std::string& mChromosome;
+	std::string mChromosome;
 	std::string mAlternateChromosome;
 
 	std::vector<FragmentData> mFragmentData;
@@ -89,10 +97,13 @@ struct AlleleReader : BamTools::PileupVisitor, BamTools::DiscardAlignmentVisitor
 	int mMaxSoftClipped;
 	bool mCheckProperPair;
 	
+	// Fragments are extracted if their start is within [mRegionStart, mRegionEnd),
+	// mRegionEnd < 0 for the end of the chromosome
+	int mRegionStart;
+	int mRegionEnd;
+	
 	std::deque<BamTools::BamAlignment> mReadQueue;
-	std::map<std::string,BamTools::BamAlignment> mReadBuffer[2];
-	std::map<std::string,bool> mReadStatus[2];
-	std::map<std::string,int> mFragmentID[2];
+	MateIndex* mMateIndex;
 	
 	int mRefID;
 	int mNextFragmentID;
@@ -101,6 +112,10 @@ struct AlleleReader : BamTools::PileupVisitor, BamTools::DiscardAlignmentVisitor
 	std::vector<SNPInfo>::const_iterator mSNPIter;
 
 	BamTools::PileupEngine mPileupEngine;
+
+private:
+	AlleleReader(const AlleleReader&);
+	AlleleReader& operator=(const AlleleReader&);
 };
 
 #endif
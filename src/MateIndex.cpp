@@ -0,0 +1,332 @@
+#include "MateIndex.h"
+
+using namespace std;
+
+using namespace BamTools;
+
+
+BamAlignment* MapMateIndex::FindAlignment(const string& name, int readEnd)
+{
+	map<string,BamAlignment>::iterator iter = mReadBuffer[readEnd].find(name);
+	if (iter == mReadBuffer[readEnd].end())
+	{
+		return 0;
+	}
+	return &iter->second;
+}
+
+void MapMateIndex::InsertAlignment(const BamAlignment& alignment, int readEnd)
+{
+	mReadBuffer[readEnd].insert(make_pair(alignment.Name, alignment));
+}
+
+void MapMateIndex::EraseAlignment(const string& name, int readEnd)
+{
+	mReadBuffer[readEnd].erase(name);
+}
+
+bool MapMateIndex::FindStatus(const string& name, int readEnd, bool& validPair)
+{
+	map<string,bool>::iterator iter = mReadStatus[readEnd].find(name);
+	if (iter == mReadStatus[readEnd].end())
+	{
+		return false;
+	}
+	validPair = iter->second;
+	return true;
+}
+
+void MapMateIndex::InsertStatus(const string& name, int readEnd, bool validPair)
+{
+	mReadStatus[readEnd].insert(make_pair(name, validPair));
+}
+
+void MapMateIndex::EraseStatus(const string& name, int readEnd)
+{
+	mReadStatus[readEnd].erase(name);
+}
+
+bool MapMateIndex::FindFragmentID(const string& name, int readEnd, int& fragmentID)
+{
+	map<string,int>::iterator iter = mFragmentID[readEnd].find(name);
+	if (iter == mFragmentID[readEnd].end())
+	{
+		return false;
+	}
+	fragmentID = iter->second;
+	return true;
+}
+
+void MapMateIndex::InsertFragmentID(const string& name, int readEnd, int fragmentID)
+{
+	mFragmentID[readEnd].insert(make_pair(name, fragmentID));
+}
+
+void MapMateIndex::EraseFragmentID(const string& name, int readEnd)
+{
+	mFragmentID[readEnd].erase(name);
+}
+
+HashMateIndex::HashMateIndex(int initialCapacity)
+{
+	// Capacity is a power of 2 for masking
+	size_t capacity = 16;
+	while (capacity < (size_t)initialCapacity)
+	{
+		capacity *= 2;
+	}
+
+	mTables[0].entries.resize(capacity);
+	mTables[1].entries.resize(capacity);
+}
+
+uint64_t HashMateIndex::HashName(const string& name)
+{
+	// FNV-1a followed by a 64 bit finalizer to mix the high bits into the low bits
+	uint64_t hash = 14695981039346656037ULL;
+	for (string::const_iterator iter = name.begin(); iter != name.end(); ++iter)
+	{
+		hash ^= (unsigned char)(*iter);
+		hash *= 1099511628211ULL;
+	}
+
+	hash ^= hash >> 33;
+	hash *= 0xff51afd7ed558ccdULL;
+	hash ^= hash >> 33;
+	hash *= 0xc4ceb9fe1a85ec53ULL;
+	hash ^= hash >> 33;
+
+	return (hash == 0) ? 1 : hash;
+}
+
+HashMateIndex::Entry* HashMateIndex::Find(int readEnd, uint64_t hash)
+{
+	vector<Entry>& entries = mTables[readEnd].entries;
+	size_t mask = entries.size() - 1;
+
+	for (size_t idx = hash & mask; entries[idx].hash != 0; idx = (idx + 1) & mask)
+	{
+		if (entries[idx].hash == hash)
+		{
+			return &entries[idx];
+		}
+	}
+
+	return 0;
+}
+
+HashMateIndex::Entry* HashMateIndex::Acquire(int readEnd, uint64_t hash)
+{
+	Entry* entry = Find(readEnd, hash);
+	if (entry != 0)
+	{
+		return entry;
+	}
+
+	Table& table = mTables[readEnd];
+
+	// Keep the load factor at most 1/2
+	if (2 * (table.size + 1) > table.entries.size())
+	{
+		Grow(table);
+	}
+
+	size_t mask = table.entries.size() - 1;
+	size_t idx = hash & mask;
+	while (table.entries[idx].hash != 0)
+	{
+		idx = (idx + 1) & mask;
+	}
+
+	table.entries[idx].hash = hash;
+	table.size++;
+
+	return &table.entries[idx];
+}
+
+void HashMateIndex::Release(int readEnd, Entry* entry)
+{
+	// Entries are removed once they no longer hold any information
+	if (entry->slot >= 0 || entry->flags != 0)
+	{
+		return;
+	}
+
+	Table& table = mTables[readEnd];
+	vector<Entry>& entries = table.entries;
+	size_t mask = entries.size() - 1;
+
+	// Backward shift deletion, moving subsequent entries of the probe
+	// sequence into the hole so that no tombstones are required
+	size_t hole = entry - &entries[0];
+	size_t idx = hole;
+	while (true)
+	{
+		idx = (idx + 1) & mask;
+
+		if (entries[idx].hash == 0)
+		{
+			break;
+		}
+
+		size_t home = entries[idx].hash & mask;
+
+		// Move if the home position of the entry is not cyclically within (hole, idx]
+		bool movable = (hole <= idx) ? (home <= hole || home > idx) : (home <= hole && home > idx);
+		if (movable)
+		{
+			entries[hole] = entries[idx];
+			hole = idx;
+		}
+	}
+
+	entries[hole] = Entry();
+	table.size--;
+}
+
+void HashMateIndex::Grow(Table& table)
+{
+	vector<Entry> entries(2 * table.entries.size());
+	size_t mask = entries.size() - 1;
+
+	for (vector<Entry>::const_iterator iter = table.entries.begin(); iter != table.entries.end(); ++iter)
+	{
+		if (iter->hash == 0)
+		{
+			continue;
+		}
+
+		size_t idx = iter->hash & mask;
+		while (entries[idx].hash != 0)
+		{
+			idx = (idx + 1) & mask;
+		}
+
+		entries[idx] = *iter;
+	}
+
+	table.entries.swap(entries);
+}
+
+BamAlignment* HashMateIndex::FindAlignment(const string& name, int readEnd)
+{
+	Entry* entry = Find(readEnd, HashName(name));
+	if (entry == 0 || entry->slot < 0 || mSlots[entry->slot].Name != name)
+	{
+		return 0;
+	}
+	return &mSlots[entry->slot];
+}
+
+void HashMateIndex::InsertAlignment(const BamAlignment& alignment, int readEnd)
+{
+	Entry* entry = Acquire(readEnd, HashName(alignment.Name));
+	if (entry->slot >= 0)
+	{
+		return;
+	}
+
+	if (mFreeSlots.empty())
+	{
+		mSlots.push_back(alignment);
+		entry->slot = mSlots.size() - 1;
+	}
+	else
+	{
+		entry->slot = mFreeSlots.back();
+		mFreeSlots.pop_back();
+		mSlots[entry->slot] = alignment;
+	}
+}
+
+void HashMateIndex::EraseAlignment(const string& name, int readEnd)
+{
+	Entry* entry = Find(readEnd, HashName(name));
+	if (entry == 0 || entry->slot < 0)
+	{
+		return;
+	}
+
+	mFreeSlots.push_back(entry->slot);
+	entry->slot = -1;
+
+	Release(readEnd, entry);
+}
+
+bool HashMateIndex::FindStatus(const string& name, int readEnd, bool& validPair)
+{
+	Entry* entry = Find(readEnd, HashName(name));
+	if (entry == 0 || !(entry->flags & HAS_STATUS))
+	{
+		return false;
+	}
+	validPair = (entry->flags & STATUS_VALID) != 0;
+	return true;
+}
+
+void HashMateIndex::InsertStatus(const string& name, int readEnd, bool validPair)
+{
+	Entry* entry = Acquire(readEnd, HashName(name));
+	if (entry->flags & HAS_STATUS)
+	{
+		return;
+	}
+	entry->flags |= HAS_STATUS;
+	if (validPair)
+	{
+		entry->flags |= STATUS_VALID;
+	}
+}
+
+void HashMateIndex::EraseStatus(const string& name, int readEnd)
+{
+	Entry* entry = Find(readEnd, HashName(name));
+	if (entry == 0)
+	{
+		return;
+	}
+
+	entry->flags &= ~(HAS_STATUS | STATUS_VALID);
+
+	Release(readEnd, entry);
+}
+
+bool HashMateIndex::FindFragmentID(const string& name, int readEnd, int& fragmentID)
+{
+	Entry* entry = Find(readEnd, HashName(name));
+	if (entry == 0 || !(entry->flags & HAS_FRAGMENT_ID))
+	{
+		return false;
+	}
+	fragmentID = entry->fragmentID;
+	return true;
+}
+
+void HashMateIndex::InsertFragmentID(const string& name, int readEnd, int fragmentID)
+{
+	Entry* entry = Acquire(readEnd, HashName(name));
+	if (entry->flags & HAS_FRAGMENT_ID)
+	{
+		return;
+	}
+	entry->flags |= HAS_FRAGMENT_ID;
+	entry->fragmentID = fragmentID;
+}
+
+void HashMateIndex::EraseFragmentID(const string& name, int readEnd)
+{
+	Entry* entry = Find(readEnd, HashName(name));
+	if (entry == 0)
+	{
+		return;
+	}
+
+	entry->flags &= ~HAS_FRAGMENT_ID;
+
+	Release(readEnd, entry);
+}
+
+size_t HashMateIndex::Size() const
+{
+	return mTables[0].size + mTables[1].size;
+}
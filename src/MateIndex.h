@@ -0,0 +1,125 @@
+#ifndef MATEINDEX_H_
+#define MATEINDEX_H_
+
+#include <string>
+#include <deque>
+#include <map>
+#include <vector>
+#include <stdint.h>
+
+#include "external/bamtools/src/api/BamAlignment.h"
+
+
+// Index of reads in flight during mate pairing, keyed by read name and read end.
+// Tracks reads buffered until their mate is seen, the pair status of reads
+// queued for the pileup, and the fragment id of reads in the pileup.  For
+// each of these, insertion of an existing name is ignored.
+class MateIndex
+{
+public:
+	virtual ~MateIndex() {}
+
+	virtual BamTools::BamAlignment* FindAlignment(const std::string& name, int readEnd) = 0;
+	virtual void InsertAlignment(const BamTools::BamAlignment& alignment, int readEnd) = 0;
+	virtual void EraseAlignment(const std::string& name, int readEnd) = 0;
+
+	virtual bool FindStatus(const std::string& name, int readEnd, bool& validPair) = 0;
+	virtual void InsertStatus(const std::string& name, int readEnd, bool validPair) = 0;
+	virtual void EraseStatus(const std::string& name, int readEnd) = 0;
+
+	virtual bool FindFragmentID(const std::string& name, int readEnd, int& fragmentID) = 0;
+	virtual void InsertFragmentID(const std::string& name, int readEnd, int fragmentID) = 0;
+	virtual void EraseFragmentID(const std::string& name, int readEnd) = 0;
+};
+
+
+// Mate index using ordered maps keyed by read name
+class MapMateIndex : public MateIndex
+{
+public:
+	BamTools::BamAlignment* FindAlignment(const std::string& name, int readEnd);
+	void InsertAlignment(const BamTools::BamAlignment& alignment, int readEnd);
+	void EraseAlignment(const std::string& name, int readEnd);
+
+	bool FindStatus(const std::string& name, int readEnd, bool& validPair);
+	void InsertStatus(const std::string& name, int readEnd, bool validPair);
+	void EraseStatus(const std::string& name, int readEnd);
+
+	bool FindFragmentID(const std::string& name, int readEnd, int& fragmentID);
+	void InsertFragmentID(const std::string& name, int readEnd, int fragmentID);
+	void EraseFragmentID(const std::string& name, int readEnd);
+
+private:
+	std::map<std::string,BamTools::BamAlignment> mReadBuffer[2];
+	std::map<std::string,bool> mReadStatus[2];
+	std::map<std::string,int> mFragmentID[2];
+};
+
+
+// Mate index using an open addressing hash table per read end, keyed by a
+// 64 bit hash of the read name.  Buffered alignments are stored in a slab of
+// reusable slots, and matched by name in addition to hash.  Status and
+// fragment id lookups rely on the hash alone, with a collision probability
+// of order n^2 / 2^64 for n reads in flight.
+class HashMateIndex : public MateIndex
+{
+public:
+	HashMateIndex(int initialCapacity = 1024);
+
+	BamTools::BamAlignment* FindAlignment(const std::string& name, int readEnd);
+	void InsertAlignment(const BamTools::BamAlignment& alignment, int readEnd);
+	void EraseAlignment(const std::string& name, int readEnd);
+
+	bool FindStatus(const std::string& name, int readEnd, bool& validPair);
+	void InsertStatus(const std::string& name, int readEnd, bool validPair);
+	void EraseStatus(const std::string& name, int readEnd);
+
+	bool FindFragmentID(const std::string& name, int readEnd, int& fragmentID);
+	void InsertFragmentID(const std::string& name, int readEnd, int fragmentID);
+	void EraseFragmentID(const std::string& name, int readEnd);
+
+	size_t Size() const;
+
+private:
+	enum
+	{
+		HAS_STATUS = 1,
+		STATUS_VALID = 2,
+		HAS_FRAGMENT_ID = 4
+	};
+
+	// Hash of zero marks an empty entry
+	struct Entry
+	{
+		Entry() : hash(0), slot(-1), fragmentID(0), flags(0) {}
+
+		uint64_t hash;
+		int32_t slot;
+		int32_t fragmentID;
+		uint8_t flags;
+	};
+
+	struct Table
+	{
+		Table() : size(0) {}
+
+		std::vector<Entry> entries;
+		size_t size;
+	};
+
+	static uint64_t HashName(const std::string& name);
+
+	Entry* Find(int readEnd, uint64_t hash);
+	Entry* Acquire(int readEnd, uint64_t hash);
+	void Release(int readEnd, Entry* entry);
+	void Grow(Table& table);
+
+	Table mTables[2];
+
+	// Slots have stable addresses, and are reused to avoid reallocating
+	// the strings and vectors of each alignment
+	std::deque<BamTools::BamAlignment> mSlots;
+	std::vector<int32_t> mFreeSlots;
+};
+
+#endif